@@ -0,0 +1,7 @@
+'''
+Performance benchmarks for musicbatch
+
+Run `python -m benchmarks --help` from the repository root. All test data is
+generated offline, results are printed as JSON to allow comparing them
+between commits.
+'''
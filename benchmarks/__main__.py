@@ -0,0 +1,171 @@
+'''
+Run benchmarks and print results as JSON
+'''
+
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime
+
+from benchmarks.library import generate_library
+from benchmarks.suite import BENCHMARKS, environment, run_benchmarks
+
+
+
+def main(*a, **ka):
+    args = parse_args(*a, **ka)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='musicbatch-bench-')
+    library = os.path.join(workdir, 'library')
+    albums = generate_library(
+        library,
+        files = args.files,
+        duration = args.duration,
+        metadata_share = args.metadata_share,
+    )
+    env = environment(
+        workdir,
+        library,
+        albums,
+        repeat = args.repeat,
+        lyrics_rows = args.lyrics_rows,
+        lookups = args.lookups,
+        memory_tasks = args.memory_tasks,
+        transcode_artists = args.transcode_artists,
+    )
+    report = dict(
+        info = dict(
+            commit = git_commit(),
+            python = platform.python_version(),
+            platform = platform.platform(),
+            cpus = os.cpu_count(),
+            time = datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+            files = args.files,
+        ),
+        results = run_benchmarks(env, args.only),
+    )
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)['results'], report['results'])
+
+
+
+def parse_args(*a, **ka):
+    parser = ArgumentParser(
+        prog='python -m benchmarks',
+        description='Run performance benchmarks on a synthetic music library',
+    )
+    parser.add_argument(
+        '--workdir',
+        metavar='DIR',
+        help='Directory for generated test data (reused between runs; default: new temporary directory)',
+    )
+    parser.add_argument(
+        '--files',
+        type=int,
+        default=2000,
+        help='Number of music files in synthetic library (default: 2000)',
+    )
+    parser.add_argument(
+        '--duration',
+        type=float,
+        default=0.2,
+        help='Duration of each music file in seconds (default: 0.2)',
+    )
+    parser.add_argument(
+        '--metadata-share',
+        type=float,
+        default=0.5,
+        help='Share of albums with metadata files (default: 0.5)',
+    )
+    parser.add_argument(
+        '--transcode-artists',
+        type=int,
+        default=1,
+        help='Number of artist directories to be transcoded by each encoder (default: 1)',
+    )
+    parser.add_argument(
+        '--lyrics-rows',
+        type=int,
+        nargs='+',
+        default=[10000, 1000000],
+        metavar='ROWS',
+        help='Sizes of lyrics databases (default: 10000 1000000)',
+    )
+    parser.add_argument(
+        '--lookups',
+        type=int,
+        default=1000,
+        help='Number of cached lyrics lookups per database (default: 1000)',
+    )
+    parser.add_argument(
+        '--memory-tasks',
+        type=int,
+        default=200000,
+        help='Number of planned tasks created by memory benchmark (default: 200000)',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of repetitions, the best time is reported (default: 3)',
+    )
+    parser.add_argument(
+        '--only',
+        nargs='+',
+        choices=[b.__name__ for b in BENCHMARKS],
+        metavar='NAME',
+        help='Run only selected benchmarks: {}'.format(', '.join(b.__name__ for b in BENCHMARKS)),
+    )
+    parser.add_argument(
+        '--output',
+        metavar='FILE',
+        help='Save JSON results to file instead of printing them',
+    )
+    parser.add_argument(
+        '--compare',
+        metavar='FILE',
+        help='Compare results with previously saved JSON file',
+    )
+    return parser.parse_args(*a, **ka)
+
+
+
+def compare(old, new):
+    '''Print relative change of each benchmark result'''
+    for name in sorted(new):
+        before = old.get(name, {}).get('seconds')
+        after = new[name].get('seconds')
+        if before and after:
+            change = '{:+.1%}'.format(after / before - 1)
+        else:
+            change = 'n/a'
+        print('{name:<30} {change:>8}'.format(name=name, change=change), file=sys.stderr)
+
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+'''
+Generate synthetic music library for benchmarks
+'''
+
+
+import json
+import math
+import os
+import random
+import struct
+import wave
+
+
+ARTISTS = (
+    'The Beatles',
+    'Beatles, the',
+    'Amaranthe',
+    'Пилот',
+    'Flёur',
+    'Kiroro',
+    'Lauren Daigle',
+    'Hemanta Mukherjee',
+)
+WORDS = (
+    'love', 'night', 'road', 'river', 'дорога', 'ночь', 'yellow', 'submarine',
+    'world', 'heart', 'stone', 'sky', 'fire', 'rain', 'home', 'dream',
+)
+GENRES = ('Rock', 'Pop', 'Folk', 'Jazz', 'Soundtrack')
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2  # bytes
+MARKER = '.synthetic-library.json'
+
+
+
+def generate_library(directory, files=2000, tracks_per_album=10, duration=0.2,
+                     seed=42, flac_share=0.5, cover_share=0.8, metadata_share=0.5):
+    '''
+    Create nested directory tree with short tagged music files, cover images
+    and metadata files. Existing library with the same parameters is reused.
+
+    Return the list of album directories.
+    '''
+    params = dict(
+        files = files,
+        tracks_per_album = tracks_per_album,
+        duration = duration,
+        seed = seed,
+        flac_share = flac_share,
+        cover_share = cover_share,
+        metadata_share = metadata_share,
+    )
+    marker = os.path.join(directory, MARKER)
+    try:
+        with open(marker) as f:
+            saved = json.load(f)
+        if saved['params'] == params:
+            return saved['albums']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    rng = random.Random(seed)
+    pcm = sine_wave(duration)
+    flac = flac_stream(pcm)
+    albums = []
+    number = 0
+    album_number = 0
+    while number < files:
+        album_number += 1
+        artist = rng.choice(ARTISTS)
+        album = '{} {}'.format(rng.choice(WORDS).title(), album_number)
+        year = str(rng.randint(1960, 2020))
+        genre = rng.choice(GENRES)
+        album_dir = os.path.join(
+            directory,
+            artist,
+            '{} - {}'.format(year, album),
+        )
+        discs = 2 if rng.random() < 0.1 else 1
+        fmt = 'flac' if rng.random() < flac_share else 'wav'
+        track_dirs = []
+        for disc in range(1, discs + 1):
+            if discs > 1:
+                track_dir = os.path.join(album_dir, 'CD{}'.format(disc))
+            else:
+                track_dir = album_dir
+            os.makedirs(track_dir, exist_ok=True)
+            track_dirs.append(track_dir)
+            for track in range(1, tracks_per_album + 1):
+                if number >= files:
+                    break
+                number += 1
+                title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).capitalize()
+                filename = os.path.join(track_dir, '{:02d}.{}'.format(track, fmt))
+                tags = dict(
+                    artist = artist,
+                    album = album,
+                    title = title,
+                    date = year,
+                    genre = genre,
+                    tracknumber = str(track),
+                    discnumber = str(disc),
+                )
+                if fmt == 'flac':
+                    write_flac(filename, flac, tags)
+                else:
+                    write_wav(filename, pcm, tags)
+        if rng.random() < cover_share:
+            write_cover(album_dir, rng)
+        if rng.random() < metadata_share:
+            write_metadata(track_dirs)
+        albums.extend(track_dirs)
+
+    with open(marker, 'w') as f:
+        json.dump(dict(params=params, albums=albums), f)
+    return albums
+
+
+
+def sine_wave(duration, frequency=440, amplitude=0.3):
+    '''Return raw PCM data (16 bit signed little endian, interleaved stereo)'''
+    count = int(SAMPLE_RATE * duration)
+    peak = amplitude * (2 ** (8 * SAMPLE_WIDTH - 1) - 1)
+    samples = []
+    for i in range(count):
+        value = int(peak * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE))
+        samples.extend([value] * CHANNELS)
+    return struct.pack('<{}h'.format(len(samples)), *samples)
+
+
+
+def write_wav(filename, pcm, tags):
+    '''Write WAV file with ID3 tags'''
+    with wave.open(filename, 'wb') as output:
+        output.setnchannels(CHANNELS)
+        output.setsampwidth(SAMPLE_WIDTH)
+        output.setframerate(SAMPLE_RATE)
+        output.writeframes(pcm)
+    from mutagen.id3 import TALB, TCON, TDRC, TIT2, TPE1, TPOS, TRCK
+    from mutagen.wave import WAVE
+    audio = WAVE(filename)
+    audio.add_tags()
+    for frame, key in (
+        (TPE1, 'artist'),
+        (TALB, 'album'),
+        (TIT2, 'title'),
+        (TDRC, 'date'),
+        (TCON, 'genre'),
+        (TRCK, 'tracknumber'),
+        (TPOS, 'discnumber'),
+    ):
+        audio.tags.add(frame(encoding=3, text=tags[key]))
+    audio.save()
+
+
+
+def write_flac(filename, stream, tags):
+    '''Write FLAC file with Vorbis comments'''
+    with open(filename, 'wb') as output:
+        output.write(stream)
+    from mutagen.flac import FLAC
+    audio = FLAC(filename)
+    audio.add_tags()
+    for key, value in tags.items():
+        audio[key] = value
+    audio.save()
+
+
+
+def write_cover(album_dir, rng):
+    '''Write cover art image with one of the supported names'''
+    from PIL import Image
+    name, fmt = rng.choice((
+        ('cover.jpg', 'jpeg'),
+        ('folder.jpg', 'jpeg'),
+        ('front.png', 'png'),
+    ))
+    color = tuple(rng.randint(0, 255) for _ in range(3))
+    image = Image.new('RGB', (600, 600), color)
+    image.save(os.path.join(album_dir, name), format=fmt)
+
+
+
+def write_metadata(directories):
+    '''Generate HODS metadata files for the album'''
+    from musicbatch.metadata.objects import generate
+    generate(directories)
+
+
+
+def flac_stream(pcm, blocksize=4096):
+    '''
+    Encode raw PCM data into a minimal valid FLAC stream.
+
+    Only verbatim subframes are used, so the result is not compressed at all.
+    This is enough for benchmarks and requires no external encoder.
+    '''
+    frame_bytes = blocksize * CHANNELS * SAMPLE_WIDTH
+    total_samples = len(pcm) // (CHANNELS * SAMPLE_WIDTH)
+
+    streaminfo = struct.pack('>HH', blocksize, blocksize)
+    streaminfo += b'\x00' * 6  # min/max frame size are unknown
+    streaminfo += (
+        (SAMPLE_RATE << 44)
+        | ((CHANNELS - 1) << 41)
+        | ((8 * SAMPLE_WIDTH - 1) << 36)
+        | total_samples
+    ).to_bytes(8, 'big')
+    streaminfo += b'\x00' * 16  # MD5 is not calculated
+    header = bytes([0x80]) + len(streaminfo).to_bytes(3, 'big')  # last metadata block
+
+    frames = []
+    for number, offset in enumerate(range(0, len(pcm), frame_bytes)):
+        chunk = pcm[offset:offset + frame_bytes]
+        samples = len(chunk) // (CHANNELS * SAMPLE_WIDTH)
+        values = struct.unpack('<{}h'.format(samples * CHANNELS), chunk)
+        frame = bytearray(b'\xff\xf8')
+        frame.append(0x79)  # 16 bit block size at the end of header, 44.1kHz
+        frame.append(((CHANNELS - 1) << 4) | 0x08)  # independent channels, 16 bps
+        frame.extend(utf8_number(number))
+        frame.extend(struct.pack('>H', samples - 1))
+        frame.append(crc8(frame))
+        for channel in range(CHANNELS):
+            frame.append(0x02)  # verbatim subframe
+            frame.extend(struct.pack('>{}h'.format(samples), *values[channel::CHANNELS]))
+        frame.extend(struct.pack('>H', crc16(frame)))
+        frames.append(bytes(frame))
+    return b'fLaC' + header + streaminfo + b''.join(frames)
+
+
+
+def utf8_number(number):
+    '''UTF-8 like encoding of frame numbers used by FLAC'''
+    if number < 0x80:
+        return bytes([number])
+    payload = []
+    while True:
+        payload.insert(0, 0x80 | (number & 0x3f))
+        number >>= 6
+        length = len(payload) + 1
+        if number < (1 << (7 - length)):
+            break
+    first = (0xff << (8 - length)) & 0xff | number
+    return bytes([first] + payload)
+
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+    return crc
+
+
+
+def crc16(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x8005) & 0xffff if crc & 0x8000 else (crc << 1) & 0xffff
+    return crc
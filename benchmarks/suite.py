@@ -0,0 +1,304 @@
+'''
+Benchmarks for the most performance sensitive code paths
+'''
+
+
+import os
+import random
+import shutil
+import sqlite3
+import time
+from types import SimpleNamespace
+
+from musicbatch.transcoder.util import find_music
+
+
+
+ENCODERS = ('vorbis', 'lame', 'aac', 'opus', 'copy', 'symlink')
+TRACKS_PER_ALBUM = 12
+BENCHMARKS = []
+
+
+
+def benchmark(function):
+    '''Register a benchmark'''
+    BENCHMARKS.append(function)
+    return function
+
+
+
+class Timer:
+    '''Measure the best of several runs'''
+
+    def __init__(self, repeat=3):
+        self.repeat = repeat
+
+
+    def __call__(self, function, *a, **ka):
+        '''
+        Execute function repeatedly, return the best time and the number of
+        processed items (the value returned by function)
+        '''
+        best = None
+        items = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            items = function(*a, **ka)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return result(best, items)
+
+
+
+def result(seconds, items=None, **extra):
+    '''Benchmark result as a JSON serializable dictionary'''
+    data = dict(seconds=seconds)
+    if items:
+        data['items'] = items
+        data['per_item'] = seconds / items
+    data.update(extra)
+    return data
+
+
+
+@benchmark
+def scan(env):
+    '''Find all music files in the library'''
+    def walk():
+        return sum(1 for _ in find_music([env.library]))
+    return {'find_music': env.timer(walk)}
+
+
+
+@benchmark
+def queue(env):
+    '''Iterate over TranscodingQueue (reads tags and metadata for target paths)'''
+    from musicbatch.transcoder.queue import TranscodingQueue
+    def iterate():
+        return sum(1 for task in TranscodingQueue([env.library], env.pattern) if task.target)
+    return {'transcoding_queue': env.timer(iterate)}
+
+
+
+@benchmark
+def memory(env):
+    '''Memory used by planned transcoding tasks (extrapolated to a million tasks)'''
+    import tracemalloc
+    from musicbatch.transcoder.queue import SourceAlbum, TranscodingTask
+
+    def plan(make_task):
+        tracemalloc.start()
+        start = time.perf_counter()
+        tasks = []
+        album = None
+        for i in range(env.memory_tasks):
+            number = i % TRACKS_PER_ALBUM + 1
+            if number == 1:
+                album = '/media/music/Artist {}/{} - Album {}'.format(i // 100, 1970 + i % 50, i)
+            tasks.append(make_task(album, number))
+        elapsed = time.perf_counter() - start
+        used, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return result(
+            elapsed,
+            len(tasks),
+            bytes_per_task = used / len(tasks),
+            megabytes_per_million = used / len(tasks) * 10**6 / 2**20,
+        )
+
+    albums = {}
+    def compact(directory, number):
+        if number == 1:
+            albums.clear()
+            albums[directory] = SourceAlbum(directory)
+        task = TranscodingTask(
+            os.path.join(directory, '{:02d}.flac'.format(number)),
+            env.pattern,
+            number,
+            album = albums[directory],
+        )
+        task._target = 'Artist/Album/{:02d} Title.ogg'.format(number)
+        return task
+
+    def namespace(directory, number):  # baseline: plain object with __dict__
+        return SimpleNamespace(
+            source = os.path.join(directory, '{:02d}.flac'.format(number)),
+            source_dir = os.path.dirname(os.path.join(directory, '{:02d}.flac'.format(number))),
+            pattern = env.pattern,
+            number = number,
+            result = None,
+            status = None,
+            _metadata = None,
+            _tags = None,
+            _path_elements = None,
+            _target = 'Artist/Album/{:02d} Title.ogg'.format(number),
+            _target_dir = None,
+            _categories = None,
+        )
+
+    return {
+        'memory_tasks': plan(compact),
+        'memory_tasks_baseline': plan(namespace),
+    }
+
+
+
+@benchmark
+def transcode(env):
+    '''Full TranscodingJob run for each encoder on a subset of the library'''
+    from musicbatch.transcoder.app import TranscodingJob
+    from musicbatch.transcoder.queue import TranscodingQueue, execute_in_threadqueue
+    results = {}
+    inputs = sorted(os.path.join(env.library, d) for d in os.listdir(env.library)
+                    if os.path.isdir(os.path.join(env.library, d)))[:env.transcode_artists]
+    for encoder in ENCODERS:
+        output = os.path.join(env.workdir, 'output-{}'.format(encoder))
+        config = os.path.join(env.workdir, 'job-{}.yml'.format(encoder))
+        write_config(config, inputs, output, encoder, env.pattern)
+        def run():
+            shutil.rmtree(output, ignore_errors=True)
+            job = TranscodingJob(config)
+            tasks = TranscodingQueue(job.inputs, job.output_pattern)
+            execute_in_threadqueue(job.transcode, tasks, num_threads=job.threads)
+            return job.stats.done
+        try:
+            results['transcode_{}'.format(encoder)] = env.timer(run)
+        except Exception as e:
+            results['transcode_{}'.format(encoder)] = error(e)
+    return results
+
+
+
+@benchmark
+def coverart(env):
+    '''Resize cover art for every album'''
+    from musicbatch.transcoder.cover import copy_coverart
+    output = os.path.join(env.workdir, 'output-cover')
+    tasks = []
+    for number, album in enumerate(env.albums):
+        music = next(find_music([album]), None)
+        if music is None:
+            continue
+        tasks.append(SimpleNamespace(
+            source = music,
+            result = os.path.join(output, str(number), 'track.ogg'),
+        ))
+    def run():
+        shutil.rmtree(output, ignore_errors=True)
+        for task in tasks:
+            copy_coverart(task)
+        return len(tasks)
+    return {'copy_coverart': env.timer(run)}
+
+
+
+@benchmark
+def lyrics(env):
+    '''Cached lyrics lookups in databases of different sizes'''
+    from musicbatch.lyrics.db import LyricsStorage
+    results = {}
+    for rows in env.lyrics_rows:
+        path = os.path.join(env.workdir, 'lyrics-{}.db'.format(rows))
+        songs = make_lyrics_db(path, rows)
+        storage = LyricsStorage(path)
+        rng = random.Random(rows)
+        sample = [rng.choice(songs) for _ in range(env.lookups)]
+        def run():
+            for artist, title in sample:
+                if storage.get(artist.upper(), title) is None:
+                    raise RuntimeError('cached song not found: {} - {}'.format(artist, title))
+            return len(sample)
+        results['lyrics_get_{}'.format(rows)] = env.timer(run)
+    return results
+
+
+
+def run_benchmarks(env, names=None):
+    '''Run selected benchmarks and return the dictionary of results'''
+    results = {}
+    for function in BENCHMARKS:
+        if names and function.__name__ not in names:
+            continue
+        try:
+            results.update(function(env))
+        except Exception as e:
+            results[function.__name__] = error(e)
+    return results
+
+
+
+def error(exception):
+    return dict(error='{}: {}'.format(exception.__class__.__name__, exception))
+
+
+
+def write_config(filename, inputs, output, encoder, pattern):
+    '''Write transcoding job configuration'''
+    from ruamel import yaml
+    config = dict(
+        name = 'Benchmark ({})'.format(encoder),
+        input = inputs,
+        output = dict(
+            directory = output,
+            pattern = pattern,
+            format = encoder,
+        ),
+        extras = dict(
+            cover = False,
+            lyrics = False,
+        ),
+    )
+    with open(filename, 'w') as f:
+        yaml.YAML(typ='safe', pure=True).dump(config, f)
+
+
+
+def make_lyrics_db(filename, rows, seed=0):
+    '''
+    Create lyrics database with the given number of songs. Return the list of
+    (artist, title) tuples stored in the database
+    '''
+    rng = random.Random(seed)
+    songs = [
+        ('Artist {}'.format(i // 20), 'Song {} {:x}'.format(i, rng.getrandbits(32)))
+        for i in range(rows)
+    ]
+    if os.path.exists(filename):
+        return songs
+
+    from musicbatch.lyrics.db import LyricsStorage
+    from musicbatch.lyrics.keys import normalize
+    LyricsStorage(filename)  # create schema
+    text = 'La la la\n' * 20
+    connection = sqlite3.connect(filename)
+    with connection:
+        connection.executemany(
+            'INSERT INTO lyrics (artist, title, artist_key, title_key, text, source) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (
+                (artist, title, normalize(artist), normalize(title), text, 'benchmark')
+                for artist, title in songs
+            )
+        )
+    connection.close()
+    return songs
+
+
+
+def environment(workdir, library, albums, **options):
+    '''Shared parameters for all benchmarks'''
+    env = SimpleNamespace(
+        workdir = workdir,
+        library = library,
+        albums = albums,
+        pattern = '{artist}/{year} - {album}/{number} {title}',
+        transcode_artists = 1,
+        lyrics_rows = (10000, 1000000),
+        lookups = 1000,
+        memory_tasks = 200000,
+        timer = Timer(options.pop('repeat', 3)),
+    )
+    for key, value in options.items():
+        setattr(env, key, value)
+    return env
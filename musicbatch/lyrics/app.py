@@ -7,10 +7,9 @@ import logging
 import sys
 from argparse import ArgumentParser
 from threading import Thread
-from time import sleep
+from time import sleep, time
 
 from musicbatch.transcoder.progress import DotTicker
-from musicbatch.lyrics.db import LyricsStorage
 
 
 
@@ -20,17 +19,46 @@ log = logging.getLogger('musicbatch.lyrics.app')
 
 def run(*a, **ka):
     args = parse_args(*a, **ka)
+    from musicbatch.lyrics.db import LyricsStorage  # heavy import, skip it for --help
     path = os.path.expandvars(args.database)
-    db = LyricsStorage(path)
+    cache = None
+    if args.http_cache:
+        from musicbatch.lyrics.cache import HTTPCache
+        from musicbatch.transcoder.deadline import parse_duration
+        options = {}
+        if args.http_cache_mode:
+            options['mode'] = args.http_cache_mode
+        if args.http_cache_ttl:
+            options['ttl'] = parse_duration(args.http_cache_ttl)
+        cache = HTTPCache(os.path.expandvars(args.http_cache), **options)
+    db = LyricsStorage(path, adaptive=not args.fixed_order, cache=cache)
     ui = UIThread(db)
-    if args.retry_scheduled:
+    if args.sources:
+        print(sources_report(db.sources()))
+    elif args.retry_scheduled:
+        budget = None
+        if args.max_duration:
+            from musicbatch.transcoder.deadline import TimeBudget, parse_duration
+            budget = TimeBudget(time() + parse_duration(args.max_duration))
         with ui:
-            db.get_scheduled()
+            db.get_scheduled(
+                engine = args.engine,
+                strategy = args.strategy,
+                limit = args.limit,
+                budget = budget,
+            )
     elif args.scan_library:
         with ui:
-            db.build_library(args.scan_library)
+            db.build_library(
+                args.scan_library,
+                engine = args.engine,
+                strategy = args.strategy,
+                prefetch = args.prefetch,
+                incremental = not args.full_scan,
+            )
     elif args.artist and args.title:
-        lyrics = db.get(args.artist, args.title)
+        lyrics = db.get(args.artist, args.title, strategy=args.strategy)
+        db.close()
         if lyrics:
             print(lyrics)
         else:
@@ -79,14 +107,107 @@ def parse_args(*a, prog=None, **ka):
         metavar='DIR',
         help='Populate local lyrics database with texts for all songs in this directory (recursive)',
     )
+    parser.add_argument(
+        '--prefetch',
+        action='store_true',
+        default=False,
+        help=(
+            'Load the list of stored and scheduled songs at once when scanning library, '
+            'fetch only the songs missing from both (scheduled songs are left for --retry-scheduled)'
+        ),
+    )
+    parser.add_argument(
+        '--full-scan',
+        action='store_true',
+        default=False,
+        help=(
+            'Read tags of all music files when scanning library '
+            '(by default only directories changed since the previous scan are read)'
+        ),
+    )
     parser.add_argument(
         '--retry-scheduled',
         action='store_true',
         default=False,
-        help='Retry fetching lyrics that were unavailable in previous runs',
+        help=(
+            'Retry fetching lyrics that were unavailable in previous runs. '
+            'Each song is retried after a delay that doubles with every failed attempt '
+            '(from one day up to 90 days)'
+        ),
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=None,
+        metavar='N',
+        help='Retry at most N scheduled songs, the longest waiting first',
+    )
+    parser.add_argument(
+        '--max-duration',
+        metavar='DURATION',
+        help='Stop retrying scheduled songs when this much time has passed, e.g. 90m or 2h30m',
+    )
+    parser.add_argument(
+        '--sources',
+        action='store_true',
+        default=False,
+        help='Show health statistics of lyrics sources',
+    )
+    parser.add_argument(
+        '--engine',
+        default='async',
+        choices=('async', 'threads'),
+        help='Fetch lyrics for batch actions with asyncio on a single thread (default) or with a pool of threads',
+    )
+    parser.add_argument(
+        '--fixed-order',
+        action='store_true',
+        default=False,
+        help=(
+            'Always query lyrics sources in order of priority '
+            '(by default the sources with the best hit rate for similar songs go first)'
+        ),
+    )
+    parser.add_argument(
+        '--strategy',
+        default='sequential',
+        choices=('sequential', 'hedged', 'concurrent'),
+        help=(
+            'Query lyrics sources one by one in order of priority (default), '
+            'start the next source if previous ones are slow to respond, '
+            'or query all sources at once. First lyrics found win'
+        ),
+    )
+    parser.add_argument(
+        '--http-cache',
+        default=None,
+        metavar='DIR',
+        help=(
+            'Keep compressed copies of web pages received from lyrics sources in this directory. '
+            'Cached pages are reused instead of fetching them again'
+        ),
+    )
+    parser.add_argument(
+        '--http-cache-mode',
+        default=None,
+        choices=('cache', 'record', 'replay'),
+        help=(
+            'Use cached pages until they expire (default), '
+            'fetch and store all pages, '
+            'or work offline with cached pages only (missing pages are reported as fetch errors)'
+        ),
+    )
+    parser.add_argument(
+        '--http-cache-ttl',
+        default=None,
+        metavar='DURATION',
+        help='Fetch cached pages again when they are older than this, e.g. 24h (default: 720h)',
     )
     args = parser.parse_args(*a, **ka)
-    if  not args.scan_library \
+    if args.sources:
+        if args.scan_library or args.retry_scheduled or args.artist or args.title:
+            parser.error('--sources can not be combined with other actions')
+    elif not args.scan_library \
     and not args.retry_scheduled \
     and not (args.artist or args.title):
         parser.error('No action requested')
@@ -95,13 +216,49 @@ def parse_args(*a, prog=None, **ka):
         parser.error('Choose either one of batch actions or a single song')
     elif (args.scan_library and args.retry_scheduled):
         parser.error('Only one batch action can be selected')
+    elif (args.prefetch or args.full_scan) and not args.scan_library:
+        parser.error('--prefetch and --full-scan require --scan-library')
+    elif (args.limit is not None or args.max_duration) and not args.retry_scheduled:
+        parser.error('--limit and --max-duration require --retry-scheduled')
     elif (args.artist or args.title) \
     and not (args.artist and args.title):
         parser.error('Can not specify artist without title')
+    if (args.http_cache_mode or args.http_cache_ttl) and not args.http_cache:
+        parser.error('--http-cache-mode and --http-cache-ttl require --http-cache')
     return args
 
 
 
+def sources_report(sources):
+    '''Format health statistics of lyrics sources as a table'''
+    template = '{name:<24} {lookups:>8} {found:>8} {rate:>7} {latency:>8} {failures:>8}  {status}'
+    lines = [template.format(
+        name = 'Source',
+        lookups = 'Lookups',
+        found = 'Found',
+        rate = 'Rate',
+        latency = 'Latency',
+        failures = 'Failures',
+        status = 'Status',
+    )]
+    for source in sources:
+        if source.disabled:
+            status = 'disabled, next probe at {:%Y-%m-%d %H:%M} UTC'.format(source.retry_at)
+        else:
+            status = 'enabled'
+        lines.append(template.format(
+            name = source.name,
+            lookups = source.lookups,
+            found = source.found,
+            rate = '-' if source.success_rate is None else '{:.1%}'.format(source.success_rate),
+            latency = '-' if source.mean_latency is None else '{:.2f}s'.format(source.mean_latency),
+            failures = source.failures,
+            status = status,
+        ))
+    return '\n'.join(lines)
+
+
+
 class UIThread:
     '''User interface thread for long running tasks'''
 
@@ -0,0 +1,189 @@
+'''
+On-disk cache of HTTP responses for lyrics fetchers
+
+Record responses while fetching lyrics, then replay them to run (and
+benchmark) the whole fetch pipeline offline, or keep raw pages for a while
+so that fixed parsers can be rerun without fetching the pages again.
+'''
+
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from musicbatch.lyrics.client import HTTPError, Response, build_url
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+CACHE = 'cache'  # use fresh cached responses, fetch and store the rest
+RECORD = 'record'  # always fetch, store all responses
+REPLAY = 'replay'  # never fetch, missing responses are errors
+MODES = (CACHE, RECORD, REPLAY)
+DEFAULT_TTL = 30 * 24 * 3600  # seconds
+
+
+
+class CacheMiss(HTTPError):
+    '''Response is not available in replay mode'''
+
+
+
+class HTTPCache:
+    '''
+    Compressed content-addressed storage of HTTP responses.
+
+    Response bodies are gzipped and stored under the SHA-256 of their
+    content, so identical pages are kept once. Each request URL (with query
+    parameters) points to a small JSON record with status, headers, final
+    URL after redirects and the digest of the body. All files are written
+    atomically, the cache may be shared between processes.
+
+    Cached responses older than `ttl` seconds are fetched again in `cache`
+    mode, `replay` mode ignores the age of responses
+    '''
+
+    def __init__(self, directory, mode=CACHE, ttl=DEFAULT_TTL, clock=time.time):
+        if mode not in MODES:
+            raise ValueError('Unknown cache mode: {}'.format(mode))
+        self.directory = directory
+        self.mode = mode
+        self.ttl = ttl
+        self.clock = clock
+
+
+    def __repr__(self):
+        return '<{cls}({directory!r}, mode={mode})>'.format(
+            cls = self.__class__.__name__,
+            directory = self.directory,
+            mode = self.mode,
+        )
+
+
+    def path(self, kind, digest, extension):
+        return os.path.join(self.directory, kind, digest[:2], digest + extension)
+
+
+    def load(self, url):
+        '''Return cached Response for the URL (or None)'''
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        try:
+            with open(self.path('requests', key, '.json'), encoding='utf-8') as f:
+                record = json.load(f)
+            if self.mode != REPLAY and self.ttl is not None \
+            and self.clock() - record['fetched'] > self.ttl:
+                return None
+            with gzip.open(self.path('objects', record['content'], '.gz'), 'rb') as f:
+                content = f.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        return Response(
+            record['final_url'],
+            record['status'],
+            record['reason'],
+            record['headers'],
+            content,
+        )
+
+
+    def save(self, url, response):
+        '''Store the response to the request for URL'''
+        content = hashlib.sha256(response.content).hexdigest()
+        blob = self.path('objects', content, '.gz')
+        if not os.path.exists(blob):
+            self._write(blob, gzip.compress(response.content))
+        record = dict(
+            url = url,
+            final_url = response.url,
+            status = response.status,
+            reason = response.reason,
+            headers = dict(response.headers),
+            content = content,
+            fetched = self.clock(),
+        )
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        self._write(self.path('requests', key, '.json'), json.dumps(record, ensure_ascii=False).encode('utf-8'))
+
+
+    def _write(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+
+    def cached(self, url, params=None):
+        '''
+        Return cached response to the request if it may be used in the current
+        mode. Raise CacheMiss in replay mode if there is none
+        '''
+        url = build_url(url, params)
+        response = None if self.mode == RECORD else self.load(url)
+        if response is None and self.mode == REPLAY:
+            raise CacheMiss('Response is not cached: {}'.format(url))
+        if response is not None:
+            log.debug('Using cached response for {}'.format(url))
+        return response
+
+
+    def get(self, url, params, download):
+        '''
+        Blocking GET request through the cache: `download(url)` returns
+        Response and is called only when no usable response is cached
+        '''
+        response = self.cached(url, params)
+        if response is None:
+            full_url = build_url(url, params)
+            try:
+                response = download(full_url)
+            except HTTPError as e:
+                if e.response is None:
+                    raise
+                response = e.response
+            if self.storable(response):
+                self.save(full_url, response)
+        return self.check(response, url)
+
+
+    async def get_async(self, url, params, download):
+        '''Same as get() for `download` coroutine function'''
+        response = self.cached(url, params)
+        if response is None:
+            full_url = build_url(url, params)
+            try:
+                response = await download(full_url)
+            except HTTPError as e:
+                if e.response is None:
+                    raise
+                response = e.response
+            if self.storable(response):
+                self.save(full_url, response)
+        return self.check(response, url)
+
+
+    @staticmethod
+    def storable(response):
+        '''
+        Error pages are stored too: most sources answer 404 for unknown songs.
+        Server errors and rate limit responses are transient
+        '''
+        return response.status < 500 and response.status != 429
+
+
+    @staticmethod
+    def check(response, url):
+        if response.status >= 400:
+            raise HTTPError('{} {} for {}'.format(response.status, response.reason, url), response)
+        return response
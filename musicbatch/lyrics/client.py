@@ -0,0 +1,329 @@
+'''
+Minimal asyncio HTTP/1.1 client with keep-alive connection pools per host
+'''
+
+
+import asyncio
+import gzip
+import ssl
+import zlib
+from urllib.parse import urlencode, urljoin, urlsplit
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) musicbatch'
+REDIRECTS = {301, 302, 303, 307, 308}
+
+
+
+def build_url(url, params=None):
+    '''Append query parameters to URL'''
+    if params:
+        url = '{}{}{}'.format(url, '&' if '?' in url else '?', urlencode(params))
+    return url
+
+
+
+class HTTPError(Exception):
+    '''Request has failed or server has returned an error status'''
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+
+class Response:
+    '''Received HTTP response (loosely compatible with requests.Response)'''
+
+    def __init__(self, url, status, reason, headers, content):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers  # lowercase names
+        self.content = content
+        self._encoding = None
+
+
+    def __repr__(self):
+        return '<{cls}({status} {url})>'.format(
+            cls = self.__class__.__name__,
+            status = self.status,
+            url = self.url,
+        )
+
+
+    @property
+    def status_code(self):
+        return self.status
+
+
+    @property
+    def encoding(self):
+        '''Character encoding from Content-Type header (if any)'''
+        if self._encoding is not None:
+            return self._encoding
+        for parameter in self.headers.get('content-type', '').split(';')[1:]:
+            key, _, value = parameter.strip().partition('=')
+            if key.lower() == 'charset' and value:
+                return value.strip('"\'')
+        return None
+
+
+    @encoding.setter
+    def encoding(self, value):
+        self._encoding = value
+
+
+    @property
+    def text(self):
+        try:
+            return self.content.decode(self.encoding or 'utf-8', errors='replace')
+        except LookupError:
+            return self.content.decode('utf-8', errors='replace')
+
+
+
+class Connection:
+    __slots__ = ('reader', 'writer', 'reused')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+
+
+    def close(self):
+        self.writer.close()
+
+
+
+class ConnectionPool:
+    '''Keep-alive connections to a single host'''
+
+    def __init__(self, host, port, tls=None, size=8):
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.size = size
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+        self.opened = 0  # total number of connections opened
+
+
+    def __repr__(self):
+        return '<{cls}({host}:{port}, idle={idle})>'.format(
+            cls = self.__class__.__name__,
+            host = self.host,
+            port = self.port,
+            idle = len(self.idle),
+        )
+
+
+    async def acquire(self):
+        '''Return an idle connection or open a new one'''
+        await self.slots.acquire()
+        try:
+            while self.idle:
+                connection = self.idle.pop()
+                if connection.reader.at_eof():  # closed by server
+                    connection.close()
+                    continue
+                connection.reused = True
+                return connection
+            reader, writer = await asyncio.open_connection(
+                self.host,
+                self.port,
+                ssl=self.tls,
+                server_hostname=self.host if self.tls else None,
+            )
+            self.opened += 1
+            return Connection(reader, writer)
+        except BaseException:
+            self.slots.release()
+            raise
+
+
+    def release(self, connection, reusable=True):
+        '''Return the connection to the pool (or close it)'''
+        if reusable:
+            self.idle.append(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+
+class HTTPClient:
+    '''
+    Asynchronous HTTP client for GET requests.
+
+    Connections are kept alive and reused for subsequent requests to the same
+    host, at most `connections_per_host` connections are open to each host
+    at any time. Redirects are followed, compressed responses are decoded.
+    Responses with error status, failed connections and malformed responses
+    raise HTTPError
+    '''
+
+    def __init__(self, connections_per_host=8, timeout=30, max_redirects=5, headers=None):
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.headers = {
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        self.headers.update(headers or {})
+        self.pools = {}
+        self._tls = None
+
+
+    def __repr__(self):
+        return '<{cls}({count} hosts)>'.format(
+            cls = self.__class__.__name__,
+            count = len(self.pools),
+        )
+
+
+    def pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        if key not in self.pools:
+            if scheme == 'https':
+                if self._tls is None:
+                    self._tls = ssl.create_default_context()
+                tls = self._tls
+            else:
+                tls = None
+            self.pools[key] = ConnectionPool(host, port, tls, self.connections_per_host)
+        return self.pools[key]
+
+
+    async def get(self, url, params=None):
+        '''Send GET request and return Response'''
+        url = build_url(url, params)
+        for _ in range(self.max_redirects + 1):
+            response = await self.send(url)
+            location = response.headers.get('location')
+            if response.status in REDIRECTS and location:
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                raise HTTPError('{} {} for {}'.format(response.status, response.reason, url), response)
+            return response
+        raise HTTPError('Too many redirects for {}'.format(url))
+
+
+    async def send(self, url):
+        '''Send a single request using pooled connection'''
+        parts = urlsplit(url)
+        if parts.scheme not in {'http', 'https'}:
+            raise HTTPError('Unsupported URL: {}'.format(url))
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        pool = self.pool(parts.scheme, parts.hostname, port)
+        while True:
+            try:
+                connection = await pool.acquire()
+            except OSError as e:  # unknown host, refused connection, TLS handshake
+                raise HTTPError('Connection failed for {}: {}'.format(url, e)) from e
+            try:
+                response, reusable = await asyncio.wait_for(
+                    self.exchange(connection, parts),
+                    self.timeout,
+                )
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                pool.release(connection, reusable=False)
+                if connection.reused:  # keep-alive connection was closed by server
+                    continue
+                raise HTTPError('Connection failed for {}: {}'.format(url, e))
+            except asyncio.TimeoutError:
+                pool.release(connection, reusable=False)
+                raise HTTPError('Timed out: {}'.format(url))
+            except (OSError, EOFError, ValueError, zlib.error) as e:  # malformed or corrupt response
+                pool.release(connection, reusable=False)
+                raise HTTPError('Invalid response from {}: {}'.format(url, e)) from e
+            except BaseException:
+                pool.release(connection, reusable=False)
+                raise
+            pool.release(connection, reusable)
+            return response
+
+
+    async def exchange(self, connection, parts):
+        '''Write request and read response. Return (response, keep-alive flag)'''
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        host = parts.hostname
+        if parts.port:
+            host += ':{}'.format(parts.port)
+        lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}'.format(host)]
+        lines.extend('{}: {}'.format(key, value) for key, value in self.headers.items())
+        lines.append('Connection: keep-alive')
+        request = '\r\n'.join(lines) + '\r\n\r\n'
+        connection.writer.write(request.encode('latin-1'))
+        await connection.writer.drain()
+
+        reader = connection.reader
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed before response')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        status = int(status)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in {b'\r\n', b'\n', b''}:
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        reusable = headers.get('connection', '').lower() != 'close' \
+               and (version == 'HTTP/1.1' or headers.get('connection', '').lower() == 'keep-alive')
+        if status in {204, 304} or 100 <= status < 200:
+            content = b''
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            content = await self.read_chunked(reader)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            reusable = False
+
+        encoding = headers.get('content-encoding', '').lower()
+        if encoding == 'gzip':
+            content = gzip.decompress(content)
+        elif encoding == 'deflate':
+            try:
+                content = zlib.decompress(content)
+            except zlib.error:
+                content = zlib.decompress(content, -zlib.MAX_WBITS)
+        return Response(parts.geturl(), status, reason, headers, content), reusable
+
+
+    @staticmethod
+    async def read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+            if not size:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)  # CRLF
+        while (await reader.readline()) not in {b'\r\n', b'\n', b''}:
+            pass  # trailers
+        return b''.join(chunks)
+
+
+    def close(self):
+        '''Close all idle connections'''
+        for pool in self.pools.values():
+            pool.close()
@@ -3,17 +3,25 @@ Scrape lyrics for all your songs into a database
 '''
 
 
+import atexit
+import hashlib
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from contextlib import contextmanager
+from threading import Lock, RLock
 
-import mutagen
 from sqlalchemy import (
     create_engine,
+    event,
+    inspect,
+    text,
     Column,
-    String,
     DateTime,
+    Float,
+    Index,
+    Integer,
+    String,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
@@ -21,19 +29,15 @@ from sqlalchemy.orm import (
     Query,
     sessionmaker,
 )
+from sqlalchemy.pool import StaticPool
 
-from musicbatch.transcoder.util import find_music
+from musicbatch.lyrics.health import Attempt, HealthMonitor, SourceStats
+from musicbatch.lyrics.keys import normalize
+from musicbatch.lyrics.routing import FeatureStats, FetcherRanking
+from musicbatch.lyrics.writer import BatchWriter
+from musicbatch.transcoder.util import walk_music
 from musicbatch.transcoder.progress import ThreadSafeCounter
 from musicbatch.transcoder.queue import execute_in_threadqueue
-from musicbatch.lyrics.fetchers import (
-    AzLyricsFetcher,
-    LyricsModeFetcher,
-    LyricsWikiFetcher,
-    LyricsWorldRuFetcher,
-    MetroLyricsFetcher,
-    MusixMatchFetcher,
-    SongTexteFetcher,
-)
 
 
 
@@ -41,12 +45,52 @@ log = logging.getLogger(__name__)
 Base = declarative_base()
 
 
+DEFAULT_ENGINE = 'async'
+DEFAULT_STRATEGY = 'sequential'
+SCHEMA_VERSION = 1  # increment when tables, columns or indexes are added
+MIGRATION_BATCH = 10000  # rows
+NEW_COLUMNS = {  # added to tables after the first release
+    'lyrics': (
+        ('artist_key', 'VARCHAR'),
+        ('title_key', 'VARCHAR'),
+    ),
+    'schedule': (
+        ('artist_key', 'VARCHAR'),
+        ('title_key', 'VARCHAR'),
+        ('attempts', 'INTEGER NOT NULL DEFAULT 1'),
+        ('next_attempt', 'DATETIME'),
+    ),
+}
+RETRY_DELAY = timedelta(days=1)  # before the first retry of a missing song, doubled after each attempt
+MAX_RETRY_DELAY = timedelta(days=90)
+BUSY_TIMEOUT = 60  # seconds to wait for the lock held by another connection
+READ_CONNECTIONS = 8
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',  # readers do not block the writer and vice versa
+    'PRAGMA synchronous = NORMAL',  # WAL is durable enough without fsync on every commit
+    'PRAGMA busy_timeout = {}'.format(BUSY_TIMEOUT * 1000),
+)
+
+
+
+def key_default(column):
+    '''Default value for lookup key: normalized value of another column'''
+    def default(context):
+        return normalize(context.get_current_parameters()[column])
+    return default
+
+
 
 class Lyrics(Base):
     __tablename__ = 'lyrics'
+    __table_args__ = (
+        Index('lyrics_lookup', 'artist_key', 'title_key'),
+    )
 
     artist = Column(String, primary_key=True)
     title = Column(String, primary_key=True)
+    artist_key = Column(String, default=key_default('artist'))
+    title_key = Column(String, default=key_default('title'))
     text = Column(String)
     source = Column(String)
     timestamp = Column(
@@ -60,9 +104,17 @@ class Lyrics(Base):
 
 class Schedule(Base):
     __tablename__ = 'schedule'
+    __table_args__ = (
+        Index('schedule_lookup', 'artist_key', 'title_key'),
+        Index('schedule_due', 'next_attempt'),
+    )
 
     artist = Column(String, primary_key=True)
     title = Column(String, primary_key=True)
+    artist_key = Column(String, default=key_default('artist'))
+    title_key = Column(String, default=key_default('title'))
+    attempts = Column(Integer, nullable=False, default=1)
+    next_attempt = Column(DateTime)
     timestamp = Column(
         DateTime(timezone=True),
         server_default=func.now(),
@@ -72,106 +124,427 @@ class Schedule(Base):
 
 
 
-class LyricsStorage:
-    '''Persistent storage for song lyrics'''
+class Source(Base):
+    '''Health statistics of a lyrics source (see musicbatch.lyrics.health)'''
+    __tablename__ = 'sources'
 
+    name = Column(String, primary_key=True)
+    lookups = Column(Integer, nullable=False, default=0)
+    found = Column(Integer, nullable=False, default=0)
+    errors = Column(Integer, nullable=False, default=0)
+    failures = Column(Integer, nullable=False, default=0)
+    latency = Column(Float, nullable=False, default=0.0)
+    retry_at = Column(DateTime)
+    timestamp = Column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        server_onupdate=func.now(),
+        nullable=False,
+    )
+
+
+
+class Hits(Base):
+    '''Lookup outcomes per lyrics source and song feature (see musicbatch.lyrics.routing)'''
+    __tablename__ = 'hits'
+
+    feature = Column(String, primary_key=True)
+    source = Column(String, primary_key=True)
+    lookups = Column(Integer, nullable=False, default=0)
+    found = Column(Integer, nullable=False, default=0)
 
-    fetchers = (
-        LyricsWikiFetcher(),
-        MetroLyricsFetcher(),
-        LyricsModeFetcher(),
-        SongTexteFetcher(),
-        LyricsWorldRuFetcher(),
-        AzLyricsFetcher(),
-        MusixMatchFetcher(),
+
+
+class Checkpoint(Base):
+    '''State of music directory at the time of the last library scan'''
+    __tablename__ = 'checkpoints'
+
+    directory = Column(String, primary_key=True)
+    mtime = Column(Float, nullable=False)
+    digest = Column(String, nullable=False)  # names, sizes and mtimes of music files
+    timestamp = Column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        server_onupdate=func.now(),
+        nullable=False,
     )
 
 
-    def __init__(self, filename=None):
-        if filename is None:
-            url = 'sqlite://'
+
+class LyricsStorage:
+    '''
+    Persistent storage for song lyrics.
+
+    Fetchers send HTTP requests through `cache` (HTTPCache) if provided
+    '''
+
+
+    FETCHERS = (  # names of classes from musicbatch.lyrics.fetchers
+        'LyricsWikiFetcher',
+        'MetroLyricsFetcher',
+        'LyricsModeFetcher',
+        'SongTexteFetcher',
+        'LyricsWorldRuFetcher',
+        'AzLyricsFetcher',
+        'MusixMatchFetcher',
+    )
+    _fetchers = None
+    _fetchers_lock = Lock()
+
+
+    @property
+    def fetchers(self):
+        '''
+        Lyrics fetchers in order of priority.
+
+        Fetchers depend on heavy libraries (lxml, scrapehelper), so they are
+        imported and instantiated only when the first song is not found in
+        local storage. Instances are shared between all LyricsStorage objects.
+        '''
+        cls = self.__class__
+        if cls._fetchers is None:
+            with cls._fetchers_lock:
+                if cls._fetchers is None:
+                    from musicbatch.lyrics import fetchers
+                    cls._fetchers = tuple(getattr(fetchers, name)() for name in cls.FETCHERS)
+        return cls._fetchers
+
+
+    def __init__(self, filename=None, adaptive=True, cache=None):
+        if filename is None:  # single connection shared between threads
+            self.db = create_engine(
+                'sqlite://',
+                connect_args={'check_same_thread': False},
+                poolclass=StaticPool,
+            )
+            self.write_db = self.db
+            self.connection_lock = RLock()
         else:
             url = 'sqlite:///{}'.format(os.path.abspath(filename))
-        self.db = create_engine(url)
-        Base.metadata.create_all(self.db)
+            self.db = sqlite_engine(url, pool_size=READ_CONNECTIONS)
+            self.write_db = sqlite_engine(url, pool_size=1, immediate=True)
+            self.connection_lock = None
+        if schema_version(self.db) < SCHEMA_VERSION:  # opening up-to-date database does not write
+            Base.metadata.create_all(self.write_db)
+            upgrade_schema(self.write_db)
         self.sessionmaker = sessionmaker(bind=self.db)
+        self.write_sessionmaker = sessionmaker(bind=self.write_db)
         self.stats = StorageStats()
+        self.health = HealthMonitor(self.load_health())
+        self.ranking = FetcherRanking(self.load_hits()) if adaptive else None
+        self.cache = cache
+        self.pending = {}  # lyrics waiting for the writer: {(artist_key, title_key): text}
+        self.pending_lock = Lock()
+        self.writer = BatchWriter(
+            lambda: self.session(write=True),
+            before_commit=self.save_health,
+            committed=self.written,
+        )
+        atexit.register(self.writer.close)
 
 
-    def get(self, artist, title):
-        '''Return lyrics for a single song'''
+    def __repr__(self):
+        return '<{cls}({url})>'.format(
+            cls = self.__class__.__name__,
+            url = self.db.url,
+        )
+
+
+    def get(self, artist, title, strategy=DEFAULT_STRATEGY):
+        '''
+        Return lyrics for a single song.
+        Fetchers are called one by one unless another strategy is requested
+        (see AsyncFetchEngine)
+        '''
         log.debug('Retrieving lyrics for: {} - {}'.format(artist, title))
+        # 1. Return from storage
+        text = self.stored(artist, title)
+        if text is not None:
+            return text
+
+        # 2. Do not retry missing songs before they are due (see get_scheduled)
+        if self.waiting(artist, title):
+            return None
+
+        # 3. Use fetchers to retrieve lyrics
+        return self.fetch(artist, title, strategy)
+
+
+    def fetch(self, artist, title, strategy=DEFAULT_STRATEGY):
+        '''Retrieve lyrics from the web without checking local storage first'''
+        if strategy != 'sequential':
+            result = []
+            engine = self.fetch_engine(strategy)
+            engine.run([(artist, title)], lambda *args: result.append(self.record(*args)))
+            return result[0] if result else None
+        fetchers = self.fetchers
+        if self.ranking is not None:
+            fetchers = self.ranking.order(fetchers, artist, title)
+        for fetcher in fetchers:
+            if not self.health.available(fetcher):
+                continue
+            attempt = Attempt(fetcher)
+            try:
+                text = fetcher(artist, title, attempt, self.cache)
+            except Exception as e:
+                attempt.failed(e)
+                self.health.record(attempt, False)
+                raise
+            self.health.record(attempt, text is not fetcher.NOT_FOUND)
+            if self.ranking is not None:
+                self.ranking.record(artist, title, fetcher, text is not fetcher.NOT_FOUND)
+            if text is not fetcher.NOT_FOUND:
+                return self.record(artist, title, text, fetcher)
+        return self.record(artist, title, None, None)
+
+
+    def stored(self, artist, title):
+        '''Return lyrics from local storage (or None)'''
+        key = normalize(artist), normalize(title)
+        with self.pending_lock:
+            text = self.pending.get(key)
+        if text is not None:
+            self.stats.cached.increment()
+            return text
         with self.session() as session:
-            # 1. Return from storage
             query = Query(Lyrics).filter(
-                (func.lower(Lyrics.artist) == func.lower(artist)),
-                (func.lower(Lyrics.title) == func.lower(title)),
+                (Lyrics.artist_key == key[0]),
+                (Lyrics.title_key == key[1]),
             )
             for lyrics in query.with_session(session):
                 log.debug('Lyrics found in storage')
                 self.stats.cached.increment()
                 return lyrics.text
 
-            # 2. Use fetchers to retrieve lyrics
-            schedule_query = Query(Schedule).filter(
-                (func.lower(Schedule.artist) == func.lower(artist)),
-                (func.lower(Schedule.title) == func.lower(title)),
-            )
-            for fetcher in self.fetchers:
-                text = fetcher(artist, title)
-                if text is fetcher.NOT_FOUND:
-                    continue
-                lyrics = Lyrics(artist=artist, title=title, text=text, source=fetcher.HOME)
-                session.add(lyrics)
-                schedule_query.with_session(session).delete(synchronize_session=False)
-                log.debug('Lyrics fetched from {}'.format(fetcher.HOME))
-                self.stats.fetched.increment()
-                return lyrics.text
 
-            # 3. Record failure
-            schedule = schedule_query.with_session(session).first()
-            if not schedule:
-                schedule = Schedule(artist=artist, title=title)
-                session.add(schedule)
-            else:
-                schedule.timestamp = datetime.utcnow()
+    def waiting(self, artist, title, now=None):
+        '''True if the song was not found recently and is not due for another attempt'''
+        if now is None:
+            now = datetime.utcnow()
+        with self.session() as session:
+            query = Query(Schedule.next_attempt).filter(
+                (Schedule.artist_key == normalize(artist)),
+                (Schedule.title_key == normalize(title)),
+            )
+            for next_attempt, in query.with_session(session):
+                if next_attempt is not None and next_attempt > now:
+                    log.debug('Lyrics were not found recently, next attempt at {}'.format(next_attempt))
+                    self.stats.waiting.increment()
+                    return True
+        return False
+
+
+    def record(self, artist, title, text, fetcher):
+        '''
+        Save fetched lyrics to storage or schedule the song for later
+        if nothing was found. Return the lyrics.
+
+        Changes are written to database in background by a single writer
+        thread, see flush()
+        '''
+        if text is not None:
+            key = normalize(artist), normalize(title)
+            with self.pending_lock:
+                self.pending[key] = text
+            self.writer.put(lambda session: store_lyrics(session, artist, title, text, fetcher.HOME), key)
+            log.debug('Lyrics fetched from {}'.format(fetcher.HOME))
+            self.stats.fetched.increment()
+            return text
+        else:
+            self.writer.put(lambda session: schedule_song(session, artist, title))
             log.debug('Lyrics not found. Scheduled for later')
             self.stats.missing.increment()
-            return fetcher.NOT_FOUND
+            return None
 
 
-    def build_library(self, *directories):
-        '''Build the library of lyrics for all songs in provided directories'''
-        def songs():
-            for filename in find_music(directories):
-                tags = mutagen.File(filename, easy=True).tags
-                artist = tags.get('artist')
-                title = tags.get('title')
-                if artist and title:
-                    yield artist[0], title[0]
-        execute_in_threadqueue(
-            lambda args: self.get(*args),
-            songs(),
-            num_threads=os.cpu_count() * 3
-        )
+    def written(self, keys):
+        '''Forget pending lyrics that were committed to database'''
+        with self.pending_lock:
+            for key in keys:
+                self.pending.pop(key, None)
 
 
-    def get_scheduled(self):
-        '''Try to retrieve all scheduled songs'''
-        with self.session() as session:
-            query = Query((Schedule.artist, Schedule.title))
-            songs = query.with_session(session)
+    def flush(self):
+        '''Wait until all changes are written to database'''
+        self.writer.flush()
+
+
+    def close(self):
+        '''Write all changes and release database connections'''
+        self.writer.close()
+        self.db.dispose()
+        self.write_db.dispose()
+
+
+    def get_many(self, songs, engine=DEFAULT_ENGINE, strategy=DEFAULT_STRATEGY, check_stored=True):
+        '''
+        Retrieve lyrics for many (artist, title) pairs.
+
+        The `async` engine keeps hundreds of requests in flight on a single
+        thread with pooled keep-alive connections, `threads` engine calls
+        get() from many threads. Songs are looked up in local storage first
+        unless `check_stored` is False, scheduled songs that are not due for
+        another attempt are skipped then too
+        '''
+        if engine == 'threads':
+            get = self.get if check_stored else self.fetch
             execute_in_threadqueue(
-                lambda args: self.get(*args),
+                lambda args: get(*args, strategy=strategy),
                 songs,
                 num_threads=os.cpu_count() * 3
             )
+        elif engine == 'async':
+            if check_stored:
+                songs = (
+                    (artist, title) for artist, title in songs
+                    if self.stored(artist, title) is None and not self.waiting(artist, title)
+                )
+            self.fetch_engine(strategy).run(songs, self.record)
+        else:
+            raise ValueError('Unknown engine: {}'.format(engine))
+        self.writer.put(self.save_health)
+        self.flush()
+
+
+    def fetch_engine(self, strategy=DEFAULT_STRATEGY):
+        '''AsyncFetchEngine that shares statistics with this storage'''
+        from musicbatch.lyrics.engine import AsyncFetchEngine
+        return AsyncFetchEngine(
+            self.fetchers,
+            strategy=strategy,
+            health=self.health,
+            ranking=self.ranking,
+            cache=self.cache,
+        )
+
+
+    def load_health(self):
+        '''Read health statistics of lyrics sources from database'''
+        with self.session() as session:
+            return [
+                SourceStats(**{key: getattr(source, key) for key in SourceStats.__slots__})
+                for source in Query(Source).with_session(session)
+            ]
+
+
+    def save_health(self, session):
+        '''Write modified health statistics of lyrics sources to database'''
+        for stats in self.health.pop_changed():
+            session.merge(Source(**{key: getattr(stats, key) for key in SourceStats.__slots__}))
+        if self.ranking is not None:
+            for stats in self.ranking.pop_changed():
+                session.merge(Hits(**{key: getattr(stats, key) for key in FeatureStats.__slots__}))
+
+
+    def load_hits(self):
+        '''Read lookup outcomes per song feature from database'''
+        with self.session() as session:
+            return [
+                FeatureStats(**{key: getattr(hits, key) for key in FeatureStats.__slots__})
+                for hits in Query(Hits).with_session(session)
+            ]
+
+
+    def sources(self):
+        '''Health statistics for all lyrics sources, configured ones first'''
+        known = [self.health.source(name) for name in self.FETCHERS]
+        others = [stats for name, stats in sorted(self.health.stats.items()) if name not in self.FETCHERS]
+        return known + others
+
+
+    def build_library(self, *directories, engine=DEFAULT_ENGINE, strategy=DEFAULT_STRATEGY,
+                      prefetch=False, incremental=True):
+        '''
+        Build the library of lyrics for all songs in provided directories.
+
+        With `prefetch` the keys of all stored and scheduled songs are loaded
+        with a single query, and only the songs missing from both are
+        fetched (once per library, duplicates are skipped).
+
+        In `incremental` mode tags are read only from directories that have
+        changed since the previous complete scan (see Checkpoint)
+        '''
+        songs = self.scan(directories, incremental)
+        if prefetch:
+            self.get_many(self.unknown(songs), engine=engine, strategy=strategy, check_stored=False)
+        else:
+            self.get_many(songs, engine=engine, strategy=strategy)
+        self.writer.put(lambda session: save_checkpoints(session, songs.checkpoints))
+        self.flush()
+
+
+    def scan(self, directories, incremental=True):
+        '''
+        Return LibraryScan that yields (artist, title) pairs from music
+        files in directories
+        '''
+        checkpoints = {}
+        if incremental:
+            with self.session() as session:
+                query = Query((Checkpoint.directory, Checkpoint.mtime, Checkpoint.digest))
+                for directory, mtime, digest in query.with_session(session):
+                    checkpoints[directory] = mtime, digest
+        return LibraryScan(directories, checkpoints)
+
+
+    def known_keys(self):
+        '''Lookup keys of all stored and scheduled songs'''
+        with self.session() as session:
+            query = Query((Lyrics.artist_key, Lyrics.title_key)).union_all(
+                Query((Schedule.artist_key, Schedule.title_key))
+            )
+            return {join_key(*key) for key in query.with_session(session)}
+
+
+    def unknown(self, songs):
+        '''Filter (artist, title) pairs that are neither stored nor scheduled, skip duplicates'''
+        known = self.known_keys()
+        with self.pending_lock:
+            known.update(join_key(*key) for key in self.pending)
+        for artist, title in songs:
+            key = join_key(normalize(artist), normalize(title))
+            if key in known:
+                self.stats.cached.increment()
+                continue
+            known.add(key)
+            yield artist, title
+
+
+    def get_scheduled(self, engine=DEFAULT_ENGINE, strategy=DEFAULT_STRATEGY, limit=None, budget=None):
+        '''
+        Try to retrieve scheduled songs that are due for another attempt,
+        the longest waiting first. Process at most `limit` songs and do not
+        start new songs when TimeBudget is exhausted
+        '''
+        songs = self.due(limit=limit)
+        if budget is not None:
+            songs = within_budget(songs, budget)
+        self.get_many(songs, engine=engine, strategy=strategy)
+
+
+    def due(self, now=None, limit=None):
+        '''List of (artist, title) pairs that are due for another attempt'''
+        if now is None:
+            now = datetime.utcnow()
+        with self.session() as session:
+            query = Query((Schedule.artist, Schedule.title)) \
+                    .filter(Schedule.next_attempt <= now) \
+                    .order_by(Schedule.next_attempt)
+            if limit is not None:
+                query = query.limit(limit)
+            return [tuple(song) for song in query.with_session(session)]
 
 
     @contextmanager
-    def session(self):
-        '''Context manager for database sessions'''
-        short_session = self.sessionmaker()
+    def session(self, write=False):
+        '''
+        Context manager for database sessions.
+        Lookups use pooled read connections, changes are made by writer thread
+        '''
+        lock = self.connection_lock
+        if lock is not None:
+            lock.acquire()
+        short_session = (self.write_sessionmaker if write else self.sessionmaker)()
         try:
             yield short_session
             short_session.commit()
@@ -180,6 +553,212 @@ class LyricsStorage:
             raise
         finally:
             short_session.close()
+            if lock is not None:
+                lock.release()
+
+
+
+class LibraryScan:
+    '''
+    Iterate over (artist, title) pairs from tags of music files.
+
+    Directories with the same state as in `previous` checkpoints are skipped.
+    States of all visited directories are collected in `checkpoints` to be
+    saved after the songs have been processed
+    '''
+
+    def __init__(self, directories, previous=None):
+        self.directories = directories
+        self.previous = previous or {}
+        self.checkpoints = {}
+        self.skipped = 0  # unchanged directories
+
+
+    def __repr__(self):
+        return '<{cls}({count} directories)>'.format(
+            cls = self.__class__.__name__,
+            count = len(self.directories),
+        )
+
+
+    def __iter__(self):
+        import mutagen
+        for root, filenames in walk_music(self.directories):
+            directory = os.path.abspath(root)
+            try:
+                state = directory_state(directory, filenames)
+            except OSError as e:
+                log.error('Failed to read {}: {}'.format(directory, e))
+                continue
+            if self.previous.get(directory) == state:
+                self.skipped += 1
+                self.checkpoints[directory] = state
+                continue
+            log.debug('Reading tags in {}'.format(directory))
+            for filename in filenames:
+                try:
+                    audio = mutagen.File(os.path.join(directory, filename), easy=True)
+                except Exception as e:
+                    log.error('Failed to read tags from {}: {}'.format(filename, e))
+                    continue
+                tags = audio.tags if audio is not None else None
+                if not tags:
+                    continue
+                artist = tags.get('artist')
+                title = tags.get('title')
+                if artist and title:
+                    yield artist[0], title[0]
+            self.checkpoints[directory] = state
+
+
+
+def directory_state(directory, filenames):
+    '''Modification time of directory and digest of music files metadata'''
+    digest = hashlib.sha1()
+    for filename in filenames:
+        stat = os.stat(os.path.join(directory, filename))
+        digest.update('{}\0{}\0{}\n'.format(filename, stat.st_size, stat.st_mtime_ns).encode('utf-8', 'surrogateescape'))
+    return os.stat(directory).st_mtime, digest.hexdigest()
+
+
+
+def save_checkpoints(session, checkpoints):
+    '''Remember the state of scanned directories'''
+    for directory, (mtime, digest) in checkpoints.items():
+        session.merge(Checkpoint(directory=directory, mtime=mtime, digest=digest))
+
+
+
+def join_key(artist_key, title_key):
+    '''Compact representation of lookup keys for in-memory sets'''
+    return '{}\0{}'.format(artist_key, title_key)
+
+
+
+def sqlite_engine(url, pool_size, immediate=False):
+    '''
+    SQLAlchemy engine for lyrics database file in WAL mode. With `immediate`
+    transactions acquire the write lock when they begin, so that busy timeout
+    applies instead of failing on upgrade from read to write lock
+    '''
+    db = create_engine(
+        url,
+        connect_args={'timeout': BUSY_TIMEOUT, 'check_same_thread': False},
+        pool_size=pool_size,
+        max_overflow=2 * pool_size,
+    )
+
+    @event.listens_for(db, 'connect')
+    def connect(connection, record):
+        if immediate:
+            connection.isolation_level = None  # transactions are managed by 'begin' handler
+        cursor = connection.cursor()
+        for pragma in PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    if immediate:
+        @event.listens_for(db, 'begin')
+        def begin(connection):
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return db
+
+
+
+def store_lyrics(session, artist, title, text, source):
+    '''Save lyrics and remove the song from schedule'''
+    session.merge(Lyrics(artist=artist, title=title, text=text, source=source))
+    schedule = Query(Schedule).filter(
+        (Schedule.artist_key == normalize(artist)),
+        (Schedule.title_key == normalize(title)),
+    )
+    schedule.with_session(session).delete(synchronize_session=False)
+
+
+
+def schedule_song(session, artist, title):
+    '''Schedule the song for the next attempt with exponential backoff'''
+    now = datetime.utcnow()
+    schedule = Query(Schedule).filter(
+        (Schedule.artist_key == normalize(artist)),
+        (Schedule.title_key == normalize(title)),
+    ).with_session(session).first()
+    if not schedule:
+        session.add(Schedule(artist=artist, title=title, attempts=1, next_attempt=now + retry_delay(1)))
+    else:
+        schedule.attempts = (schedule.attempts or 0) + 1
+        schedule.next_attempt = now + retry_delay(schedule.attempts)
+        schedule.timestamp = now
+
+
+
+def retry_delay(attempts):
+    '''Time to wait after the given number of failed attempts'''
+    if attempts > 32:  # avoid huge multipliers, the cap is reached much earlier
+        return MAX_RETRY_DELAY
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+
+def within_budget(songs, budget):
+    '''Stop iteration over songs when time budget is exhausted'''
+    for song in songs:
+        if not budget.allows():
+            log.info('Time budget is exhausted, remaining songs are left for the next run')
+            return
+        yield song
+
+
+
+def schema_version(db):
+    '''Return the version of database schema (0 for new and unversioned databases)'''
+    with db.connect() as connection:
+        return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+
+def upgrade_schema(db):
+    '''
+    Add columns introduced after the first release to databases created by
+    older versions, fill normalized lookup keys for rows that were inserted
+    without them. Database is marked with the current SCHEMA_VERSION
+    '''
+    inspector = inspect(db)
+    for table in (Lyrics.__table__, Schedule.__table__):
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        with db.begin() as connection:
+            for name, definition in NEW_COLUMNS[table.name]:
+                if name not in columns:
+                    log.info('Adding {} column to {} table'.format(name, table.name))
+                    connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(table.name, name, definition)))
+            if table is Schedule.__table__:
+                connection.execute(text(
+                    'UPDATE schedule SET next_attempt = timestamp WHERE next_attempt IS NULL'
+                ))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+        select = text(
+            'SELECT rowid, artist, title FROM {} WHERE artist_key IS NULL LIMIT {}'
+            .format(table.name, MIGRATION_BATCH)
+        )
+        update = text(
+            'UPDATE {} SET artist_key = :artist, title_key = :title WHERE rowid = :rowid'
+            .format(table.name)
+        )
+        while True:
+            with db.begin() as connection:
+                rows = connection.execute(select).fetchall()
+                if not rows:
+                    break
+                log.info('Filling lookup keys for {} rows in {} table'.format(len(rows), table.name))
+                connection.execute(update, [
+                    dict(rowid=rowid, artist=normalize(artist), title=normalize(title))
+                    for rowid, artist, title in rows
+                ])
+    with db.begin() as connection:
+        connection.execute(text('PRAGMA user_version = {}'.format(SCHEMA_VERSION)))
 
 
 
@@ -195,14 +774,16 @@ class StorageStats:
         self.cached = ThreadSafeCounter()
         self.fetched = ThreadSafeCounter()
         self.missing = ThreadSafeCounter()
+        self.waiting = ThreadSafeCounter()
 
 
     def __str__(self):
-        template = '{new} lyrics fetched, {missing} not found, {cached} from cache'
+        template = '{new} lyrics fetched, {missing} not found, {cached} from cache, {waiting} waiting for retry'
         return template.format(
             new = self.fetched,
             missing = self.missing,
             cached = self.cached,
+            waiting = self.waiting,
         )
 
 
@@ -0,0 +1,351 @@
+'''
+Asynchronous engine for lyrics fetchers
+
+Fetchers describe their work as generators that yield Request objects and
+receive responses (or parsed HTML documents) in return. The same generator
+can be driven by blocking requests (see BaseLyricsFetcher.__call__) or by
+AsyncFetchEngine which keeps hundreds of requests in flight on a single
+thread.
+'''
+
+
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from musicbatch.lyrics.client import HTTPClient, HTTPError
+from musicbatch.lyrics.health import Attempt
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+MAX_IN_FLIGHT = 256  # songs processed concurrently
+HEDGE_DELAY = 2  # seconds before the next fetcher is started by hedged strategy
+STRATEGIES = ('sequential', 'hedged', 'concurrent')
+
+
+
+class FetchError(Exception):
+    '''Request made by asynchronous engine has failed'''
+
+
+
+class Request:
+    '''HTTP request yielded by fetcher'''
+
+    __slots__ = ('url', 'params', 'html', 'encoding')
+
+
+    def __init__(self, url, params=None, html=False, encoding=None):
+        self.url = url
+        self.params = params
+        self.html = html  # fetcher expects parsed HTML document instead of response
+        self.encoding = encoding  # override the encoding detected from response
+
+
+    def __repr__(self):
+        return '<{cls}({url!r})>'.format(
+            cls = self.__class__.__name__,
+            url = self.url,
+        )
+
+
+
+def drive(steps, perform, errors=()):
+    '''
+    Execute the requests yielded by steps generator with blocking `perform`
+    callable and return the final value of the generator.
+    Exceptions listed in `errors` are thrown into the generator
+    '''
+    try:
+        request = next(steps)
+        while True:
+            try:
+                result = perform(request)
+            except errors as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+
+def parse_html(response, encoding=None):
+    '''Parse HTML document from response, make all links absolute (or raise FetchError)'''
+    from lxml import etree, html
+    if encoding:
+        response.encoding = encoding
+    try:
+        document = html.document_fromstring(response.text)
+    except (etree.LxmlError, ValueError) as e:
+        raise FetchError('Invalid HTML from {}: {}'.format(response.url, e)) from e
+    document.make_links_absolute(response.url)
+    return document
+
+
+
+class RateLimiter:
+    '''Allow at most `calls` acquisitions per `period` seconds'''
+
+    def __init__(self, calls, period, clock=time.monotonic):
+        self.calls = calls
+        self.period = period
+        self.clock = clock
+        self.history = deque()
+
+
+    def __repr__(self):
+        return '<{cls}({calls} per {period}s)>'.format(
+            cls = self.__class__.__name__,
+            calls = self.calls,
+            period = self.period,
+        )
+
+
+    def delay(self):
+        '''Seconds to wait before the next call is allowed (and reserve it if zero)'''
+        now = self.clock()
+        while self.history and now - self.history[0] >= self.period:
+            self.history.popleft()
+        if len(self.history) < self.calls:
+            self.history.append(now)
+            return 0
+        return self.period - (now - self.history[0])
+
+
+    async def acquire(self):
+        while True:
+            delay = self.delay()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+
+
+class AsyncFetchEngine:
+    '''
+    Run lyrics fetchers on asyncio event loop.
+
+    Requests share keep-alive connection pools per host. Rate limits of each
+    fetcher (RATELIMIT_CALLS per RATELIMIT_PERIOD seconds) are honored across
+    all songs in flight. If HealthMonitor is provided, disabled sources are
+    skipped and the outcome of each lookup is recorded. If FetcherRanking is
+    provided, fetchers are tried in the order of estimated hit rate for each
+    song instead of the order of priority. If HTTPCache is provided, cached
+    responses are used instead of sending requests (and are not rate limited).
+
+    Fetchers for a single song are tried according to `strategy`:
+        sequential  next fetcher starts after the previous one has failed
+        hedged      next fetcher also starts if the previous ones have not
+                    finished within `hedge_delay` seconds
+        concurrent  all fetchers start at once
+    '''
+
+    def __init__(self, fetchers, client=None, max_in_flight=MAX_IN_FLIGHT,
+                 strategy='sequential', hedge_delay=HEDGE_DELAY, health=None,
+                 ranking=None, cache=None):
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown strategy: {}'.format(strategy))
+        self.fetchers = tuple(fetchers)
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.strategy = strategy
+        self.hedge_delay = 0 if strategy == 'concurrent' else hedge_delay
+        self.health = health
+        self.ranking = ranking
+        self.cache = cache
+        self.limiters = {}
+
+
+    def __repr__(self):
+        return '<{cls}({count} fetchers)>'.format(
+            cls = self.__class__.__name__,
+            count = len(self.fetchers),
+        )
+
+
+    def limiter(self, fetcher):
+        '''Rate limiter for the fetcher (None if fetcher is not limited)'''
+        key = id(fetcher)
+        if key not in self.limiters:
+            calls = getattr(fetcher, 'RATELIMIT_CALLS', None)
+            period = getattr(fetcher, 'RATELIMIT_PERIOD', None)
+            if calls and period is None:
+                raise ValueError('{} defines RATELIMIT_CALLS without RATELIMIT_PERIOD'.format(fetcher))
+            self.limiters[key] = RateLimiter(calls, period) if calls else None
+        return self.limiters[key]
+
+
+    async def perform(self, fetcher, request):
+        '''Execute a single request on behalf of the fetcher'''
+        async def download(url, params=None):
+            limiter = self.limiter(fetcher)
+            if limiter is not None:
+                await limiter.acquire()
+            return await self.client.get(url, params)
+        try:
+            if self.cache is None:
+                response = await download(request.url, request.params)
+            else:
+                response = await self.cache.get_async(request.url, request.params, download)
+        except HTTPError as e:
+            raise FetchError(str(e)) from e
+        if request.html:
+            return parse_html(response, request.encoding)
+        return response
+
+
+    async def fetch(self, fetcher, artist, title):
+        '''Execute a single fetcher for the song'''
+        health = self.health
+        if health is not None and not health.available(fetcher):
+            return fetcher.NOT_FOUND
+        attempt = Attempt(fetcher)
+        steps = fetcher.search(artist, title)
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    result = await self.perform(fetcher, request)
+                except FetchError as e:
+                    attempt.failed(e)
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(result)
+        except StopIteration as stop:
+            text = stop.value
+        except asyncio.CancelledError:
+            steps.close()
+            raise
+        except Exception as e:
+            log.error('{} failed for {} - {}: {}'.format(fetcher, artist, title, e))
+            attempt.failed(e)
+            text = fetcher.NOT_FOUND
+        if health is not None:
+            health.record(attempt, text is not fetcher.NOT_FOUND)
+        if self.ranking is not None:
+            self.ranking.record(artist, title, fetcher, text is not fetcher.NOT_FOUND)
+        return text
+
+
+    async def lookup(self, artist, title):
+        '''
+        Find lyrics with the configured strategy.
+        Return a tuple of (lyrics, fetcher) or (None, None) if nothing was found
+        '''
+        fetchers = self.fetchers
+        if self.ranking is not None:
+            fetchers = self.ranking.order(fetchers, artist, title)
+        if self.strategy == 'sequential':
+            return await self.sequential(fetchers, artist, title)
+        return await self.hedged(fetchers, artist, title)
+
+
+    async def sequential(self, fetchers, artist, title):
+        '''Try fetchers one by one in order of priority'''
+        for fetcher in fetchers:
+            text = await self.fetch(fetcher, artist, title)
+            if text is not fetcher.NOT_FOUND:
+                return text, fetcher
+        return None, None
+
+
+    async def hedged(self, fetchers, artist, title):
+        '''
+        Start fetchers in order of priority, each next one after `hedge_delay`
+        seconds or as soon as all running fetchers have failed. The first
+        lyrics found win (fetchers validate results with check()), the
+        remaining fetchers are cancelled. Results that arrive together are
+        resolved in order of priority
+        '''
+        queue = iter(enumerate(fetchers))
+        running = {}
+
+        def launch():
+            for priority, fetcher in queue:
+                task = asyncio.ensure_future(self.fetch(fetcher, artist, title))
+                running[task] = priority, fetcher
+                return True
+            return False
+
+        more = launch()
+        while more and not self.hedge_delay:
+            more = launch()
+        try:
+            while running:
+                done, _ = await asyncio.wait(
+                    running,
+                    timeout=self.hedge_delay if more else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                found = []
+                for task in done:
+                    priority, fetcher = running.pop(task)
+                    text = task.result()
+                    if text is not fetcher.NOT_FOUND:
+                        found.append((priority, text, fetcher))
+                if found:
+                    priority, text, fetcher = min(found, key=lambda result: result[0])
+                    return text, fetcher
+                if more and (not done or not running):
+                    more = launch()
+            return None, None
+        finally:
+            for task in running:
+                task.cancel()
+
+
+    async def process(self, songs, callback):
+        '''
+        Look up lyrics for all (artist, title) pairs and pass the results to
+        callback(artist, title, lyrics, fetcher). Songs are consumed lazily
+        on a separate thread: producing them may involve blocking I/O (reading
+        music tags, database queries) that would stall requests in flight
+        '''
+        own_client = self.client is None
+        if own_client:
+            self.client = HTTPClient()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        loop = asyncio.get_running_loop()
+        songs = iter(songs)
+        reader = ThreadPoolExecutor(max_workers=1)
+
+        async def one(artist, title):
+            try:
+                text, fetcher = await self.lookup(artist, title)
+                callback(artist, title, text, fetcher)
+            except Exception as e:
+                log.error('Failed to process {} - {}: {}'.format(artist, title, e))
+            finally:
+                slots.release()
+
+        try:
+            while True:
+                song = await loop.run_in_executor(reader, next, songs, None)
+                if song is None:
+                    break
+                artist, title = song
+                await slots.acquire()
+                task = asyncio.ensure_future(one(artist, title))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            reader.shutdown()
+            if own_client:
+                self.client.close()
+                self.client = None
+
+
+    def run(self, songs, callback):
+        '''Blocking wrapper for process()'''
+        asyncio.run(self.process(songs, callback))
@@ -9,22 +9,37 @@ from lxml.html import HtmlComment, iterlinks
 
 from scrapehelper.fetch import BaseDataFetcher, DataFetcherError
 from musicbatch.lyrics.cyrillic import transliterate
+from musicbatch.lyrics.client import HTTPError, Response
+from musicbatch.lyrics.engine import FetchError, Request, drive, parse_html
+from musicbatch.lyrics.keys import THE_END, THE_START
+
+
+FETCH_ERRORS = (DataFetcherError, FetchError)
 
 
 
 class BaseLyricsFetcher(BaseDataFetcher):
-    '''Base class for all lyrics fetchers'''
+    '''
+    Base class for all lyrics fetchers.
+
+    Child classes implement search(artist, title) generator that yields
+    Request objects and receives the responses (or parsed HTML documents).
+    Failed requests raise one of FETCH_ERRORS inside the generator. Calling
+    the fetcher executes the requests with blocking I/O, AsyncFetchEngine
+    executes them concurrently
+    '''
 
     HOME = NotImplemented  # Home URL for the lyrics source
     NOT_FOUND = None
+    RATELIMIT_PERIOD = 60  # seconds, window for RATELIMIT_CALLS (blocking and async requests)
     regex = {
         'empty_line': re.compile(r'^\s+$', re.MULTILINE),
         'except-alphanum': re.compile(r'[^\w\d]'),
         'except-alphanum-space-hyphen': re.compile(r'[^\w\d\s-]'),
         'except-whitespace-hyphen': re.compile(r'[\s-]+'),
         'many_linebreaks': re.compile(r'\n\n+'),
-        'the_end': re.compile(r'(.*)(?:,\s*|[^,]\s+)the\s*$', re.IGNORECASE),
-        'the_start': re.compile(r'^\s*the\s+(.*)', re.IGNORECASE),
+        'the_end': THE_END,
+        'the_start': THE_START,
         'whitespace': re.compile(r'\s+', re.DOTALL),
     }
 
@@ -36,6 +51,59 @@ class BaseLyricsFetcher(BaseDataFetcher):
         )
 
 
+    def __call__(self, artist, title, attempt=None, cache=None):
+        '''
+        Fetch lyrics for a single song (register failed requests with attempt,
+        read and write HTTP responses to cache)
+        '''
+        perform = self.perform
+        if cache is not None:
+            perform = lambda request: self.perform_cached(request, cache)
+        if attempt is not None:
+            perform = attempt.track(perform)
+        return drive(self.search(artist, title), perform, FETCH_ERRORS)
+
+
+    def search(self, artist, title):
+        '''Generator of requests that returns the lyrics (or NOT_FOUND)'''
+        raise NotImplementedError
+
+
+    def perform(self, request):
+        '''Execute a single request with blocking I/O'''
+        options = {}
+        if request.params is not None:
+            options['params'] = request.params
+        if not request.html:
+            return self.get(request.url, **options)
+        if request.encoding is not None:
+            options['force_encoding'] = request.encoding
+        return self.parse_html(request.url, **options)
+
+
+    def perform_cached(self, request, cache):
+        '''Execute a single request through HTTPCache'''
+        try:
+            response = cache.get(request.url, request.params, self.download)
+        except HTTPError as e:
+            raise FetchError(str(e)) from e
+        if request.html:
+            return parse_html(response, request.encoding)
+        return response
+
+
+    def download(self, url):
+        '''Blocking GET request that returns client.Response'''
+        response = self.get(url)
+        return Response(
+            response.url,
+            response.status_code,
+            response.reason,
+            {key.lower(): value for key, value in response.headers.items()},
+            response.content,
+        )
+
+
     @classmethod
     def check(cls, lyrics):
         '''Validate lyrics'''
@@ -85,16 +153,16 @@ class LyricsWikiFetcher(BaseLyricsFetcher):
     marker = re.compile(r'^.*<lyrics>(.*)</lyrics>.*$', re.DOTALL|re.IGNORECASE)
     noise = re.compile(r"''+", re.DOTALL)
 
-    def __call__(self, artist, title):
+    def search(self, artist, title):
         try:
-            api_response = self.get(self.api, params=dict(
+            api_response = yield Request(self.api, params=dict(
                 action = 'lyrics',
                 func = 'getSong',
                 fmt = 'xml',  # JSON output is malformed! Single quotes all over the place
                 artist = self.fix_the(artist),
                 song = title,
             ))
-        except DataFetcherError:
+        except FETCH_ERRORS:
             return self.NOT_FOUND
 
         overview = etree.fromstring(api_response.content)
@@ -104,8 +172,8 @@ class LyricsWikiFetcher(BaseLyricsFetcher):
 
         full_page_url = overview.xpath('url//text()')[0]
         try:
-            html = self.parse_html(full_page_url, params=dict(action='edit'))
-        except DataFetcherError:
+            html = yield Request(full_page_url, params=dict(action='edit'), html=True)
+        except FETCH_ERRORS:
             return self.NOT_FOUND
         wiki_text = html.xpath('//*[@id="wpTextbox1"]//text()')[0]
         lyrics = self.marker.sub(r'\1', wiki_text)
@@ -122,15 +190,15 @@ class MusixMatchFetcher(BaseLyricsFetcher):
     url_pattern = 'https://www.musixmatch.com/lyrics/{artist}/{title}'
     prepare = re.compile(r'[^\w\d]+', re.IGNORECASE)
 
-    def __call__(self, artist, title):
+    def search(self, artist, title):
         artist = self.fix_the(artist)
         artist, title = map(
             lambda x: self.prepare.sub('-', x),
             (artist, title)
         )
         try:
-            html = self.parse_html(self.url_pattern.format(artist=artist, title=title))
-        except DataFetcherError:
+            html = yield Request(self.url_pattern.format(artist=artist, title=title), html=True)
+        except FETCH_ERRORS:
             return self.NOT_FOUND
         paragraphs = html.xpath('//span[@class="lyrics__content__ok"]//text()') \
                   or html.xpath('//span[@class="lyrics__content__warning"]//text()')
@@ -153,18 +221,20 @@ class MetroLyricsFetcher(BaseLyricsFetcher):
         return caption
 
 
-    def __call__(self, artist, title):
+    def search(self, artist, title):
         artist = self.fix_the(artist)
         artist, title = map(
             self.clean_caption,
             (artist, title)
         )
         try:
-            response = self.get(self.url_pattern.format(artist=artist, title=title))
-        except DataFetcherError:
+            html = yield Request(
+                self.url_pattern.format(artist=artist, title=title),
+                html=True,
+                encoding='utf-8',  # incorrectly detected otherwise
+            )
+        except FETCH_ERRORS:
             return self.NOT_FOUND
-        response.encoding = 'utf-8'  # incorrectly detected otherwise
-        html = self.parse_html(response=response)
         paragraphs = html.xpath('//p[@class="verse"]')
         lyrics = '\n\n'.join(p.text_content().strip() for p in paragraphs)
         return self.check(lyrics)
@@ -187,7 +257,7 @@ class LyricsModeFetcher(BaseLyricsFetcher):
         return caption
 
 
-    def __call__(self, artist, title):
+    def search(self, artist, title):
         artist = self.fix_the(artist, position=None)
         artist, title = map(
             self.clean_caption,
@@ -201,12 +271,12 @@ class LyricsModeFetcher(BaseLyricsFetcher):
         except IndexError:
             char = ''
         try:
-            html = self.parse_html(self.url_pattern.format(
+            html = yield Request(self.url_pattern.format(
                 artist=artist,
                 title=title,
                 char=char,
-            ))
-        except DataFetcherError:
+            ), html=True)
+        except FETCH_ERRORS:
             return self.NOT_FOUND
         paragraphs = html.xpath('//div[@id="lyrics_text"]')
         if not paragraphs:
@@ -250,7 +320,7 @@ class LyricsWorldRuFetcher(BaseLyricsFetcher):
         return bool(self.cyrillic.match(''.join(texts)))
 
 
-    def __call__(self, artist, title):
+    def search(self, artist, title):
         if not self.is_cyrillic(artist, title):
             return self.NOT_FOUND  # This fetcher is slow. Don't use it for non-cyrillic titles
         artist = self.fix_the(artist, position=None)
@@ -260,12 +330,12 @@ class LyricsWorldRuFetcher(BaseLyricsFetcher):
         page_number = 1
         while True:
             try:
-                artist_page = self.parse_html(self.artist_url.format(
+                artist_page = yield Request(self.artist_url.format(
                     artist=artist,
                     num=page_number,
-                ), force_encoding='utf-8')
+                ), html=True, encoding='utf-8')
                 page_number += 1
-            except DataFetcherError:
+            except FETCH_ERRORS:
                 return self.NOT_FOUND
             tracks = artist_page.xpath('//table[@class="tracklist"]//a')
             song_url = None
@@ -276,8 +346,8 @@ class LyricsWorldRuFetcher(BaseLyricsFetcher):
             if not song_url:
                 continue  # try next page
             try:
-                song_page = self.parse_html(song_url, force_encoding='utf-8')
-            except DataFetcherError:
+                song_page = yield Request(song_url, html=True, encoding='utf-8')
+            except FETCH_ERRORS:
                 return self.NOT_FOUND
             lyrics = song_page.xpath('//p[@id="songLyricsDiv"]')
             if lyrics:
@@ -298,15 +368,15 @@ class AzLyricsFetcher(BaseLyricsFetcher):
         return caption
 
 
-    def __call__(self, artist, title):
+    def search(self, artist, title):
         artist = self.fix_the(artist, position=None)
         artist, title = map(
             self.clean_caption,
             (artist, title)
         )
         try:
-            html = self.parse_html(self.url_pattern.format(artist=artist, title=title))
-        except DataFetcherError:
+            html = yield Request(self.url_pattern.format(artist=artist, title=title), html=True)
+        except FETCH_ERRORS:
             return self.NOT_FOUND
         comments = (e for e in html.iter() if isinstance(e, HtmlComment))
         for comment in comments:
@@ -329,18 +399,19 @@ class SongTexteFetcher(BaseLyricsFetcher):
     simplify = LyricsWorldRuFetcher.clean_title
     bad = "Leider kein Songtext vorhanden".lower()
 
-    def __call__(self, artist, title):
+    def search(self, artist, title):
         artist = self.fix_the(artist)
         artist_simplified, title_simplified = map(self.simplify, (artist, title))
         try:
-            search_page = self.parse_html(
+            search_page = yield Request(
                 self.search_url,
                 params={
                     'c': 'songs',
                     'q': ' '.join((artist, title)),
-                }
+                },
+                html=True,
             )
-        except DataFetcherError:
+        except FETCH_ERRORS:
             return self.NOT_FOUND
         songs = search_page.xpath('//div[@class="songResultTable"]//div')
         for song in songs:
@@ -357,8 +428,8 @@ class SongTexteFetcher(BaseLyricsFetcher):
         else:
             return self.NOT_FOUND
         try:
-            song_page = self.parse_html(link)
-        except DataFetcherError:
+            song_page = yield Request(link, html=True)
+        except FETCH_ERRORS:
             return self.NOT_FOUND
         lyrics = song_page.xpath('(.//div[@id="lyrics"])[1]')
         if not lyrics:
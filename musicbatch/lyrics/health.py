@@ -0,0 +1,209 @@
+'''
+Health of lyrics sources and circuit breaker for failing fetchers
+'''
+
+
+import asyncio
+import socket
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+FAILURE_THRESHOLD = 5  # consecutive failed lookups that disable the source
+PROBE_INTERVAL = timedelta(hours=1)  # time before disabled source is probed again
+SOURCE_ERRORS = (  # exceptions (or their causes) that count against the source
+    ConnectionError,
+    TimeoutError,
+    asyncio.TimeoutError,
+    socket.timeout,
+    socket.gaierror,
+)
+
+
+
+def source_name(fetcher):
+    '''Key for health statistics of the fetcher'''
+    return fetcher.__class__.__name__
+
+
+
+def is_source_error(error):
+    '''
+    Check whether the exception raised by request indicates a problem with
+    lyrics source (unreachable host, timeout, server error, throttling).
+    Other exceptions (e.g. "not found" errors without HTTP status, parser
+    errors on unexpected pages) are treated as a missing song
+    '''
+    while error is not None:
+        if isinstance(error, SOURCE_ERRORS):
+            return True
+        response = getattr(error, 'response', None)
+        status = getattr(response, 'status_code', None)
+        if status is not None:
+            return status >= 500 or status == 429
+        error = error.__cause__ or error.__context__
+    return False
+
+
+
+class SourceStats:
+    '''Statistics of a single lyrics source'''
+
+    __slots__ = ('name', 'lookups', 'found', 'errors', 'failures', 'latency', 'retry_at')
+
+
+    def __init__(self, name, lookups=0, found=0, errors=0, failures=0, latency=0.0, retry_at=None):
+        self.name = name
+        self.lookups = lookups
+        self.found = found
+        self.errors = errors  # lookups that have encountered source errors
+        self.failures = failures  # consecutive lookups with errors
+        self.latency = latency  # total seconds spent in lookups
+        self.retry_at = retry_at  # circuit is open until this time (UTC)
+
+
+    def __repr__(self):
+        return '<{cls}({name}, {found}/{lookups} found, {failures} failures)>'.format(
+            cls = self.__class__.__name__,
+            name = self.name,
+            found = self.found,
+            lookups = self.lookups,
+            failures = self.failures,
+        )
+
+
+    def copy(self):
+        return self.__class__(**{key: getattr(self, key) for key in self.__slots__})
+
+
+    @property
+    def success_rate(self):
+        return self.found / self.lookups if self.lookups else None
+
+
+    @property
+    def mean_latency(self):
+        return self.latency / self.lookups if self.lookups else None
+
+
+    @property
+    def disabled(self):
+        return self.retry_at is not None
+
+
+
+class Attempt:
+    '''Single lookup performed by a fetcher'''
+
+    __slots__ = ('fetcher', 'started', 'errors')
+
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.started = time.monotonic()
+        self.errors = 0
+
+
+    def failed(self, error):
+        '''Register an exception raised by request'''
+        if is_source_error(error):
+            self.errors += 1
+
+
+    def track(self, perform):
+        '''Wrap blocking `perform` callable to register failed requests'''
+        def tracked(request):
+            try:
+                return perform(request)
+            except Exception as e:
+                self.failed(e)
+                raise
+        return tracked
+
+
+
+class HealthMonitor:
+    '''
+    Track the health of lyrics sources.
+
+    After FAILURE_THRESHOLD consecutive lookups with errors the circuit opens
+    and the source is skipped. Once PROBE_INTERVAL has passed a single lookup
+    is allowed through as a probe: success closes the circuit, another error
+    keeps it open for one more interval
+    '''
+
+    def __init__(self, stats=(), threshold=FAILURE_THRESHOLD, interval=PROBE_INTERVAL,
+                 clock=datetime.utcnow):
+        self.stats = {source.name: source for source in stats}
+        self.threshold = threshold
+        self.interval = interval
+        self.clock = clock
+        self.lock = Lock()
+        self.changed = set()  # names of sources modified since the last save
+
+
+    def __repr__(self):
+        return '<{cls}({count} sources)>'.format(
+            cls = self.__class__.__name__,
+            count = len(self.stats),
+        )
+
+
+    def source(self, name):
+        if name not in self.stats:
+            self.stats[name] = SourceStats(name)
+        return self.stats[name]
+
+
+    def available(self, fetcher):
+        '''Check if the fetcher may be used now (reserve the probe if circuit is open)'''
+        with self.lock:
+            source = self.source(source_name(fetcher))
+            if source.retry_at is None:
+                return True
+            now = self.clock()
+            if now < source.retry_at:
+                return False
+            log.debug('Probing disabled lyrics source: {}'.format(source.name))
+            source.retry_at = now + self.interval  # other lookups wait for the probe
+            self.changed.add(source.name)
+            return True
+
+
+    def record(self, attempt, found):
+        '''Update statistics with the outcome of a finished attempt'''
+        elapsed = time.monotonic() - attempt.started
+        with self.lock:
+            source = self.source(source_name(attempt.fetcher))
+            source.lookups += 1
+            source.latency += elapsed
+            if found:
+                source.found += 1
+            if attempt.errors:
+                source.errors += 1
+                source.failures += 1
+                if source.failures >= self.threshold:
+                    if source.retry_at is None:
+                        log.warning('Disabling lyrics source after {} failures: {}'.format(
+                            source.failures,
+                            source.name,
+                        ))
+                    source.retry_at = self.clock() + self.interval
+            else:
+                source.failures = 0
+                source.retry_at = None
+            self.changed.add(source.name)
+
+
+    def pop_changed(self):
+        '''Return copies of statistics modified since the previous call'''
+        with self.lock:
+            changed = [self.stats[name].copy() for name in self.changed]
+            self.changed = set()
+            return changed
@@ -0,0 +1,30 @@
+'''
+Normalized lookup keys for artists and song titles
+'''
+
+
+import re
+
+
+THE_START = re.compile(r'^\s*the\s+(.*)', re.IGNORECASE)
+THE_END = re.compile(r'(.*?)(?:,\s*|\s+)the\s*$', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+
+
+
+def strip_the(caption):
+    '''Remove "The" from the start or from the end of caption'''
+    for regex in (THE_START, THE_END):
+        if regex.match(caption):
+            return regex.sub(r'\1', caption)
+    return caption
+
+
+
+def normalize(caption):
+    '''
+    Lookup key for artist or title: case folded, with collapsed whitespace
+    and without "The" (so that "The Beatles" matches "beatles, the")
+    '''
+    caption = WHITESPACE.sub(' ', caption).strip()
+    return strip_the(caption).strip().casefold()
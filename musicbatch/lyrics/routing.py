@@ -0,0 +1,156 @@
+'''
+Adaptive order of lyrics fetchers
+
+Each source works well for some songs (German lyrics on songtexte.com,
+Russian on lyricsworld.ru) and almost never for others. Outcomes of lookups
+are counted per song feature, and fetchers are tried in order of estimated
+hit rate for the song at hand
+'''
+
+
+import unicodedata
+from threading import Lock
+
+from musicbatch.lyrics.health import source_name
+from musicbatch.lyrics.keys import normalize
+
+
+PRIOR_WEIGHT = 5  # lookups needed for specific statistics to outweigh general ones
+ANY = '*'  # feature shared by all songs
+
+
+
+def detect_script(text):
+    '''
+    Return the name of the writing system prevalent in text (lowercase
+    Unicode script name, e.g. 'latin', 'cyrillic', 'cjk'). Latin texts with
+    diacritics (German, French, Scandinavian) are reported as 'latin-ext'
+    '''
+    counts = {}
+    extended = False
+    for char in text:
+        if not char.isalpha():
+            continue
+        try:
+            script = unicodedata.name(char).split(' ', 1)[0].lower()
+        except ValueError:
+            continue
+        if script == 'latin' and ord(char) > 0x7f:
+            extended = True
+        counts[script] = counts.get(script, 0) + 1
+    if not counts:
+        return None
+    script = max(sorted(counts), key=counts.get)
+    if script == 'latin' and extended:
+        script = 'latin-ext'
+    return script
+
+
+
+def song_features(artist, title):
+    '''Features of the song from general to specific'''
+    features = [ANY]
+    script = detect_script(artist + title)
+    if script:
+        features.append('script:{}'.format(script))
+    artist = normalize(artist)
+    if artist:
+        features.append('artist:{}'.format(artist))
+    return features
+
+
+
+class FeatureStats:
+    '''Lookup outcomes of a single source for songs with the same feature'''
+
+    __slots__ = ('feature', 'source', 'lookups', 'found')
+
+
+    def __init__(self, feature, source, lookups=0, found=0):
+        self.feature = feature
+        self.source = source
+        self.lookups = lookups
+        self.found = found
+
+
+    def __repr__(self):
+        return '<{cls}({source} for {feature}: {found}/{lookups})>'.format(
+            cls = self.__class__.__name__,
+            source = self.source,
+            feature = self.feature,
+            found = self.found,
+            lookups = self.lookups,
+        )
+
+
+    def copy(self):
+        return self.__class__(**{key: getattr(self, key) for key in self.__slots__})
+
+
+
+class FetcherRanking:
+    '''
+    Order fetchers by estimated probability of finding lyrics for a song.
+
+    The estimate for each source starts with its overall hit rate, which is
+    then refined with statistics for the script of the song and for the
+    artist. Sparse statistics are smoothed towards the more general estimate
+    (PRIOR_WEIGHT), so the configured priority decides until there is enough
+    evidence
+    '''
+
+    def __init__(self, stats=(), prior=PRIOR_WEIGHT):
+        self.stats = {(item.feature, item.source): item for item in stats}
+        self.prior = prior
+        self.lock = Lock()
+        self.changed = set()  # keys of statistics modified since the last save
+
+
+    def __repr__(self):
+        return '<{cls}({count} records)>'.format(
+            cls = self.__class__.__name__,
+            count = len(self.stats),
+        )
+
+
+    def score(self, fetcher, features):
+        '''Estimated hit rate of the fetcher for a song with given features'''
+        source = source_name(fetcher)
+        estimate = 0.5
+        for feature in features:
+            item = self.stats.get((feature, source))
+            if item is not None:
+                estimate = (item.found + self.prior * estimate) / (item.lookups + self.prior)
+        return estimate
+
+
+    def order(self, fetchers, artist, title):
+        '''Sort fetchers for the song, ties are resolved by the original order'''
+        features = song_features(artist, title)
+        with self.lock:
+            scores = [self.score(fetcher, features) for fetcher in fetchers]
+        ranked = sorted(range(len(fetchers)), key=lambda index: -scores[index])
+        return tuple(fetchers[index] for index in ranked)
+
+
+    def record(self, artist, title, fetcher, found):
+        '''Count the outcome of a lookup'''
+        source = source_name(fetcher)
+        with self.lock:
+            for feature in song_features(artist, title):
+                key = feature, source
+                item = self.stats.get(key)
+                if item is None:
+                    item = self.stats[key] = FeatureStats(feature, source)
+                item.lookups += 1
+                if found:
+                    item.found += 1
+                self.changed.add(key)
+
+
+    def pop_changed(self):
+        '''Return copies of statistics modified since the previous call'''
+        with self.lock:
+            changed = [self.stats[key].copy() for key in self.changed]
+            self.changed = set()
+            return changed
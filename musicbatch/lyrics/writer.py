@@ -0,0 +1,129 @@
+'''
+Single writer thread for lyrics database
+'''
+
+
+import time
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+WRITE_BATCH = 100  # operations per transaction
+WRITE_INTERVAL = 0.5  # seconds before incomplete batch is committed
+WRITE_RETRIES = 5  # attempts to commit a batch before applying operations one by one
+
+
+
+class BatchWriter:
+    '''
+    Apply database writes from a single thread.
+
+    Operations are callables that accept a database session. They are
+    committed in batches of `batch_size` or after `interval` seconds,
+    whichever comes first, so that many threads (and processes sharing the
+    database file) do not compete for the write lock with tiny transactions.
+
+    `session` is the context manager factory that opens a transaction and
+    commits it on exit. `before_commit(session)` is called once per batch,
+    `committed(keys)` receives the keys of operations that were written
+    '''
+
+    def __init__(self, session, batch_size=WRITE_BATCH, interval=WRITE_INTERVAL,
+                 before_commit=None, committed=None):
+        self.session = session
+        self.batch_size = batch_size
+        self.interval = interval
+        self.before_commit = before_commit
+        self.committed = committed
+        self.queue = Queue()
+        self.lock = Lock()
+        self.thread = None
+
+
+    def __repr__(self):
+        return '<{cls}(batch={batch_size}, interval={interval}s)>'.format(
+            cls = self.__class__.__name__,
+            batch_size = self.batch_size,
+            interval = self.interval,
+        )
+
+
+    def put(self, operation, key=None):
+        '''Schedule the operation to be written'''
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self._write_forever, daemon=True)
+                self.thread.start()
+        self.queue.put((operation, key))
+
+
+    def flush(self):
+        '''Wait until all scheduled operations are committed'''
+        if self.thread is not None:
+            self.queue.join()
+
+
+    def close(self):
+        '''Commit remaining operations and stop the writer thread'''
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+
+    def _write_forever(self):
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self.write(batch)
+            finally:
+                for _ in range(len(batch) + stop):
+                    self.queue.task_done()
+
+
+    def write(self, batch):
+        '''Commit a batch of operations'''
+        for attempt in range(WRITE_RETRIES):
+            try:
+                with self.session() as session:
+                    if self.before_commit is not None:
+                        self.before_commit(session)
+                    for operation, key in batch:
+                        operation(session)
+                break
+            except Exception as e:
+                log.warning('Failed to commit {} writes (attempt {}): {}'.format(len(batch), attempt + 1, e))
+                time.sleep(min(0.1 * 2 ** attempt, 2))
+        else:
+            written = []
+            for operation, key in batch:
+                try:
+                    with self.session() as session:
+                        operation(session)
+                    written.append((operation, key))
+                except Exception as e:
+                    log.error('Failed to write to lyrics database: {}'.format(e))
+            batch = written
+        if self.committed is not None:
+            self.committed([key for operation, key in batch if key is not None])
@@ -6,13 +6,13 @@ import os
 from argparse import ArgumentParser
 
 from musicbatch.metadata import METADATA_YAML
-from musicbatch.metadata.objects import generate, MusicAlbumInfo
 
 
 
 def run(*a, **ka):
     '''CLI entry point for metadata manager'''
     args = parse_args(*a, **ka)
+    from musicbatch.metadata.objects import generate, MusicAlbumInfo  # heavy import, skip it for --help
     if args.recursive:
         directories = find_subdirs(args.directory)
     else:
@@ -14,7 +14,19 @@ DEFAULT_CONFIG = {
     'format': 'vorbis',
     'quality': None,
     'lossy_source': 'copy',
+    'staging': None,
+    'max_size': None,
+    'priority': [],
     'cover': 250,
     'lyrics': None,
+    'replaygain': False,
+    'threads': None,
+    'reads_per_device': None,
+    'album_batch': None,
+    'retries': 2,
+    'retry_delay': 5,
+    'prefetch': None,
+    'prefetch_budget': '256M',
+    'prefetch_method': 'fadvise',
 }
 CONFIG_ENCODING = 'utf-8'
@@ -5,6 +5,7 @@ CLI application for transcoding music files
 
 import os
 import json
+import hashlib
 import platform
 import time
 import sys
@@ -12,19 +13,17 @@ from argparse import ArgumentParser
 from contextlib import contextmanager
 from datetime import datetime
 from functools import partial
-from pkg_resources import resource_string
+from itertools import chain
+from pkgutil import get_data
 from subprocess import Popen, DEVNULL
-from threading import Thread
-
-import mutagen
-from jsonschema import Draft7Validator as JSONSchemaValidator
-from ruamel import yaml
+from threading import Lock, Thread
 
 from musicbatch.transcoder import (
     CONFIG_ENCODING,
     DEFAULT_CONFIG,
     LOSSLESS_EXTENSIONS,
 )
+from musicbatch.transcoder.capacity import CapacityPlanner, free_space
 from musicbatch.transcoder.encoders import (
     AACTranscoder,
     LameTranscoder,
@@ -40,10 +39,25 @@ from musicbatch.transcoder.progress import (
     show_progress,
 )
 from musicbatch.transcoder.queue import (
+    AlbumTracker,
     TranscodingQueue,
+    TranscodingTask,
+    batch_by_directory,
     execute_in_threadqueue,
+    execute_per_device,
+    for_each,
+)
+from musicbatch.transcoder.prefetch import SourcePrefetcher, warm_up
+from musicbatch.transcoder.staging import StagingArea
+from musicbatch.transcoder.util import (
+    group_by_device,
+    parse_size,
+    partial_filename,
+    skip_action,
 )
-from musicbatch.lyrics.db import LyricsStorage
+
+# NOTE: Heavy dependencies (mutagen, jsonschema, ruamel.yaml, sqlalchemy) are
+#       imported only where they are used to keep CLI startup fast
 
 
 
@@ -69,18 +83,105 @@ def run(*a, **ka):
 
     if args.newconfig:
         with open(args.config, 'wb') as config:
-            config.write(resource_string(__name__.rsplit('.', 1)[0], 'sample.yml'))
+            config.write(get_data(__name__.rsplit('.', 1)[0], 'sample.yml'))
         edit_file(args.config)
         return
 
     job = TranscodingJob(args.config)
-    tasks = TranscodingQueue(job.inputs, job.output_pattern)
+
+    if args.history:
+        show_history(job, threshold=args.threshold / 100)
+        return
+
+    if args.coordinator:
+        from musicbatch.transcoder.distributed import run_coordinator
+        run_coordinator(job, args.coordinator)
+        job.finished = True
+        job.write_report()
+        return
+
+    if args.worker:
+        from musicbatch.transcoder.distributed import authkey, connect_ledger, run_worker
+        ledger = connect_ledger(args.worker, authkey(job, args.worker))
+        with restore_stdin():
+            show_progress(job)
+            try:
+                run_worker(job, ledger)
+            finally:
+                job.finished = True
+        return
+
+    if args.verify:
+        verifier = job.verify_all()
+        print(verifier.show())
+        if verifier.corrupt:
+            print('Corrupt files will be transcoded again by the next run (or with --retry-failed)')
+        return
+
+    if args.retry_failed and not job.failing:
+        print('No failed tasks recorded for {}'.format(job.job_id))
+        return
+
+    if args.max_duration or args.deadline:
+        if job.reads_per_device:
+            raise ValueError('--max-duration and --deadline can not be used with execution.reads_per_device')
+        from musicbatch.transcoder.deadline import (
+            RESUME_FILENAME,
+            BudgetedRun,
+            ResumeState,
+            TimeBudget,
+            parse_deadline,
+            parse_duration,
+        )
+        if args.deadline:
+            deadline = parse_deadline(args.deadline)
+        else:
+            deadline = time.time() + parse_duration(args.max_duration)
+        job.budgeted = BudgetedRun(
+            job,
+            TimeBudget(deadline),
+            ResumeState(os.path.join(job.output_dir, RESUME_FILENAME)),
+        )
 
     with restore_stdin():
         show_progress(job)   # start progress report thread
-        execute_in_threadqueue(job.transcode, tasks, buffer_size=20)
-        job.finished = True  # terminate progress report thread
+        job.stats.start()
+        try:
+            job.transcode_all(failed_only=args.retry_failed)
+            if args.watch:
+                from musicbatch.transcoder.watch import watch_job
+                watch_job(job, settle=args.settle)
+        except KeyboardInterrupt:
+            if not args.watch:
+                raise
+        finally:
+            job.stats.stop()
+            job.finished = True  # terminate progress report thread
         job.write_report()
+        if job.planner is not None:
+            print(job.planner.show())
+        if job.budgeted is not None and job.budgeted.postponed:
+            print('Time budget is exhausted, {} tasks are postponed until the next run'.format(
+                len(job.budgeted.postponed)
+            ))
+        if job.failures:
+            print('{} tasks have failed:'.format(len(job.failures)))
+            for source, error in sorted(job.failures.items()):
+                print('  {}: {}'.format(source, error))
+            print('Use --retry-failed to process only these tasks again')
+
+
+
+def show_history(job, threshold=0.1):
+    '''Print the journal of previous runs and highlight performance regressions'''
+    from musicbatch.transcoder.history import HISTORY_FILENAME, RunHistory
+    history = RunHistory(os.path.join(job.output_dir, HISTORY_FILENAME))
+    comparisons = history.compare(job.config_hash, threshold=threshold)
+    if not comparisons:
+        print('No runs recorded for {}'.format(job.job_id))
+        return
+    for comparison in comparisons:
+        print(comparison.show())
 
 
 
@@ -101,9 +202,87 @@ def parse_args(*a, prog=None, **ka):
         default=False,
         help='Create new configuration file from template and open it for editing',
     )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        default=False,
+        help='Keep running after the first pass and transcode new or modified albums as they appear',
+    )
+    parser.add_argument(
+        '--settle',
+        default=30,
+        type=float,
+        metavar='SECONDS',
+        help='Process an album in watch mode only after it was not modified for this long (default: 30)',
+    )
+    parser.add_argument(
+        '--coordinator',
+        metavar='[HOST:]PORT',
+        help=(
+            'Serve the queue of transcoding tasks to worker processes instead of transcoding locally. '
+            'Listens on localhost unless HOST is given, '
+            'other addresses require MUSICBATCH_AUTHKEY environment variable'
+        ),
+    )
+    parser.add_argument(
+        '--worker',
+        metavar='[HOST:]PORT',
+        help='Process transcoding tasks received from coordinator at the given address',
+    )
+    parser.add_argument(
+        '--max-duration',
+        metavar='DURATION',
+        help='Stop starting new tasks when this much time has passed, e.g. 90m or 2h30m. '
+             'The next run continues from where this one has stopped',
+    )
+    parser.add_argument(
+        '--deadline',
+        metavar='TIME',
+        help='Same as --max-duration, but with wall clock time (HH:MM or YYYY-MM-DD HH:MM)',
+    )
+    parser.add_argument(
+        '--retry-failed',
+        action='store_true',
+        default=False,
+        help='Process again only the tasks that have failed in previous runs, without scanning input directories',
+    )
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        default=False,
+        help='Decode all output files and compare their duration with sources. '
+             'Corrupt files are transcoded again by the next run',
+    )
+    parser.add_argument(
+        '--history',
+        action='store_true',
+        default=False,
+        help='Show the journal of previous runs of this job and detect throughput regressions',
+    )
+    parser.add_argument(
+        '--threshold',
+        default=10,
+        type=float,
+        metavar='PERCENT',
+        help='Throughput drop that is reported as a regression (default: 10%%)',
+    )
     args = parser.parse_args(*a, **ka)
     if args.newconfig and os.path.exists(args.config):
         parser.error('File already exists: {}'.format(args.config))
+    modes = [a for a in (
+        'history',
+        'watch',
+        'coordinator',
+        'worker',
+        'max_duration',
+        'deadline',
+        'retry_failed',
+        'verify',
+    ) if getattr(args, a)]
+    if args.newconfig and modes:
+        parser.error('Only --newconfig action can be performed on a new configuration file')
+    if len(modes) > 1:
+        parser.error('Incompatible options: {}'.format(', '.join('--' + m.replace('_', '-') for m in modes)))
     return args
 
 
@@ -159,6 +338,7 @@ class TranscodingJob:
 
     def __init__(self, config_file):
         '''Initialize transcoding job'''
+        from ruamel import yaml
         self.stats = TranscodingStats()
         self.finished = False
         self.config_file = config_file
@@ -168,14 +348,42 @@ class TranscodingJob:
             config = yaml.load(f, Loader=yaml.RoundTripLoader)
             output = config.get('output', {})
             extras = config.get('extras', {})
+            execution = config.get('execution', {})
 
         self.validate(config)
 
+        self.config_hash = hashlib.sha1(
+            json.dumps(config, sort_keys=True).encode(CONFIG_ENCODING)
+        ).hexdigest()
         self.job_id = config.get('name', DEFAULT_CONFIG['name'])
         self.inputs = config.get('input', [])
         self.output_dir = output.get('directory')
         self.output_pattern = output.get('pattern', DEFAULT_CONFIG['pattern'])
         self.cover_size = extras.get('cover', DEFAULT_CONFIG['cover'])
+        self.max_size = output.get('max_size', DEFAULT_CONFIG['max_size'])
+        self.priority = output.get('priority', DEFAULT_CONFIG['priority']) or []
+        self.planner = None
+        self.upgrades = set()  # sources that must be transcoded again
+        self.budgeted = None
+        self.threads = execution.get('threads', DEFAULT_CONFIG['threads']) or os.cpu_count()
+        self.reads_per_device = execution.get('reads_per_device', DEFAULT_CONFIG['reads_per_device'])
+        self.album_batch = execution.get('album_batch', DEFAULT_CONFIG['album_batch'])
+        self.retries = execution.get('retries', DEFAULT_CONFIG['retries'])
+        self.retry_delay = execution.get('retry_delay', DEFAULT_CONFIG['retry_delay'])
+        prefetch = execution.get('prefetch', DEFAULT_CONFIG['prefetch'])
+        if prefetch:
+            self.prefetcher = SourcePrefetcher(
+                lookahead = prefetch,
+                budget = parse_size(execution.get('prefetch_budget', DEFAULT_CONFIG['prefetch_budget'])),
+                method = execution.get('prefetch_method', DEFAULT_CONFIG['prefetch_method']),
+            )
+            self.callbacks = dict(
+                on_queue = self.prefetcher.queued,
+                on_start = self.prefetcher.started,
+            )
+        else:
+            self.prefetcher = None
+            self.callbacks = {}
         if output.get('category_blacklist'):
             self.select_mode = 'blacklist'
             self.select = set(output.get('category_blacklist'))
@@ -192,6 +400,7 @@ class TranscodingJob:
         elif os.path.isdir(lyrics_source):
             self.get_lyrics = partial(read_lyrics, lyricsdir=lyrics_source)
         elif os.path.isfile(lyrics_source):
+            from musicbatch.lyrics.db import LyricsStorage
             database = LyricsStorage(lyrics_source)
             self.get_lyrics = database.get
         else:
@@ -201,6 +410,19 @@ class TranscodingJob:
         quality = output.get('quality', DEFAULT_CONFIG['quality'])
         self.transcoder = self.ENCODERS.get(encoder)(quality)
 
+        if extras.get('replaygain', DEFAULT_CONFIG['replaygain']):
+            try:
+                from musicbatch.transcoder.loudness import LoudnessAnalysis, register_tags
+            except ImportError as e:
+                raise ValueError('ReplayGain analysis requires NumPy: {}'.format(e))
+            register_tags()
+            self.loudness = LoudnessAnalysis()
+            self.transcoder.on_decode = self.stats.timed('loudness', self.loudness.analyze)
+            self.albums = AlbumTracker(self.finish_album)
+        else:
+            self.loudness = None
+            self.albums = None
+
         lossy_action = output.get('lossy_source', DEFAULT_CONFIG['lossy_source'])
         if lossy_action == 'allow_bad_transcodes'\
         or encoder == 'symlink' \
@@ -213,7 +435,28 @@ class TranscodingJob:
             self.lossy_action = lambda infile, outfile: (infile, skip_marker)
             self.lossy_action.STATUS_SKIP = skip_marker
 
+        staging = output.get('staging', DEFAULT_CONFIG['staging'])
+        if staging and encoder == 'symlink':
+            log.warning('Staging directory is ignored for symlink output')
+            staging = None
+        if staging:
+            staging_extras = []
+            if self.cover_size:
+                staging_extras.append(self.stats.timed('cover', partial(copy_coverart, size=self.cover_size)))
+            if self.get_lyrics:
+                staging_extras.append(self.stats.timed('lyrics', partial(copy_lyrics, lyrics_finder=self.get_lyrics)))
+            staging_extras.append(TranscodingTask.compact)  # music tags are not needed after the last extra
+            self.staging = StagingArea(staging, self.output_dir, extras=staging_extras, stats=self.stats)
+        else:
+            self.staging = None
+
         os.makedirs(self.output_dir, exist_ok=True)
+
+        self.keep_journal = True  # distributed workers report failures to coordinator instead
+        self._journal = None
+        self._journal_lock = Lock()
+        self._failing = None
+        self.failures = {}  # source -> error message (for this run only)
         log.debug('Initialized {}'.format(self))
 
 
@@ -224,63 +467,561 @@ class TranscodingJob:
         )
 
 
-    def transcode(self, task):
-        '''Execute a single transcoding task'''
+    @property
+    def journal(self):
+        '''
+        FailureJournal in the output directory (None if disabled).
+        The database is opened on first use
+        '''
+        if not self.keep_journal:
+            return None
+        with self._journal_lock:
+            if self._journal is None:
+                from musicbatch.transcoder.failures import FailureJournal
+                from musicbatch.transcoder.history import HISTORY_FILENAME
+                self._journal = FailureJournal(os.path.join(self.output_dir, HISTORY_FILENAME))
+            return self._journal
+
+
+    @property
+    def failing(self):
+        '''Sources of the tasks that have failed in previous runs'''
+        if self._failing is None:
+            journal = self.journal
+            with self._journal_lock:
+                if self._failing is None:
+                    if journal is None:
+                        self._failing = set()
+                    else:
+                        self._failing = {failure.source for failure in journal.failures(self.config_hash)}
+        return self._failing
+
+
+    @failing.setter
+    def failing(self, value):
+        self._failing = value
+
+
+    def scan(self, directories):
+        '''Generate transcoding tasks for the music in directories'''
+        return self.stats.timed_iter('scan', TranscodingQueue(directories, self.output_pattern))
+
+
+    def transcode_all(self, failed_only=False):
+        '''
+        Execute all transcoding tasks for the input directories
+        (or only the tasks that have failed previously)
+        '''
+        function, callbacks = self.processing()
+        try:
+            if failed_only:
+                execute_in_threadqueue(
+                    function,
+                    self.batch(self.track(self.journal.tasks(self.config_hash, self.output_pattern))),
+                    num_threads=self.threads,
+                    **callbacks
+                )
+            elif self.budgeted is not None:
+                try:
+                    execute_in_threadqueue(
+                        function,
+                        self.batch(self.track(self.budgeted.tasks())),
+                        num_threads=self.threads,
+                        **callbacks
+                    )
+                finally:
+                    self.budgeted.save()
+            elif self.reads_per_device:
+                queues = {
+                    device: self.scan(directories)
+                    for device, directories in group_by_device(self.inputs).items()
+                }
+                if self.max_size:
+                    queues = {device: list(tasks) for device, tasks in queues.items()}
+                    selected = set(map(id, self.plan(chain.from_iterable(queues.values()))))
+                    queues = {
+                        device: [task for task in tasks if id(task) in selected]
+                        for device, tasks in queues.items()
+                    }
+                execute_per_device(
+                    function,
+                    {device: self.batch(self.track(tasks)) for device, tasks in queues.items()},
+                    reads_per_device=self.reads_per_device,
+                    read=self.read_sources,
+                    num_threads=self.threads,
+                    buffer_size=max(20, self.prefetcher.lookahead if self.prefetcher else 0),
+                    **callbacks
+                )
+            else:
+                tasks = self.batch(self.track(self.plan(self.scan(self.inputs))))
+                execute_in_threadqueue(
+                    function,
+                    tasks,
+                    num_threads=self.threads,
+                    buffer_size=max(20, self.prefetcher.lookahead if self.prefetcher else 0),
+                    **callbacks
+                )
+        finally:
+            self.flush()
+
+
+    def read_sources(self, item):
+        '''
+        Load source files of a queue item into page cache ahead of the encoder
+        (read phase of per-device scheduling). Up-to-date sources are not read
+        '''
+        for task in (item if self.by_album else [item]):
+            if self.filtered_out(task):
+                continue
+            worker = self.worker(task)
+            if not hasattr(worker, 'target_filename') or isinstance(worker, SymlinkCreator):
+                continue
+            final = worker.target_filename(task.source, os.path.join(self.output_dir, task.target))
+            if not skip_action(task.source, final) \
+            or task.source in self.upgrades \
+            or task.source in self.failing:
+                warm_up(task.source)
+
+
+    def verify_all(self):
+        '''Decode all output files of the job and compare their duration with sources'''
+        from musicbatch.transcoder.history import HISTORY_FILENAME
+        from musicbatch.transcoder.verify import VerificationCache, Verifier
+        verifier = Verifier(
+            self.output_dir,
+            VerificationCache(os.path.join(self.output_dir, HISTORY_FILENAME)),
+            threads = self.threads,
+            on_corrupt = partial(self.journal.record, self.config_hash),
+        )
+        verifier.run(self.outputs())
+        return verifier
+
+
+    def outputs(self):
+        '''Generate (task, output path) pairs for the files produced by encoders'''
+        for task in self.scan(self.inputs):
+            if self.filtered_out(task):
+                continue
+            worker = self.worker(task)
+            if not hasattr(worker, 'target_filename') or isinstance(worker, SymlinkCreator):
+                continue
+            yield task, worker.target_filename(task.source, os.path.join(self.output_dir, task.target))
+
+
+    def plan(self, tasks):
+        '''
+        Select the tasks that fit into output size limit (if any).
+        All tasks are scanned before returning the selection
+        '''
+        if not self.max_size:
+            return tasks
+        if self.max_size == 'auto':
+            budget, incremental = free_space(self.output_dir), True
+        else:
+            budget, incremental = parse_size(self.max_size), False
+        self.planner = CapacityPlanner(budget, self.estimate_size, self.priority, incremental)
+        with self.stats.timer('plan').measure():
+            return self.planner.plan(tasks)
+
+
+    def estimate_size(self, task):
+        '''
+        Estimate the output size of the task before transcoding.
+        Return a tuple of (expected size, size of existing output file)
+        '''
+        if self.filtered_out(task):
+            return 0, 0
+        worker = self.worker(task)
+        if not hasattr(worker, 'estimate_size'):  # lossy source is skipped
+            return 0, 0
+        final = worker.target_filename(task.source, os.path.join(self.output_dir, task.target))
+        try:
+            existing = os.lstat(final).st_size
+        except OSError:
+            existing = 0
+        if skip_action(task.source, final):
+            return existing, existing
+        source_size = os.path.getsize(task.source)
+        try:
+            duration = task.duration
+        except Exception as e:
+            log.warning('Can not read duration of {}, assuming lossless: {}'.format(task.source, e))
+            return source_size, existing
+        return worker.estimate_size(duration, source_size), existing
+
+
+    @property
+    def by_album(self):
+        '''Short tracks from each album are transcoded in a single batch'''
+        return bool(self.album_batch) and self.loudness is None
+
+
+    def processing(self):
+        '''Return the function that processes queued items and matching callbacks'''
+        if self.by_album:
+            callbacks = {name: partial(for_each, callback) for name, callback in self.callbacks.items()}
+            return self.transcode_album, callbacks
+        return self.transcode, self.callbacks
+
+
+    def batch(self, tasks):
+        '''
+        Group short tracks from each source directory into a single queue item
+        if albums are batched. Other tasks are queued one by one (as lists of
+        one task) to be transcoded in parallel
+        '''
+        if not self.by_album:
+            return tasks
+        return self._batch(tasks)
+
+
+    def _batch(self, tasks):
+        for album in batch_by_directory(tasks):
+            short = []
+            for task in album:
+                if self.batchable(task):
+                    short.append(task)
+                else:
+                    yield [task]
+            if len(short) > 1:
+                yield short
+            else:
+                yield from ([task] for task in short)
+
+
+    def batchable(self, task):
+        '''Check if the task may be transcoded in a batch with other short tracks'''
+        if self.filtered_out(task) or not hasattr(self.worker(task), 'transcode_batch'):
+            return False
+        try:
+            return task.duration <= self.album_batch
+        except Exception:
+            return False
+
+
+    def track(self, tasks):
+        '''Register tasks in album tracker and staging area (if any) as they are produced'''
+        if self.albums is not None:
+            tasks = self.albums.track(tasks)
+        if self.staging is not None:
+            tasks = self.staging.track(tasks)
+        return tasks
+
+
+    def flush(self):
+        '''Move all remaining results from staging area to output directory'''
+        if self.staging is not None:
+            self.staging.close()
+
+
+    def transcode(self, task, step=None):
+        '''
+        Execute a single transcoding task.
+        Return True if the task was processed successfully
+        '''
+        success, staged = self.attempt(task, step)
+        self.done(task, staged, success)
+        return success
+
+
+    def attempt(self, task, step=None):
+        '''
+        Try to execute the transcoding task.
+
+        Transient errors (e.g. network filesystem hiccups) are retried with
+        exponential backoff, other failures are recorded to the journal.
+        Return a tuple of (success, path to staged result)
+        '''
+        attempt = 0
+        while True:
+            staged = None
+            try:
+                if step is None:
+                    step = self.prepare(task)
+                if step is not None:
+                    staged = self._transcode(task, step)
+            except Exception as e:
+                from musicbatch.transcoder.failures import is_transient
+                if step is not None:
+                    self.discard(step)
+                if attempt < self.retries and is_transient(e):
+                    delay = self.retry_delay * 2 ** attempt
+                    log.warning('Retrying {} in {}s after error: {}'.format(task.source, delay, e))
+                    time.sleep(delay)
+                    attempt += 1
+                    step = None
+                    continue
+                self.record_failure(task, e)
+                return False, None
+            if task.source in self.failing:
+                self.journal.resolve(self.config_hash, task.source)
+                self.failing.discard(task.source)
+            return True, staged
+
+
+    def discard(self, step):
+        '''Remove incomplete results of a failed step'''
+        for path in (step.partial, step.staged):
+            if path is not None and os.path.lexists(path):
+                os.remove(path)
+
+
+    def record_failure(self, task, exception):
+        '''Save the details of a failed task to the journal'''
+        from musicbatch.transcoder.failures import describe
+        task.result = None
+        self.stats.record_failure()
+        journal = self.journal
+        if journal is not None:
+            error = journal.record(self.config_hash, task, exception).error
+        else:
+            error = describe(exception)
+        self.failures[task.source] = error
+        log.error('Failed to transcode {}: {}'.format(task.source, error))
+        log.debug('Traceback for {}'.format(task.source), exc_info=exception)
+
+
+    def done(self, task, staged=None, success=True):
+        '''
+        Notify album tracker, staging area and time budget about the processed
+        task, release its cached music tags
+        '''
+        if self.albums is not None:  # album gain must be written before staged album is flushed
+            self.albums.done(task, success)
+        elif self.loudness is not None:
+            self.loudness.discard(task.source)
+        if self.staging is not None:
+            self.staging.done(task, staged)
+        if self.budgeted is not None and task.result is not None:
+            self.budgeted.finish(task)
+        if self.staging is None or not task.result:  # staged results are compacted after flush
+            task.compact()
+
+
+    def finish_album(self, results):
+        '''Write album gain when all tracks from source directory were processed'''
+        try:
+            self.write_album_gain(results)
+        except Exception as e:
+            log.error('Failed to write album gain for {}: {}'.format(results[0][0].source_dir, e))
+        finally:
+            for task, success in results:
+                self.loudness.discard(task.source)
+
+
+    def expected_task_time(self):
+        '''Average duration of a single transcoding task (in seconds)'''
+        total = 0
+        for stage in ('transcode', 'tags'):
+            timer = self.stats.timer(stage)
+            if timer.count:
+                total += timer.value / timer.count
+        return total
+
+
+    def transcode_album(self, tasks):
+        '''
+        Execute a queue item produced by batch(). Short tracks from a single
+        source directory are transcoded by a single encoder process to save
+        on startup costs
+        '''
+        steps = []
+        batch = []
+        for task in tasks:
+            try:
+                step = self.prepare(task)
+            except Exception as e:
+                step = e
+            steps.append(step)
+            if isinstance(step, TranscodingStep) and task.status is None:
+                batch.append((task, step))
+        if len(batch) > 1:
+            log.debug('Transcoding {} tracks from {} in one batch'.format(len(batch), batch[0][0].source_dir))
+            start = time.perf_counter()
+            results = self.transcoder.transcode_batch([(task.source, step.destination) for task, step in batch])
+            elapsed = time.perf_counter() - start
+            for (task, step), (result, status) in zip(batch, results):
+                self.stats.timer('transcode').add(elapsed / len(batch))
+                if status is not None:
+                    task.result, task.status = result, status
+        results = []
+        for task, step in zip(tasks, steps):
+            if step is None:  # nothing to be done
+                results.append((task, True, None))
+            elif isinstance(step, Exception):
+                results.append((task,) + self.attempt(task))  # try again from the start
+            else:
+                results.append((task,) + self.attempt(task, step))
+        for task, success, staged in results:
+            self.done(task, staged, success)
+
+
+    def write_album_gain(self, results):
+        '''
+        Add album ReplayGain tags to transcoded files, `results` is the list
+        of (task, success) pairs. The tags are written only if all the tracks
+        of the album were transcoded successfully
+        '''
+        album = [(task, success) for task, success in results if not self.filtered_out(task)]
+        if not album or not all(success for task, success in album):
+            return
+        tags = self.loudness.album_tags(
+            [task.source for task, success in album],
+            opus = getattr(self.transcoder, 'extension', None) == 'opus',
+        )
+        if not tags:
+            log.debug('Album gain is not available for {}'.format(album[0][0].source_dir))
+            return
+        import mutagen
+        with self.stats.timer('tags').measure():
+            for task, success in album:
+                result = mutagen.File(task.result, easy=True)
+                self.write_tags(result, tags)
+                result.save()
+
+
+    def prepare(self, task):
+        '''
+        Check if the task needs to be executed and calculate file paths.
+
+        Return TranscodingStep or None if there is nothing to be done.
+        Up-to-date tasks are marked as skipped
+        '''
+        if self.budgeted is not None and not self.budgeted.allows():
+            log.debug('Postponed {task}'.format(task=task))
+            return
+
         log.debug('Started {task}'.format(task=task))
+        task.result = task.status = None
 
-        if (self.select_mode == 'blacklist' and self.select.intersection(task.categories)) \
-        or (self.select_mode == 'whitelist' and not self.select.intersection(task.categories)):
+        if self.filtered_out(task):
             self.stats.record_skip()
             log.debug('Skipped {task}'.format(task=task))
             return
 
-        source_format = os.path.splitext(task.source)[1][1:].lower()
-        if source_format in LOSSLESS_EXTENSIONS:
-            worker = self.transcoder
-        else:
-            worker = self.lossy_action
-
         if self._timestamp is None:  # record the time of first transcoding task
-            self._timestamp = int(time.time())
+            self._timestamp = time.time()
 
-        # Step 1: Transcode
-        task.result, task.status = worker(
-            task.source,
-            os.path.join(self.output_dir, task.target)
-        )
+        # Results are written to a temporary file (or to staging area)
+        # and are moved into place only when finished
+        step = TranscodingStep(self.worker(task), os.path.join(self.output_dir, task.target))
+        worker = step.worker
+        if hasattr(worker, 'target_filename'):
+            step.final = worker.target_filename(task.source, step.destination)
+            if skip_action(task.source, step.final) \
+            and task.source not in self.upgrades \
+            and task.source not in self.failing:
+                task.result, task.status = step.final, worker.STATUS_SKIP
+            else:
+                if self.staging is not None:
+                    step.destination = step.staged = worker.target_filename(
+                        task.source,
+                        self.staging.path(task.target)
+                    )
+                else:
+                    step.destination = step.partial = partial_filename(step.final)
+                if os.path.lexists(step.destination):
+                    if os.path.getmtime(step.destination) > self.timestamp:
+                        raise RuntimeError('Target path collision for {}'.format(step.final))
+                    os.remove(step.destination)  # leftover from interrupted run
+        return step
 
-        # Step 1a: Process extras (cover art, lyrics)
-        if self.cover_size:
-            Thread(
-                target=copy_coverart,
-                kwargs=dict(task=task, size=self.cover_size)
-            ).start()
-        if self.get_lyrics:
-            Thread(
-                target=copy_lyrics,
-                kwargs=dict(task=task, lyrics_finder=self.get_lyrics),
-            ).start()
+
+    def _transcode(self, task, step=None):
+        '''
+        Transcode, tag and process extras for a single task.
+
+        Return the path to staged result if the result was written to staging
+        area (extras are processed when the file is moved to output directory)
+        '''
+        if step is None:
+            step = self.prepare(task)
+            if step is None:
+                return
+        worker = step.worker
+        staged = step.staged
+
+        # Step 1: Transcode (unless it was done already)
+        if task.status is None:
+            with self.stats.timer('transcode').measure():
+                task.result, task.status = worker(task.source, step.destination)
 
         # Handle skipped transcodes
         if task.status is worker.STATUS_SKIP:
             if os.path.getmtime(task.result) > self.timestamp:
                 raise RuntimeError('Target path collision for {}'.format(task.result))
+            self.process_extras(task)
             self.stats.record_skip()
             log.debug('Skipped {task}'.format(task=task))
-            return
+            return staged
 
         # Step 2: Copy music tags
         if not task.status is worker.STATUS_SKIPTAGS:
-            result = mutagen.File(task.result, easy=True)
-            for key in task.tags.keys():  # mutagen is inconsistent about `for k in t.tags`
-                if hasattr(result.tags, 'valid_keys') \
-                and key not in result.tags.valid_keys:
-                    continue
-                result.tags[key] = task.tags[key]
-            result.save()
+            import mutagen
+            with self.stats.timer('tags').measure():
+                result = mutagen.File(task.result, easy=True)
+                self.write_tags(result, task.tags)
+                if self.loudness is not None:
+                    self.write_tags(result, self.loudness.track_tags(
+                        task.source,
+                        opus = getattr(worker, 'extension', None) == 'opus',
+                    ))
+                result.save()
+
+        # Step 3: Move finished file into place
+        if step.partial is not None:
+            os.replace(step.partial, step.final)
+            task.result = step.final
+
+        # Step 4: Process extras (cover art, lyrics)
+        self.process_extras(task)
 
         self.stats.record_done()
         log.debug('Finished {task}'.format(task=task))
+        return staged
+
+
+    def write_tags(self, result, tags):
+        '''Copy tags to mutagen file object, skip unsupported keys'''
+        for key in tags.keys():  # mutagen is inconsistent about `for k in t.tags`
+            if hasattr(result.tags, 'valid_keys') \
+            and key not in result.tags.valid_keys:
+                continue
+            result.tags[key] = tags[key]
+
+
+    def process_extras(self, task):
+        '''
+        Copy cover art and lyrics in background threads.
+        When staging is used, extras are processed on flush
+        '''
+        if self.staging is not None:
+            return
+        if self.cover_size:
+            Thread(
+                target=self.stats.timed('cover', copy_coverart),
+                kwargs=dict(task=task, size=self.cover_size)
+            ).start()
+        if self.get_lyrics:
+            Thread(
+                target=self.stats.timed('lyrics', copy_lyrics),
+                kwargs=dict(task=task, lyrics_finder=self.get_lyrics),
+            ).start()
+
+
+    def filtered_out(self, task):
+        '''Check if the task is excluded by category filters'''
+        return (self.select_mode == 'blacklist' and bool(self.select.intersection(task.categories))) \
+            or (self.select_mode == 'whitelist' and not self.select.intersection(task.categories))
+
+
+    def worker(self, task):
+        '''Select transcoder-like object for the task'''
+        source_format = os.path.splitext(task.source)[1][1:].lower()
+        if source_format in LOSSLESS_EXTENSIONS:
+            return self.transcoder
+        else:
+            return self.lossy_action
 
 
     @property
@@ -292,6 +1033,14 @@ class TranscodingJob:
         return self._timestamp
 
 
+    def reset_timestamp(self):
+        '''
+        Start a new pass over input directories (watch mode): results of
+        previous passes are not target path collisions
+        '''
+        self._timestamp = None
+
+
     def write_report(self):
         '''Keep a journal of transcoder runs'''
         log_entry = '{time}Z: {stats}\n'.format(
@@ -300,6 +1049,9 @@ class TranscodingJob:
         )
         with open(os.path.join(self.output_dir, 'transcoding.log'), 'a') as logfile:
             logfile.write(log_entry)
+        from musicbatch.transcoder.history import HISTORY_FILENAME, RunHistory
+        history = RunHistory(os.path.join(self.output_dir, HISTORY_FILENAME))
+        history.record(self)
 
 
     def validate(self, config):
@@ -307,9 +1059,10 @@ class TranscodingJob:
         try:
             self.validator
         except AttributeError:
+            from jsonschema import Draft7Validator as JSONSchemaValidator
             package = __name__.rsplit('.', 1)[0]
             path = 'schema.json'
-            schema = json.loads(resource_string(package, path).decode())
+            schema = json.loads(get_data(package, path).decode())
             self.validator = JSONSchemaValidator(schema)
 
         error_messages = []
@@ -322,3 +1075,26 @@ class TranscodingJob:
             raise ValueError('invalid configuration values:\n{}'.format(
                     '\n'.join(sorted(error_messages))
             ))
+
+
+
+class TranscodingStep:
+    '''Intermediate state of a single transcoding task'''
+
+    __slots__ = ('worker', 'destination', 'final', 'staged', 'partial')
+
+
+    def __init__(self, worker, destination):
+        self.worker = worker
+        self.destination = destination  # where the worker writes its result
+        self.final = None  # location of the result in output directory
+        self.staged = None  # location of the result in staging area
+        self.partial = None  # temporary name of the result
+
+
+    def __repr__(self):
+        return '<{cls}({worker!r}, {destination!r})>'.format(
+            cls = self.__class__.__name__,
+            worker = self.worker,
+            destination = self.destination,
+        )
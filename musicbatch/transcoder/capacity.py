@@ -0,0 +1,196 @@
+'''
+Fit transcoding job into the available space on target device
+'''
+
+
+import os
+import shutil
+from collections import OrderedDict
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+PLAYCOUNT_TAGS = ('playcount', 'fmps_playcount', 'play_count')
+
+
+
+class PlannedAlbum:
+    '''Transcoding tasks from a single source directory and their output size'''
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.tasks = []
+        self.size = 0  # expected size of all output files
+        self.on_disk = 0  # size of the output files that already exist
+
+
+    def __repr__(self):
+        return '<{cls}({source_dir!r}, size={size})>'.format(
+            cls = self.__class__.__name__,
+            source_dir = self.source_dir,
+            size = self.size,
+        )
+
+
+    @property
+    def categories(self):
+        categories = set()
+        for task in self.tasks:
+            categories.update(task.categories)
+        return categories
+
+
+    @property
+    def added(self):
+        '''Time when the newest file was added to the album'''
+        latest = 0
+        for task in self.tasks:
+            try:
+                latest = max(latest, os.path.getmtime(task.source))
+            except OSError:
+                pass
+        return latest
+
+
+    @property
+    def playcount(self):
+        '''Sum of play counters stored in music tags'''
+        total = 0
+        for task in self.tasks:
+            try:
+                tags = task.read_tags() or {}
+            except Exception:
+                continue
+            for key in PLAYCOUNT_TAGS:
+                try:
+                    total += int(tags[key][0])
+                    break
+                except (KeyError, IndexError, ValueError, TypeError):
+                    continue
+        return total
+
+
+
+class CapacityPlanner:
+    '''
+    Select albums that fit into the size budget before transcoding starts.
+
+    Output size of each task is estimated with `estimate(task)` callable that
+    returns a tuple of (expected size, size of existing output file). Albums
+    are considered in the order defined by priority rules:
+
+        category:NAME   albums with this category go first
+        recent          recently added albums go first
+        playcount       most played albums go first
+
+    Albums with equal priority keep the scanning order. If `incremental` is
+    true, the budget limits only the additional space (e.g. free space on
+    target filesystem), otherwise it limits the total size of the output.
+    '''
+
+    MARGIN = 1.05  # estimates for encoded files are approximate
+
+
+    def __init__(self, budget, estimate, priority=(), incremental=False):
+        self.budget = budget
+        self.estimate = estimate
+        self.priority = list(priority)
+        self.incremental = incremental
+        self.selected = []
+        self.left_out = []
+        self.used = 0
+        for rule in self.priority:
+            self._sort_key(rule)  # validate rules early
+
+
+    def __repr__(self):
+        return '<{cls}(budget={budget}, priority={priority!r})>'.format(
+            cls = self.__class__.__name__,
+            budget = self.budget,
+            priority = self.priority,
+        )
+
+
+    def _sort_key(self, rule):
+        '''Return a function that calculates the sorting key for an album'''
+        if rule.startswith('category:'):
+            category = rule.split(':', 1)[1]
+            return lambda album: 0 if category in album.categories else 1
+        elif rule == 'recent':
+            return lambda album: -album.added
+        elif rule == 'playcount':
+            return lambda album: -album.playcount
+        raise ValueError('Unknown priority rule: {}'.format(rule))
+
+
+    def plan(self, tasks):
+        '''Consume all tasks and return the list of the ones that fit the budget'''
+        albums = OrderedDict()
+        for task in tasks:
+            album = albums.get(task.source_dir)
+            if album is None:
+                album = albums[task.source_dir] = PlannedAlbum(task.source_dir)
+            album.tasks.append(task)
+            expected, existing = self.estimate(task)
+            album.size += existing if expected == existing else int(expected * self.MARGIN)
+            album.on_disk += existing
+            task.compact()
+
+        ordered = list(albums.values())
+        for rule in reversed(self.priority):  # stable sort by multiple keys
+            ordered.sort(key=self._sort_key(rule))
+
+        remaining = self.budget
+        selected = set()
+        for album in ordered:
+            cost = album.size - album.on_disk if self.incremental else album.size
+            if cost <= remaining:
+                remaining -= cost
+                self.used += album.size
+                selected.add(album.source_dir)
+            else:
+                self.left_out.append(album)
+        for album in albums.values():
+            if album.source_dir in selected:
+                self.selected.extend(album.tasks)
+        if self.left_out:
+            log.warning('{} albums do not fit into {} bytes'.format(len(self.left_out), self.budget))
+        return self.selected
+
+
+    def show(self):
+        '''Human readable report on the albums that were left out'''
+        if not self.left_out:
+            return 'All albums fit into the size limit ({} used)'.format(human_size(self.used))
+        lines = ['{count} albums ({size}) did not fit into the size limit ({used} used):'.format(
+            count = len(self.left_out),
+            size = human_size(sum(album.size for album in self.left_out)),
+            used = human_size(self.used),
+        )]
+        for album in self.left_out:
+            lines.append('  {size:>9}  {path}'.format(
+                size = human_size(album.size),
+                path = album.source_dir,
+            ))
+        return '\n'.join(lines)
+
+
+
+def free_space(path):
+    '''Free space on the filesystem that contains the path (in bytes)'''
+    return shutil.disk_usage(path).free
+
+
+
+def human_size(size):
+    '''Format the number of bytes for humans'''
+    for unit in ('B', 'K', 'M', 'G'):
+        if abs(size) < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'T'
+    return '{:.1f}{}'.format(size, unit) if unit != 'B' else '{}B'.format(size)
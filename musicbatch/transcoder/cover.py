@@ -6,8 +6,6 @@ import os
 import random
 import re
 
-from PIL import Image
-
 from musicbatch.transcoder.util import make_target_directory, skip_action
 
 
@@ -71,6 +69,7 @@ def copy_coverart(task, size=250, name='cover.jpg', format='jpeg'):
         destination = os.path.join(os.path.dirname(task.result), name)
         if not skip_action(source, destination):
             make_target_directory(destination)
+            from PIL import Image
             image = Image.open(source)
             image.thumbnail((size, size))
             image.save(destination, format=format)
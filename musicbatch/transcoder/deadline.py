@@ -0,0 +1,257 @@
+'''
+Time budgeted transcoding runs
+'''
+
+
+import json
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+
+from musicbatch.transcoder.queue import TranscodingTask
+from musicbatch.transcoder.util import skip_action
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+RESUME_FILENAME = 'transcoding-resume.json'
+
+NEW = 'new'
+CHANGED = 'changed'
+UPGRADE = 'upgrade'
+TIERS = (NEW, CHANGED, UPGRADE)  # order of processing
+
+UPGRADE_THRESHOLD = 0.8  # existing files with lower bitrate are upgraded
+
+
+
+_duration = re.compile(r'^\s*(?:(\d+)h)?\s*(?:(\d+)m)?\s*(?:(\d+)s?)?\s*$', re.IGNORECASE)
+def parse_duration(value):
+    '''Convert human readable duration (e.g. "90m", "1h30m", "3600") to seconds'''
+    parsed = _duration.match(str(value))
+    if not parsed or not any(parsed.groups()):
+        raise ValueError('Invalid duration value: {}'.format(value))
+    hours, minutes, seconds = (int(x or 0) for x in parsed.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+
+
+def parse_deadline(value, now=None):
+    '''
+    Convert wall clock time (HH:MM) or date and time (YYYY-MM-DD HH:MM) to
+    Unix timestamp. Time without date refers to the nearest future moment
+    '''
+    if now is None:
+        now = datetime.now()
+    value = value.strip()
+    for fmt in ('%H:%M', '%H:%M:%S'):
+        try:
+            parsed = datetime.strptime(value, fmt).time()
+        except ValueError:
+            continue
+        deadline = datetime.combine(now.date(), parsed)
+        if deadline <= now:
+            deadline += timedelta(days=1)
+        return deadline.timestamp()
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError('Invalid deadline value: {}'.format(value))
+
+
+
+class TimeBudget:
+    '''Track the time left until deadline'''
+
+    def __init__(self, deadline, clock=time.time):
+        self.deadline = deadline
+        self.clock = clock
+
+
+    def __repr__(self):
+        return '<{cls}(deadline={deadline})>'.format(
+            cls = self.__class__.__name__,
+            deadline = datetime.fromtimestamp(self.deadline).replace(microsecond=0),
+        )
+
+
+    @property
+    def remaining(self):
+        return self.deadline - self.clock()
+
+
+    def allows(self, duration=0):
+        '''Check if an action of given duration can be completed before deadline'''
+        return self.remaining > duration
+
+
+
+class ResumeState:
+    '''
+    Ordered list of pending tasks that is saved between time budgeted runs,
+    so that the next run continues where the previous one has stopped
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+
+    def __repr__(self):
+        return '<{cls}({filename!r})>'.format(
+            cls = self.__class__.__name__,
+            filename = self.filename,
+        )
+
+
+    def load(self, config_hash):
+        '''Return the list of pending task records or None if there is no valid state'''
+        try:
+            with open(self.filename) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get('config_hash') != config_hash:
+            log.debug('Ignoring resume state for another job configuration')
+            return None
+        return state.get('tasks')
+
+
+    def save(self, config_hash, records):
+        '''Save pending task records atomically'''
+        if not records:
+            self.clear()
+            return
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(dict(config_hash=config_hash, tasks=records), f)
+        os.replace(temporary, self.filename)
+
+
+    def clear(self):
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+
+
+def classify(job, task):
+    '''
+    Detect what kind of work the task requires: transcoding a new file,
+    updating a changed one or upgrading the quality of an existing file.
+    Return None if the output is up to date
+    '''
+    if job.filtered_out(task):
+        return None
+    worker = job.worker(task)
+    if not hasattr(worker, 'target_filename'):
+        return None
+    final = worker.target_filename(task.source, os.path.join(job.output_dir, task.target))
+    if not os.path.lexists(final):
+        return NEW
+    if not skip_action(task.source, final):
+        return CHANGED
+    bitrate = getattr(worker, 'bitrate', None)
+    if bitrate:
+        import mutagen
+        try:
+            existing = mutagen.File(final).info.bitrate / 1000
+        except Exception:
+            return None
+        if existing and existing < bitrate * UPGRADE_THRESHOLD:
+            return UPGRADE
+    return None
+
+
+
+class BudgetedRun:
+    '''
+    Produce transcoding tasks in the order of their value (new, changed,
+    upgrades) while there is enough time left.
+
+    All tasks are classified before transcoding starts and the ordered list of
+    pending tasks is kept in resume state file. The next run continues from
+    that list instead of scanning input directories again; the list is removed
+    when all tasks are finished.
+    '''
+
+    def __init__(self, job, budget, resume):
+        self.job = job
+        self.budget = budget
+        self.resume = resume
+        self.records = None
+        self.pending = {}  # id(task) -> record index
+        self.finished = set()  # record indexes
+        self.lock = Lock()
+
+
+    def __repr__(self):
+        return '<{cls}({budget!r})>'.format(
+            cls = self.__class__.__name__,
+            budget = self.budget,
+        )
+
+
+    def plan(self):
+        '''Load pending tasks from resume state or classify all tasks of the job'''
+        job = self.job
+        self.records = self.resume.load(job.config_hash)
+        if self.records is not None:
+            log.debug('Resuming time budgeted run with {} pending tasks'.format(len(self.records)))
+            return
+        records = []
+        for task in job.plan(job.scan(job.inputs)):
+            tier = classify(job, task)
+            if tier is None:
+                job.stats.record_skip()
+            else:
+                records.append([task.source, task.number, task.target_dir, tier])
+        records.sort(key=lambda record: TIERS.index(record[-1]))
+        self.records = records
+        self.resume.save(job.config_hash, records)
+        log.debug('Planned {} tasks for time budgeted run'.format(len(records)))
+
+
+    def tasks(self):
+        '''Generate tasks until the time budget is exhausted'''
+        if self.records is None:
+            self.plan()
+        for index, (source, number, target_dir, tier) in enumerate(self.records):
+            if not self.allows():
+                log.debug('Time budget is exhausted')
+                return
+            task = TranscodingTask(source, self.job.output_pattern, number, target_dir)
+            if tier == UPGRADE:
+                self.job.upgrades.add(source)
+            with self.lock:
+                self.pending[id(task)] = index
+            yield task
+
+
+    def allows(self):
+        '''Check if there is enough time left to start another task'''
+        return self.budget.allows(self.job.expected_task_time())
+
+
+    def finish(self, task):
+        '''Mark task as finished'''
+        with self.lock:
+            self.finished.add(self.pending.pop(id(task)))
+
+
+    @property
+    def postponed(self):
+        '''Records of the tasks that were not finished'''
+        if self.records is None:
+            return []
+        return [record for index, record in enumerate(self.records) if index not in self.finished]
+
+
+    def save(self):
+        '''Save the list of postponed tasks for the next run'''
+        self.resume.save(self.job.config_hash, self.postponed)
@@ -0,0 +1,574 @@
+'''
+Distributed transcoding: coordinator with durable work queue and any number
+of worker processes on this or other hosts
+'''
+
+
+import ipaddress
+import os
+import socket
+import time
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+from threading import Event, Lock, Thread
+
+from sqlalchemy import (
+    create_engine,
+    Column,
+    Float,
+    Integer,
+    String,
+)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import (
+    Query,
+    sessionmaker,
+)
+from sqlalchemy.pool import StaticPool
+
+from musicbatch.transcoder.encoders import TranscoderConstants
+from musicbatch.transcoder.queue import (
+    TranscodingQueue,
+    TranscodingTask,
+    execute_in_threadqueue,
+)
+
+
+import logging
+log = logging.getLogger(__name__)
+Base = declarative_base()
+
+
+LEDGER_FILENAME = 'transcoding-queue.db'
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 7391
+REPORT_TIMEOUT = 30  # seconds to wait for stage reports from workers after the last task
+DISCONNECTED = (ConnectionError, EOFError)  # coordinator has stopped serving the ledger
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+
+class LedgerTask(Base):
+    __tablename__ = 'tasks'
+
+    id = Column(Integer, primary_key=True)
+    source = Column(String, nullable=False)
+    number = Column(Integer, nullable=False)
+    target_dir = Column(String)
+    state = Column(String, nullable=False, default=PENDING, index=True)
+    worker = Column(String)
+    lease_expires = Column(Float, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String)
+
+
+
+class LedgerInfo(Base):
+    __tablename__ = 'info'
+
+    key = Column(String, primary_key=True)
+    value = Column(String)
+
+
+
+class WorkLedger:
+    '''
+    Durable queue of transcoding tasks with time limited leases.
+
+    Workers lease tasks and must renew their leases with heartbeats. Tasks
+    with expired leases are returned to the queue and may be leased by another
+    worker. All methods are thread safe and return picklable values, so
+    the ledger can be shared over the network (see serve_ledger).
+    '''
+
+
+    def __init__(self, filename=None, lease_time=120, max_attempts=3, clock=time.time):
+        if filename is None:  # all access is serialized, share the in-memory database between threads
+            self.db = create_engine(
+                'sqlite://',
+                connect_args={'check_same_thread': False},
+                poolclass=StaticPool,
+            )
+        else:
+            self.db = create_engine('sqlite:///{}'.format(os.path.abspath(filename)))
+        Base.metadata.create_all(self.db)
+        self.sessionmaker = sessionmaker(bind=self.db)
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.lock = Lock()
+        self.reports = []
+        self.workers = set()  # workers that have asked for tasks
+
+
+    def __repr__(self):
+        return '<{cls}({url})>'.format(
+            cls = self.__class__.__name__,
+            url = self.db.url,
+        )
+
+
+    def prepare(self, config_hash):
+        '''
+        Check if the ledger contains unfinished tasks for the same job
+        configuration. Previous contents are discarded otherwise, so that
+        the next run after a completed one scans the inputs again.
+
+        Return True if the ledger was already filled and may be resumed
+        '''
+        with self.lock, self.session() as session:
+            saved = dict(Query((LedgerInfo.key, LedgerInfo.value)).with_session(session))
+            unfinished = Query(LedgerTask).filter(LedgerTask.state.in_((PENDING, LEASED)))
+            if saved.get('config_hash') == config_hash and saved.get('filled') \
+            and unfinished.with_session(session).first() is not None:
+                resumed = Query(LedgerTask).filter(LedgerTask.state == LEASED)
+                resumed.with_session(session).update(
+                    {LedgerTask.state: PENDING, LedgerTask.worker: None},
+                    synchronize_session=False
+                )
+                return True
+            Query(LedgerTask).with_session(session).delete(synchronize_session=False)
+            Query(LedgerInfo).with_session(session).delete(synchronize_session=False)
+            session.add(LedgerInfo(key='config_hash', value=config_hash))
+            return False
+
+
+    def fill(self, tasks, chunk_size=500):
+        '''Add TranscodingTask objects to the ledger'''
+        chunk = []
+        for task in tasks:
+            chunk.append(LedgerTask(
+                source = task.source,
+                number = task.number,
+                target_dir = task.target_dir,
+                state = PENDING,
+                attempts = 0,
+            ))
+            if len(chunk) >= chunk_size:
+                self._add(chunk)
+                chunk = []
+        self._add(chunk)
+        with self.lock, self.session() as session:
+            session.add(LedgerInfo(key='filled', value='1'))
+
+
+    def _add(self, rows):
+        with self.lock, self.session() as session:
+            session.add_all(rows)
+
+
+    def is_filled(self):
+        with self.lock, self.session() as session:
+            query = Query(LedgerInfo).filter(LedgerInfo.key == 'filled')
+            return query.with_session(session).first() is not None
+
+
+    def settings(self):
+        '''Parameters that workers need to know'''
+        return dict(lease_time=self.lease_time)
+
+
+    def lease(self, worker, count=1):
+        '''Lease up to `count` pending tasks. Return the list of task dictionaries'''
+        now = self.clock()
+        with self.lock, self.session() as session:
+            self.workers.add(worker)
+            self._reclaim(session, now)
+            query = Query(LedgerTask).filter(LedgerTask.state == PENDING)
+            rows = query.with_session(session).order_by(LedgerTask.id).limit(count).all()
+            leased = []
+            for row in rows:
+                row.state = LEASED
+                row.worker = worker
+                row.lease_expires = now + self.lease_time
+                row.attempts += 1
+                leased.append(dict(
+                    id = row.id,
+                    source = row.source,
+                    number = row.number,
+                    target_dir = row.target_dir,
+                ))
+            if leased:
+                log.debug('Leased {} tasks to {}'.format(len(leased), worker))
+            return leased
+
+
+    def heartbeat(self, worker, task_ids):
+        '''
+        Renew leases for the tasks that are being processed by the worker.
+        Return the list of task ids that are no longer leased by this worker
+        '''
+        if not task_ids:
+            return []
+        now = self.clock()
+        with self.lock, self.session() as session:
+            query = Query(LedgerTask).filter(
+                LedgerTask.id.in_(task_ids),
+                LedgerTask.worker == worker,
+                LedgerTask.state == LEASED,
+            )
+            renewed = set()
+            for row in query.with_session(session):
+                row.lease_expires = now + self.lease_time
+                renewed.add(row.id)
+            return [i for i in task_ids if i not in renewed]
+
+
+    def complete(self, worker, task_id, skipped=False):
+        '''Mark task as successfully processed'''
+        self._finish(worker, task_id, SKIPPED if skipped else DONE)
+
+
+    def fail(self, worker, task_id, error=None):
+        '''Return the task to the queue or mark it as failed after too many attempts'''
+        self._finish(worker, task_id, FAILED, error)
+
+
+    def _finish(self, worker, task_id, state, error=None):
+        with self.lock, self.session() as session:
+            row = Query(LedgerTask).filter(LedgerTask.id == task_id).with_session(session).first()
+            if row is None:
+                raise KeyError('unknown task id: {}'.format(task_id))
+            if row.state in {DONE, SKIPPED}:
+                return  # already processed by another worker after lease expiration
+            if state == FAILED and row.state == LEASED and row.worker != worker:
+                return  # lease has expired and the task was given to another worker
+            if state == FAILED and row.attempts < self.max_attempts:
+                state = PENDING
+            row.state = state
+            row.worker = worker
+            row.lease_expires = None
+            row.error = error
+
+
+    def _reclaim(self, session, now):
+        '''Return tasks with expired leases to the queue'''
+        expired = Query(LedgerTask).filter(
+            LedgerTask.state == LEASED,
+            LedgerTask.lease_expires < now,
+        ).with_session(session)
+        for row in expired:
+            log.debug('Lease expired: task {} ({}) held by {}'.format(row.id, row.source, row.worker))
+            if row.attempts >= self.max_attempts:
+                row.state = FAILED
+                row.error = 'lease expired {} times'.format(row.attempts)
+            else:
+                row.state = PENDING
+            row.worker = None
+            row.lease_expires = None
+
+
+    def reclaim(self):
+        '''Return tasks with expired leases to the queue'''
+        with self.lock, self.session() as session:
+            self._reclaim(session, self.clock())
+
+
+    def progress(self):
+        '''Return the number of tasks in each state'''
+        with self.lock, self.session() as session:
+            counts = {state: 0 for state in (PENDING, LEASED, DONE, SKIPPED, FAILED)}
+            query = Query(LedgerTask.state).with_session(session)
+            for state, in query:
+                counts[state] += 1
+            return counts
+
+
+    def finished(self):
+        '''True if all tasks in the ledger have been processed'''
+        if not self.is_filled():
+            return False
+        counts = self.progress()
+        return not counts[PENDING] and not counts[LEASED]
+
+
+    def report(self, worker, stages):
+        '''Receive processing stage timings from a worker that has finished'''
+        with self.lock:
+            self.reports.append((worker, stages))
+
+
+    def unreported(self):
+        '''Return the set of workers that have asked for tasks but have not reported yet'''
+        with self.lock:
+            return self.workers - {worker for worker, stages in self.reports}
+
+
+    def failures(self):
+        '''Return the list of (source, error) for failed tasks'''
+        with self.lock, self.session() as session:
+            query = Query((LedgerTask.source, LedgerTask.error)).filter(LedgerTask.state == FAILED)
+            return [tuple(row) for row in query.with_session(session)]
+
+
+    def failed_tasks(self):
+        '''Return the list of dictionaries describing failed tasks'''
+        with self.lock, self.session() as session:
+            query = Query(LedgerTask).filter(LedgerTask.state == FAILED)
+            return [dict(
+                source = row.source,
+                number = row.number,
+                target_dir = row.target_dir,
+                error = row.error,
+            ) for row in query.with_session(session)]
+
+
+    def succeeded(self, sources):
+        '''Return the set of given sources that have been processed successfully'''
+        sources = list(sources)
+        if not sources:
+            return set()
+        with self.lock, self.session() as session:
+            query = Query(LedgerTask.source).filter(
+                LedgerTask.source.in_(sources),
+                LedgerTask.state.in_((DONE, SKIPPED)),
+            )
+            return {source for source, in query.with_session(session)}
+
+
+    @contextmanager
+    def session(self):
+        '''Context manager for database sessions'''
+        short_session = self.sessionmaker()
+        try:
+            yield short_session
+            short_session.commit()
+        except:
+            short_session.rollback()
+            raise
+        finally:
+            short_session.close()
+
+
+
+class LedgerServerManager(BaseManager):
+    '''Share WorkLedger over network'''
+
+
+
+class LedgerClientManager(BaseManager):
+    '''Connect to WorkLedger shared over network'''
+
+LedgerClientManager.register('ledger')
+
+
+
+def parse_address(address, default_host=DEFAULT_HOST):
+    '''Convert "HOST:PORT" or "PORT" string into address tuple'''
+    if isinstance(address, tuple):
+        return address
+    host, _, port = str(address).rpartition(':')
+    if not port:
+        port = DEFAULT_PORT
+    return (host or default_host, int(port))
+
+
+
+def is_loopback(host):
+    '''True if the host name refers to this machine only'''
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+
+def authkey(job, address=None):
+    '''
+    Shared secret for coordinator and workers.
+
+    Workers must use exactly the same job configuration, so for connections
+    within a single host the secret is derived from it unless
+    MUSICBATCH_AUTHKEY environment variable is set. Anyone who can read the
+    configuration could compute that secret, so MUSICBATCH_AUTHKEY is
+    required for all other addresses
+    '''
+    secret = os.environ.get('MUSICBATCH_AUTHKEY')
+    if not secret:
+        host, port = parse_address(address or DEFAULT_PORT)
+        if not is_loopback(host):
+            raise ValueError(
+                'MUSICBATCH_AUTHKEY environment variable must be set '
+                'for coordinator at non-local address: {}'.format(host)
+            )
+        secret = job.config_hash
+    return secret.encode()
+
+
+
+def serve_ledger(ledger, address, key):
+    '''Start network server for the ledger. Return the running server object'''
+    LedgerServerManager.register('ledger', callable=lambda: ledger)
+    manager = LedgerServerManager(address=parse_address(address), authkey=key)
+    server = manager.get_server()
+    def serve():
+        try:
+            server.serve_forever()
+        except SystemExit:  # raised by server on shutdown
+            pass
+    Thread(target=serve, daemon=True).start()
+    log.debug('Serving {} at {}'.format(ledger, server.address))
+    return server
+
+
+
+def connect_ledger(address, key):
+    '''Connect to the ledger served by coordinator'''
+    manager = LedgerClientManager(address=parse_address(address), authkey=key)
+    manager.connect()
+    return manager.ledger()
+
+
+
+def run_coordinator(job, address, poll_interval=1, report_timeout=REPORT_TIMEOUT, show=print):
+    '''
+    Expand the transcoding queue into a durable ledger and serve it to workers
+    until all tasks are processed and all workers have reported their stage
+    timings (or `report_timeout` seconds have passed after the last task)
+    '''
+    ledger = WorkLedger(os.path.join(job.output_dir, LEDGER_FILENAME))
+    if ledger.prepare(job.config_hash):
+        log.debug('Resuming previous coordinator run')
+        filler = None
+    else:
+        tasks = job.plan(job.stats.timed_iter('scan', TranscodingQueue(job.inputs, job.output_pattern)))
+        filler = Thread(target=ledger.fill, args=(tasks,), daemon=True)
+        filler.start()
+    server = serve_ledger(ledger, address, authkey(job, address))
+    job.stats.start()
+    try:
+        while not ledger.finished():
+            if filler is not None and not filler.is_alive() and not ledger.is_filled():
+                raise RuntimeError('failed to fill the work queue')
+            ledger.reclaim()
+            show(' {pending} pending, {leased} in progress, {done} transcoded, '
+                 '{skipped} skipped, {failed} failed\r'.format(**ledger.progress()), end='')
+            time.sleep(poll_interval)
+        show('')
+    finally:
+        job.stats.stop()
+    counts = ledger.progress()
+    job.stats.record_done(counts[DONE])
+    job.stats.record_skip(counts[SKIPPED])
+    deadline = time.monotonic() + report_timeout
+    while ledger.unreported() and time.monotonic() < deadline:
+        time.sleep(poll_interval)
+    for worker in ledger.unreported():
+        log.warning('No stage report from worker {}'.format(worker))
+    for worker, stages in ledger.reports:
+        for stage, seconds in stages.items():
+            job.stats.timer(stage).add(seconds)
+    for source, error in ledger.failures():
+        log.error('Failed to transcode {}: {}'.format(source, error))
+    journal_results(job, ledger)
+    server.stop_event.set()
+    return ledger
+
+
+
+def journal_results(job, ledger):
+    '''
+    Save failures reported by workers to the journal of the job (workers do
+    not open the database in shared output directory)
+    '''
+    journal = job.journal
+    for failure in ledger.failed_tasks():
+        journal.add(job.config_hash, **failure)
+    for source in ledger.succeeded(job.failing):
+        journal.resolve(job.config_hash, source)
+
+
+
+def run_worker(job, ledger, worker_id=None, idle_delay=5):
+    '''
+    Process tasks leased from the ledger until there is nothing left.
+    Failures are reported to the ledger only, coordinator keeps the journal.
+
+    Tracks of an album may be spread over many workers, so album level
+    processing is not available: album_batch is ignored and only track gain
+    is written with replaygain enabled
+    '''
+    job.keep_journal = False
+    if job.album_batch:
+        log.warning('album_batch is ignored in distributed mode')
+        job.album_batch = None
+    if job.albums is not None:
+        log.warning('Album gain is not written in distributed mode, only track gain')
+        job.albums = None
+    if worker_id is None:
+        worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+    lease_time = ledger.settings()['lease_time']
+    active = set()
+    active_lock = Lock()
+    stopped = Event()
+
+    def heartbeat():
+        while not stopped.wait(lease_time / 3):
+            with active_lock:
+                task_ids = list(active)
+            try:
+                lost_leases = ledger.heartbeat(worker_id, task_ids)
+            except DISCONNECTED:
+                return
+            for lost in lost_leases:
+                log.warning('Lease for task {} was lost by {}'.format(lost, worker_id))
+
+    def tasks():
+        while True:
+            try:
+                leased = ledger.lease(worker_id, job.threads)
+                if not leased and ledger.finished():
+                    return
+            except DISCONNECTED:
+                log.debug('Coordinator has closed the connection, no tasks left for {}'.format(worker_id))
+                return
+            if not leased:
+                time.sleep(idle_delay)
+                continue
+            with active_lock:  # renew leases of the tasks waiting in queue too
+                active.update(record['id'] for record in leased)
+            for record in leased:
+                task = TranscodingTask(
+                    filename = record['source'],
+                    pattern = job.output_pattern,
+                    seq_number = record['number'],
+                    target_dir = record['target_dir'],
+                )
+                task.ledger_id = record['id']
+                yield task
+
+    def process(task):
+        try:
+            if job.transcode(task):
+                skipped = task.result is None or task.status is TranscoderConstants.STATUS_SKIP
+                ledger.complete(worker_id, task.ledger_id, skipped)
+            else:
+                ledger.fail(worker_id, task.ledger_id, job.failures.get(task.source))
+        finally:
+            with active_lock:
+                active.discard(task.ledger_id)
+
+    beat = Thread(target=heartbeat, daemon=True)
+    beat.start()
+    job.stats.start()
+    try:
+        execute_in_threadqueue(
+            process,
+            job.track(tasks()),
+            num_threads=job.threads,
+            buffer_size=job.threads,
+            **job.callbacks
+        )
+    finally:
+        job.flush()
+        stopped.set()
+        job.stats.stop()
+    try:
+        ledger.report(worker_id, job.stats.stages)
+    except DISCONNECTED:
+        log.warning('Coordinator has stopped before receiving stage report from {}'.format(worker_id))
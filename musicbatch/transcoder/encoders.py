@@ -5,10 +5,9 @@ Workers for transcoding music into different target formats
 
 import os
 import re
+import subprocess
 from shutil import copyfile
 
-from pydub import AudioSegment
-
 from musicbatch.transcoder.util import (
     make_target_directory,
     skip_action,
@@ -33,6 +32,12 @@ class TranscoderConstants:
 class Transcoder(TranscoderConstants):
     '''Generic base class for transcoders'''
 
+    # Approximate average bitrates (kbit/s) for VBR quality settings (-aq)
+    QUALITY_BITRATES = {}
+
+    # Optional callback that receives decoded audio: on_decode(input_filename, AudioSegment)
+    on_decode = None
+
 
     def __init__(self, quality=None, *a, **ka):
         self.export_params = self.configure(quality, *a, **ka)
@@ -50,25 +55,90 @@ class Transcoder(TranscoderConstants):
         raise NotImplementedError
 
 
-    def __call__(self, input_filename, output_filename):
-        '''Transcode file from one format to another'''
+    def target_filename(self, input_filename, output_filename):
+        '''Full path to the file that will be created for output_filename'''
         extension = '.' + self.extension.lower()
         if not output_filename.lower().endswith(extension):
             output_filename += extension
+        return output_filename
+
+
+    @property
+    def bitrate(self):
+        '''Expected average bitrate of the encoded audio (in kbit/s)'''
+        parameters = self.export_params.get('parameters', [])
+        options = dict(zip(parameters[::2], parameters[1::2]))
+        if '-ab' in options:
+            return int(options['-ab'].rstrip('kK'))
+        if '-aq' in options:
+            return self.QUALITY_BITRATES[int(options['-aq'])]
+        raise ValueError('Can not determine bitrate for {}'.format(self))
+
+
+    def estimate_size(self, duration, source_size=None):
+        '''Estimate the size of transcoded file (in bytes)'''
+        return int(duration * self.bitrate * 1000 / 8)
+
+
+    def __call__(self, input_filename, output_filename):
+        '''Transcode file from one format to another'''
+        output_filename = self.target_filename(input_filename, output_filename)
 
         make_target_directory(output_filename)
         if not skip_action(input_filename, output_filename):
+            from pydub import AudioSegment
             # ffmpeg format names usually match extension
             input_format = os.path.splitext(input_filename)[1][1:].lower()
-            AudioSegment \
-                .from_file(input_filename, input_format) \
-                .export(output_filename, **self.export_params)
+            audio = AudioSegment.from_file(input_filename, input_format)
+            if self.on_decode is not None:
+                self.on_decode(input_filename, audio)
+            audio.export(output_filename, **self.export_params)
             status = self.STATUS_OK
         else:
             status = self.STATUS_SKIP
         return output_filename, status
 
 
+    def transcode_batch(self, pairs):
+        '''
+        Transcode several files with a single encoder process.
+
+        Accept a list of (input_filename, output_filename) pairs. Return a list
+        of (output_filename, status) in the same order. Status is None for the
+        files that were not transcoded: the whole batch is discarded if
+        encoder fails, so that the files can be transcoded one by one.
+        '''
+        from pydub.utils import get_encoder_name
+        command = [get_encoder_name(), '-y', '-nostdin', '-loglevel', 'error']
+        for input_filename, output_filename in pairs:
+            command.extend(['-i', input_filename])
+        outputs = []
+        for index, (input_filename, output_filename) in enumerate(pairs):
+            output_filename = self.target_filename(input_filename, output_filename)
+            make_target_directory(output_filename)
+            command.extend(['-map', '{}:a:0'.format(index), '-map_metadata', '-1'])
+            command.extend(['-acodec', self.export_params['codec']])
+            command.extend(self.export_params.get('parameters', []))
+            command.extend(['-f', self.export_params['format'], output_filename])
+            outputs.append(output_filename)
+        try:
+            process = subprocess.run(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            failed = process.returncode != 0
+        except OSError:
+            failed = True
+        if failed:
+            for output_filename in outputs:
+                if os.path.exists(output_filename):
+                    os.remove(output_filename)
+            return [(output_filename, None) for output_filename in outputs]
+        return [(output_filename, self.STATUS_OK) for output_filename in outputs]
+
+
     def __repr__(self):
         return '<{cls}(quality={quality!r})>'.format(
             cls = self.__class__.__name__,
@@ -80,6 +150,10 @@ class Transcoder(TranscoderConstants):
 class VorbisTranscoder(Transcoder):
     '''Transcoder for Ogg Vorbis target'''
     valid_quality = re.compile(r'^q\s*([0-9]0?)$')
+    QUALITY_BITRATES = {
+        0: 64, 1: 80, 2: 96, 3: 112, 4: 128, 5: 160,
+        6: 192, 7: 224, 8: 256, 9: 320, 10: 500,
+    }
 
 
     def configure(self, quality, *a, **ka):
@@ -100,6 +174,10 @@ class VorbisTranscoder(Transcoder):
 class LameTranscoder(Transcoder):
     '''Transcoder for LAME MP3 target'''
     valid_quality = re.compile(r'^V\s*([0-9])$', re.IGNORECASE)
+    QUALITY_BITRATES = {
+        0: 245, 1: 225, 2: 190, 3: 175, 4: 165,
+        5: 130, 6: 115, 7: 100, 8: 85, 9: 65,
+    }
 
 
     def configure(self, quality, *a, **ka):
@@ -173,10 +251,21 @@ class VerbatimFileCopy(TranscoderConstants):
         pass
 
 
-    def __call__(self, input_filename, output_filename):
+    def estimate_size(self, duration, source_size=None):
+        '''Copy has the same size as the source file'''
+        return source_size or 0
+
+
+    def target_filename(self, input_filename, output_filename):
+        '''Full path to the file that will be created for output_filename'''
         extension = '.' + os.path.splitext(input_filename)[1][1:].lower()
         if not output_filename.lower().endswith(extension):
             output_filename += extension
+        return output_filename
+
+
+    def __call__(self, input_filename, output_filename):
+        output_filename = self.target_filename(input_filename, output_filename)
         make_target_directory(output_filename)
         if not skip_action(input_filename, output_filename):
             copyfile(input_filename, output_filename)
@@ -202,10 +291,13 @@ class SymlinkCreator(VerbatimFileCopy):
     (e.g. torrents directory)
     '''
 
+    def estimate_size(self, duration, source_size=None):
+        '''Symlinks take (almost) no space'''
+        return 0
+
+
     def __call__(self, input_filename, output_filename):
-        extension = os.path.splitext(input_filename)[1].lower()
-        if not output_filename.lower().endswith(extension):
-            output_filename += extension
+        output_filename = self.target_filename(input_filename, output_filename)
         make_target_directory(output_filename)
         if not skip_action(input_filename, output_filename):
             if os.path.exists(output_filename):
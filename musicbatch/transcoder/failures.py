@@ -0,0 +1,193 @@
+'''
+Persistent journal of failed transcoding tasks
+'''
+
+
+import errno
+import os
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+
+from sqlalchemy import (
+    create_engine,
+    Column,
+    DateTime,
+    Integer,
+    String,
+    Text,
+)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import (
+    Query,
+    sessionmaker,
+)
+
+from musicbatch.transcoder.queue import TranscodingTask
+
+
+
+log = logging.getLogger(__name__)
+Base = declarative_base()
+
+
+OUTPUT_LINES = 20  # tail of encoder output saved to journal
+TRANSIENT_ERRORS = {
+    errno.EAGAIN,
+    errno.EBUSY,
+    errno.EINTR,
+    errno.EIO,
+    errno.ENETDOWN,
+    errno.ENETRESET,
+    errno.ENETUNREACH,
+    errno.ESTALE,
+    errno.ETIMEDOUT,
+}
+
+
+
+class Failure(Base):
+    __tablename__ = 'failures'
+
+    id = Column(Integer, primary_key=True)
+    config_hash = Column(String, index=True, nullable=False)
+    source = Column(String, nullable=False)
+    number = Column(Integer)
+    target_dir = Column(String)
+    error = Column(String)
+    output = Column(Text)  # tail of ffmpeg stderr or full error message
+    attempts = Column(Integer, nullable=False, default=0)
+    last_failed = Column(DateTime)
+
+
+
+class FailureJournal:
+    '''
+    Keep a record of transcoding tasks that have failed, so that they can be
+    retried without scanning all input directories again.
+
+    A task is removed from the journal when it succeeds.
+    '''
+
+
+    def __init__(self, filename=None):
+        if filename is None:
+            url = 'sqlite://'
+        else:
+            url = 'sqlite:///{}'.format(os.path.abspath(filename))
+        self.db = create_engine(url)
+        Base.metadata.create_all(self.db)
+        self.sessionmaker = sessionmaker(bind=self.db, expire_on_commit=False)
+        self.lock = Lock()
+
+
+    def __repr__(self):
+        return '<{cls}({url})>'.format(
+            cls = self.__class__.__name__,
+            url = self.db.url,
+        )
+
+
+    def record(self, config_hash, task, exception):
+        '''Save the failure of the task, return Failure object'''
+        return self.add(
+            config_hash,
+            source = task.source,
+            number = task.number,
+            target_dir = task.album.target_dir,
+            error = describe(exception),
+            output = output_tail(exception),
+        )
+
+
+    def add(self, config_hash, source, number, target_dir, error, output=None):
+        '''Save the failure reported by other process (e.g. distributed worker)'''
+        with self.lock, self.session() as session:
+            failure = Query(Failure).with_session(session).filter(
+                Failure.config_hash == config_hash,
+                Failure.source == source,
+            ).first()
+            if failure is None:
+                failure = Failure(config_hash=config_hash, source=source, attempts=0)
+                session.add(failure)
+            failure.number = number
+            failure.target_dir = target_dir
+            failure.error = error
+            failure.output = output
+            failure.attempts += 1
+            failure.last_failed = datetime.utcnow()
+        return failure
+
+
+    def resolve(self, config_hash, source):
+        '''Remove the task from journal after it has succeeded'''
+        with self.lock, self.session() as session:
+            Query(Failure).with_session(session).filter(
+                Failure.config_hash == config_hash,
+                Failure.source == source,
+            ).delete()
+
+
+    def failures(self, config_hash):
+        '''Return the list of failures for the job configuration'''
+        with self.session() as session:
+            return Query(Failure).with_session(session).filter(
+                Failure.config_hash == config_hash,
+            ).order_by(Failure.source).all()
+
+
+    def tasks(self, config_hash, pattern):
+        '''Recreate transcoding tasks for the recorded failures'''
+        for failure in self.failures(config_hash):
+            if not os.path.exists(failure.source):
+                log.warning('Source file is gone: {}'.format(failure.source))
+                self.resolve(config_hash, failure.source)
+                continue
+            yield TranscodingTask(
+                filename = failure.source,
+                pattern = pattern,
+                seq_number = failure.number or 1,
+                target_dir = failure.target_dir,
+            )
+
+
+    @contextmanager
+    def session(self):
+        '''Context manager for database sessions'''
+        short_session = self.sessionmaker()
+        try:
+            yield short_session
+            short_session.commit()
+        except:
+            short_session.rollback()
+            raise
+        finally:
+            short_session.close()
+
+
+
+def is_transient(exception):
+    '''Check if the error is likely to go away on retry (e.g. NFS hiccup)'''
+    return isinstance(exception, OSError) and exception.errno in TRANSIENT_ERRORS
+
+
+
+def describe(exception):
+    '''Short one line description of the exception'''
+    message = str(exception).strip().splitlines()
+    return '{}: {}'.format(
+        exception.__class__.__name__,
+        message[0] if message else '',
+    )
+
+
+
+def output_tail(exception, lines=OUTPUT_LINES):
+    '''Return the tail of encoder output (or of error message)'''
+    output = getattr(exception, 'stderr', None)
+    if isinstance(output, bytes):
+        output = output.decode(errors='replace')
+    if not output:
+        output = str(exception)  # pydub includes ffmpeg output into message
+    return '\n'.join(output.strip().splitlines()[-lines:])
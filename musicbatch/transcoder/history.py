@@ -0,0 +1,233 @@
+'''
+Structured journal of transcoder runs
+'''
+
+
+import os
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from statistics import median
+
+from sqlalchemy import (
+    create_engine,
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    JSON,
+    String,
+)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import (
+    Query,
+    sessionmaker,
+)
+
+
+
+log = logging.getLogger(__name__)
+Base = declarative_base()
+
+
+HISTORY_FILENAME = 'transcoding.db'
+
+
+
+class Run(Base):
+    __tablename__ = 'runs'
+
+    id = Column(Integer, primary_key=True)
+    job = Column(String)
+    config_hash = Column(String, index=True)
+    encoder = Column(String)
+    threads = Column(Integer)
+    started = Column(DateTime, nullable=False)
+    duration = Column(Float, nullable=False)
+    done = Column(Integer, nullable=False)
+    skipped = Column(Integer, nullable=False)
+    stages = Column(JSON)
+
+
+    @property
+    def total(self):
+        '''Total number of tasks processed'''
+        return self.done + self.skipped
+
+
+    @property
+    def throughput(self):
+        '''Number of transcoded files per second'''
+        if not self.duration:
+            return 0.0
+        return self.done / self.duration
+
+
+    def stage_cost(self, stage):
+        '''Average time spent in a processing stage per transcoded file'''
+        if not self.done:
+            return 0.0
+        return (self.stages or {}).get(stage, 0.0) / self.done
+
+
+
+class RunHistory:
+    '''Persistent storage for transcoder run records'''
+
+
+    def __init__(self, filename=None):
+        if filename is None:
+            url = 'sqlite://'
+        else:
+            url = 'sqlite:///{}'.format(os.path.abspath(filename))
+        self.db = create_engine(url)
+        Base.metadata.create_all(self.db)
+        self.sessionmaker = sessionmaker(bind=self.db, expire_on_commit=False)
+
+
+    def record(self, job):
+        '''Save the statistics of a finished TranscodingJob'''
+        stats = job.stats
+        run = Run(
+            job = job.job_id,
+            config_hash = job.config_hash,
+            encoder = repr(job.transcoder),
+            threads = job.threads,
+            started = datetime.utcfromtimestamp(stats.started or 0),
+            duration = stats.elapsed,
+            done = stats.done,
+            skipped = stats.skipped,
+            stages = stats.stages,
+        )
+        with self.session() as session:
+            session.add(run)
+        log.debug('Recorded transcoder run: {}'.format(run.id))
+        return run
+
+
+    def runs(self, config_hash=None):
+        '''Return the list of recorded runs in chronological order'''
+        with self.session() as session:
+            query = Query(Run)
+            if config_hash is not None:
+                query = query.filter(Run.config_hash == config_hash)
+            return query.with_session(session).order_by(Run.started, Run.id).all()
+
+
+    def compare(self, config_hash=None, threshold=0.1, window=5):
+        '''
+        Compare each run with the median of previous comparable runs.
+
+        Runs are comparable if they share the configuration hash and have
+        transcoded at least one file. Return the list of RunComparison objects.
+        '''
+        baseline = {}
+        results = []
+        for run in self.runs(config_hash):
+            previous = baseline.setdefault(run.config_hash, [])
+            results.append(RunComparison(run, previous[-window:], threshold))
+            if run.done:
+                previous.append(run)
+        return results
+
+
+    @contextmanager
+    def session(self):
+        '''Context manager for database sessions'''
+        short_session = self.sessionmaker()
+        try:
+            yield short_session
+            short_session.commit()
+        except:
+            short_session.rollback()
+            raise
+        finally:
+            short_session.close()
+
+
+
+class RunComparison:
+    '''Comparison of a single run against the baseline of previous runs'''
+
+
+    def __init__(self, run, baseline, threshold=0.1):
+        self.run = run
+        self.baseline = baseline
+        self.threshold = threshold
+
+
+    @property
+    def baseline_throughput(self):
+        if not self.baseline:
+            return None
+        return median(r.throughput for r in self.baseline)
+
+
+    @property
+    def change(self):
+        '''Relative throughput change compared to baseline'''
+        baseline = self.baseline_throughput
+        if not baseline or not self.run.done:
+            return None
+        return self.run.throughput / baseline - 1
+
+
+    @property
+    def regression(self):
+        '''True if throughput has dropped more than the threshold allows'''
+        change = self.change
+        return change is not None and change < -self.threshold
+
+
+    def stage_changes(self):
+        '''
+        Change of per-file time spent in each stage compared to baseline.
+        Largest slowdowns go first.
+        '''
+        if not self.baseline or not self.run.done:
+            return []
+        stages = set(self.run.stages or {})
+        for run in self.baseline:
+            stages.update(run.stages or {})
+        changes = []
+        for stage in stages:
+            before = median(r.stage_cost(stage) for r in self.baseline)
+            after = self.run.stage_cost(stage)
+            changes.append((stage, after - before, before, after))
+        changes.sort(key=lambda x: x[1], reverse=True)
+        return changes
+
+
+    @property
+    def culprit(self):
+        '''Name of the stage that has slowed down the most'''
+        for stage, delta, before, after in self.stage_changes():
+            if delta > 0:
+                return stage
+
+
+    def show(self):
+        run = self.run
+        line = '{time}Z: {total: 5d} files ({done} transcoded) in {duration:.1f}s, {speed:.2f} files/s'.format(
+            time = run.started.replace(microsecond=0),
+            total = run.total,
+            done = run.done,
+            duration = run.duration,
+            speed = run.throughput,
+        )
+        change = self.change
+        if change is not None:
+            line += ' ({:+.0%} vs baseline)'.format(change)
+        if self.regression:
+            culprit = self.culprit
+            line += ' REGRESSION'
+            if culprit:
+                for stage, delta, before, after in self.stage_changes():
+                    if stage == culprit:
+                        break
+                line += ': {stage} {before:.3f}s -> {after:.3f}s per file'.format(
+                    stage = stage,
+                    before = before,
+                    after = after,
+                )
+        return line
@@ -0,0 +1,263 @@
+'''
+Loudness analysis (EBU R128) and ReplayGain tags for transcoded files
+'''
+
+
+import math
+from functools import lru_cache
+from threading import Lock
+
+import numpy as np
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+REFERENCE_LOUDNESS = -18.0  # LUFS, ReplayGain 2.0
+OPUS_REFERENCE_LOUDNESS = -23.0  # LUFS, R128_*_GAIN tags in Opus files (RFC 7845)
+
+BLOCK_STEP = 0.1  # seconds, gating blocks of 400ms overlap by 75%
+BLOCK_STEPS = 4
+ABSOLUTE_GATE = -70.0  # LUFS
+RELATIVE_GATE = -10.0  # LU
+
+FILTER_SIZE = 2**16  # FFT size for K-weighting filter
+CHUNK_FRAMES = 2**16  # audio frames converted to floating point at once
+
+CHANNEL_WEIGHTS = {  # FFmpeg channel order: L R C LFE Ls Rs
+    5: (1.0, 1.0, 1.0, 1.41, 1.41),
+    6: (1.0, 1.0, 1.0, 0.0, 1.41, 1.41),
+}
+
+
+
+@lru_cache(maxsize=None)
+def k_weighting(rate):
+    '''
+    Impulse response of ITU-R BS.1770 K-weighting filter (high shelf followed
+    by high pass) for the sample rate. The IIR filter is truncated to a FIR
+    one: its response decays below float precision within a few hundred ms
+    '''
+    # Pre-filter coefficients as in libebur128, valid for any sample rate
+    K = math.tan(math.pi * 1681.974450955533 / rate)
+    Q = 0.7071752369554196
+    Vh = 10 ** (3.999843853973347 / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / Q + K * K
+    shelf_b = [(Vh + Vb * K / Q + K * K) / a0, 2 * (K * K - Vh) / a0, (Vh - Vb * K / Q + K * K) / a0]
+    shelf_a = [1.0, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0]
+
+    K = math.tan(math.pi * 38.13547087602444 / rate)
+    Q = 0.5003270373238773
+    a0 = 1 + K / Q + K * K
+    highpass_b = [1.0, -2.0, 1.0]
+    highpass_a = [1.0, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0]
+
+    b = np.convolve(shelf_b, highpass_b)
+    a = np.convolve(shelf_a, highpass_a)
+    response = np.fft.rfft(b, FILTER_SIZE) / np.fft.rfft(a, FILTER_SIZE)
+    return np.fft.irfft(response, FILTER_SIZE)[:FILTER_SIZE // 4]
+
+
+
+class LoudnessMeter:
+    '''
+    Streaming loudness meter for a single track.
+
+    Audio is fed in chunks of floating point samples shaped (frames, channels).
+    K-weighting is applied with FFT convolution (overlap-save), the energy of
+    filtered signal is accumulated in 100ms steps
+    '''
+
+    def __init__(self, rate, channels):
+        self.rate = rate
+        self.channels = channels
+        self.weights = np.array(CHANNEL_WEIGHTS.get(channels, (1.0,) * channels))
+        impulse = k_weighting(rate)
+        self.overlap = len(impulse) - 1
+        self.hop = FILTER_SIZE - self.overlap
+        self.response = np.fft.rfft(impulse, FILTER_SIZE)[:, None]
+        self.history = np.zeros((self.overlap, channels))
+        self.step = max(1, int(round(rate * BLOCK_STEP)))
+        self.remainder = np.zeros((0, channels))
+        self.steps = []  # weighted mean square of each 100ms step
+        self.peak = 0.0
+
+
+    def __repr__(self):
+        return '<{cls}({rate}Hz, {channels}ch)>'.format(
+            cls = self.__class__.__name__,
+            rate = self.rate,
+            channels = self.channels,
+        )
+
+
+    def feed(self, samples):
+        '''Process a chunk of audio samples'''
+        if not len(samples):
+            return
+        self.peak = max(self.peak, float(np.abs(samples).max()))
+        for start in range(0, len(samples), self.hop):
+            self._filter(samples[start:start + self.hop])
+
+
+    def _filter(self, samples):
+        extended = np.concatenate((self.history, samples))
+        self.history = extended[-self.overlap:]
+        if len(extended) < FILTER_SIZE:
+            extended = np.concatenate((extended, np.zeros((FILTER_SIZE - len(extended), self.channels))))
+        filtered = np.fft.irfft(np.fft.rfft(extended, axis=0) * self.response, FILTER_SIZE, axis=0)
+        self._accumulate(filtered[self.overlap:self.overlap + len(samples)])
+
+
+    def _accumulate(self, filtered):
+        squared = np.concatenate((self.remainder, filtered ** 2))
+        complete = len(squared) // self.step * self.step
+        if complete:
+            means = squared[:complete].reshape(-1, self.step, self.channels).mean(axis=1)
+            self.steps.extend(means @ self.weights)
+        self.remainder = squared[complete:]
+
+
+    @property
+    def blocks(self):
+        '''Energy of 400ms gating blocks'''
+        steps = np.asarray(self.steps)
+        if len(steps) < BLOCK_STEPS:
+            return np.zeros(0)
+        return np.lib.stride_tricks.sliding_window_view(steps, BLOCK_STEPS).mean(axis=1)
+
+
+    @property
+    def loudness(self):
+        '''Integrated loudness of the track (LUFS)'''
+        return integrated_loudness(self.blocks)
+
+
+
+def block_loudness(energy):
+    with np.errstate(divide='ignore'):
+        return -0.691 + 10 * np.log10(energy)
+
+
+
+def integrated_loudness(blocks):
+    '''
+    Gated loudness of the energy blocks (LUFS).
+    Return None if there is no audible signal
+    '''
+    blocks = blocks[block_loudness(blocks) > ABSOLUTE_GATE]
+    if not len(blocks):
+        return None
+    threshold = block_loudness(blocks.mean()) + RELATIVE_GATE
+    blocks = blocks[block_loudness(blocks) > threshold]
+    return float(block_loudness(blocks.mean()))
+
+
+
+def to_float(raw, sample_width, channels):
+    '''Convert interleaved PCM bytes to floating point array shaped (frames, channels)'''
+    if sample_width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 3:
+        data = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = (data[:, 0] | data[:, 1] << 8 | data[:, 2] << 16) << 8 >> 8  # sign extension
+        samples = samples.astype(np.float32) / 2**23
+    else:
+        dtype = np.dtype('<i{}'.format(sample_width))
+        samples = np.frombuffer(raw, dtype=dtype).astype(np.float32) / 2**(8 * sample_width - 1)
+    return samples.reshape(-1, channels)
+
+
+
+def measure(segment):
+    '''Measure the loudness of pydub AudioSegment'''
+    meter = LoudnessMeter(segment.frame_rate, segment.channels)
+    raw = memoryview(segment.raw_data)
+    chunk = CHUNK_FRAMES * segment.frame_width
+    for start in range(0, len(raw), chunk):
+        meter.feed(to_float(raw[start:start + chunk], segment.sample_width, segment.channels))
+    return meter
+
+
+
+class LoudnessAnalysis:
+    '''
+    Collect loudness measurements of the tracks decoded by transcoder and
+    produce ReplayGain tags for them.
+
+    Track tags are available as soon as the track is decoded, album tags
+    require the measurements of all the tracks from the source directory
+    '''
+
+    def __init__(self):
+        self.meters = {}  # source filename -> LoudnessMeter
+        self.lock = Lock()
+
+
+    def __repr__(self):
+        return '<{cls}({count} tracks)>'.format(
+            cls = self.__class__.__name__,
+            count = len(self.meters),
+        )
+
+
+    def analyze(self, source, segment):
+        '''Measure the decoded audio of the source file'''
+        meter = measure(segment)
+        with self.lock:
+            self.meters[source] = meter
+
+
+    def discard(self, source):
+        '''Forget the measurements for the source file'''
+        with self.lock:
+            self.meters.pop(source, None)
+
+
+    def track_tags(self, source, opus=False):
+        '''ReplayGain tags for a single track'''
+        meter = self.meters.get(source)
+        if meter is None:
+            return {}
+        return gain_tags('track', meter.loudness, meter.peak, opus)
+
+
+    def album_tags(self, sources, opus=False):
+        '''
+        ReplayGain tags for the album that consists of the source files.
+        Return an empty dict unless all the tracks were measured
+        '''
+        meters = [self.meters.get(source) for source in sources]
+        if not meters or None in meters:
+            return {}
+        loudness = integrated_loudness(np.concatenate([meter.blocks for meter in meters]))
+        return gain_tags('album', loudness, max(meter.peak for meter in meters), opus)
+
+
+
+def gain_tags(scope, loudness, peak, opus=False):
+    '''Format ReplayGain tags for the track or album'''
+    if loudness is None:
+        return {}
+    tags = {
+        'replaygain_{}_gain'.format(scope): '{:.2f} dB'.format(REFERENCE_LOUDNESS - loudness),
+        'replaygain_{}_peak'.format(scope): '{:.6f}'.format(peak),
+    }
+    if opus:  # Q7.8 fixed point relative to -23 LUFS
+        tags['r128_{}_gain'.format(scope)] = str(int(round((OPUS_REFERENCE_LOUDNESS - loudness) * 256)))
+    return tags
+
+
+
+def register_tags():
+    '''Make mutagen's easy interfaces accept ReplayGain tags as plain text'''
+    from mutagen.easyid3 import EasyID3
+    from mutagen.easymp4 import EasyMP4Tags
+    for scope in ('track', 'album'):
+        for kind in ('gain', 'peak'):
+            key = 'replaygain_{}_{}'.format(scope, kind)
+            EasyID3.RegisterTXXXKey(key, key.upper())
+            EasyMP4Tags.RegisterFreeformKey(key, key)
@@ -0,0 +1,132 @@
+'''
+Read source files ahead of the encoder
+'''
+
+
+import os
+from collections import OrderedDict
+from queue import Queue
+from threading import Lock, Thread
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+class SourcePrefetcher:
+    '''
+    Warm up page cache for the source files of upcoming transcoding tasks.
+
+    Attach to execute_in_threadqueue via on_queue/on_start callbacks. Up to
+    `lookahead` tasks that are waiting in the queue are prefetched as long as
+    their total size fits into `budget` bytes. Reservation is released when the
+    encoder picks up the task.
+
+    Prefetching is done either with posix_fadvise(WILLNEED) hint that makes the
+    kernel read the file in background, or by reading the file sequentially
+    in a background thread (useful for network filesystems that ignore the
+    hint).
+    '''
+
+    CHUNK_SIZE = 1024 * 1024
+
+
+    def __init__(self, lookahead=4, budget=256 * 1024**2, method='fadvise'):
+        if method == 'fadvise' and not hasattr(os, 'posix_fadvise'):
+            method = 'read'
+        if method not in {'fadvise', 'read'}:
+            raise ValueError('unknown prefetch method: {}'.format(method))
+        self.lookahead = lookahead
+        self.budget = budget
+        self.method = method
+        self.waiting = OrderedDict()  # task id -> (path, reserved bytes or None)
+        self.reserved = 0
+        self.prefetched = 0  # total bytes
+        self.lock = Lock()
+        self.reader = None
+        if method == 'read':
+            self.reads = Queue()
+            self.reader = Thread(target=self._read_forever, daemon=True)
+            self.reader.start()
+
+
+    def __repr__(self):
+        return '<{cls}(lookahead={lookahead}, budget={budget}, method={method!r})>'.format(
+            cls = self.__class__.__name__,
+            lookahead = self.lookahead,
+            budget = self.budget,
+            method = self.method,
+        )
+
+
+    def queued(self, task):
+        '''Callback for tasks entering the queue'''
+        with self.lock:
+            self.waiting[id(task)] = (task.source, None)
+            self._schedule()
+
+
+    def started(self, task):
+        '''Callback for tasks picked up by encoder'''
+        with self.lock:
+            path, reserved = self.waiting.pop(id(task), (None, None))
+            if reserved:
+                self.reserved -= reserved
+            self._schedule()
+
+
+    def _schedule(self):
+        '''Prefetch the next tasks in line while the budget allows it'''
+        for position, (key, (path, reserved)) in enumerate(self.waiting.items()):
+            if position >= self.lookahead:
+                break
+            if reserved is not None:
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            if self.reserved and self.reserved + size > self.budget:
+                break
+            self.reserved += size
+            self.prefetched += size
+            self.waiting[key] = (path, size)
+            if self.method == 'fadvise':
+                self._advise(path)
+            else:
+                self.reads.put((key, path))
+
+
+    def _advise(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            log.debug('Prefetch failed for {}: {}'.format(path, e))
+
+
+    def _read_forever(self):
+        while True:
+            key, path = self.reads.get()
+            try:
+                with open(path, 'rb', buffering=0) as f:
+                    while key in self.waiting:  # stop when encoder has started
+                        if not f.read(self.CHUNK_SIZE):
+                            break
+            except OSError as e:
+                log.debug('Prefetch failed for {}: {}'.format(path, e))
+
+
+
+def warm_up(path, chunk_size=SourcePrefetcher.CHUNK_SIZE):
+    '''Read the file sequentially to load it into page cache'''
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            while f.read(chunk_size):
+                pass
+    except OSError as e:
+        log.debug('Prefetch failed for {}: {}'.format(path, e))
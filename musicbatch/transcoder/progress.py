@@ -3,8 +3,10 @@ Show progress of the transcoding job
 '''
 
 
+from contextlib import contextmanager
+from functools import wraps
 from threading import Lock, Thread
-from time import sleep
+from time import perf_counter, sleep, time
 
 
 
@@ -33,14 +35,59 @@ class ThreadSafeCounter:
 
 
 
+class ThreadSafeTimer:
+    '''
+    Accumulate the time spent in a single processing stage by multiple threads
+    '''
+
+    def __init__(self):
+        self.value = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+
+    def add(self, seconds):
+        with self.lock:
+            self.value += seconds
+            self.count += 1
+            return self.value
+
+
+    @contextmanager
+    def measure(self):
+        '''Measure the duration of the code block'''
+        start = perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(perf_counter() - start)
+
+
+    def __str__(self):
+        return '{:.3f}s'.format(self.value)
+
+
+    def __format__(self, *a, **ka):
+        return str(self).__format__(*a, **ka)
+
+
+
 class TranscodingStats:
     '''
     Numberic statistics of the transcoding job
     '''
 
+    STAGES = ('scan', 'transcode', 'tags', 'cover', 'lyrics')
+
+
     def __init__(self):
         self._done = ThreadSafeCounter()
         self._skipped = ThreadSafeCounter()
+        self._failed = ThreadSafeCounter()
+        self._timers = {stage: ThreadSafeTimer() for stage in self.STAGES}
+        self._timers_lock = Lock()
+        self.started = None
+        self.finished = None
 
 
     def __repr__(self):
@@ -52,17 +99,18 @@ class TranscodingStats:
 
 
     def show(self):
-        return '{total: 5d} files processed ({done} transcoded, {skip} skipped)'.format(
+        return '{total: 5d} files processed ({done} transcoded, {skip} skipped{failed})'.format(
             total = self.total,
             done = self.done,
             skip = self.skipped,
+            failed = ', {} failed'.format(self.failed) if self.failed else '',
         )
 
 
     @property
     def total(self):
         '''Total number of tasks processed'''
-        return self.done + self.skipped
+        return self.done + self.skipped + self.failed
 
 
     @property
@@ -77,14 +125,90 @@ class TranscodingStats:
         return self._skipped.value
 
 
-    def record_skip(self):
+    @property
+    def failed(self):
+        '''Number of failed tasks'''
+        return self._failed.value
+
+
+    def record_skip(self, number=1):
         '''Record a skipped task'''
-        self._skipped.increment()
+        self._skipped.increment(number)
 
 
-    def record_done(self):
+    def record_done(self, number=1):
         '''Record a finished task'''
-        self._done.increment()
+        self._done.increment(number)
+
+
+    def record_failure(self, number=1):
+        '''Record a failed task'''
+        self._failed.increment(number)
+
+
+    def start(self):
+        '''Record the start of the transcoding job'''
+        self.started = time()
+
+
+    def stop(self):
+        '''Record the end of the transcoding job'''
+        self.finished = time()
+
+
+    @property
+    def elapsed(self):
+        '''Wall clock duration of the transcoding job (in seconds)'''
+        if self.started is None:
+            return 0.0
+        return (self.finished or time()) - self.started
+
+
+    @property
+    def throughput(self):
+        '''Number of transcoded files per second of wall clock time'''
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0.0
+        return self.done / elapsed
+
+
+    def timer(self, stage):
+        '''Return the timer object for a processing stage'''
+        try:
+            return self._timers[stage]
+        except KeyError:
+            with self._timers_lock:
+                return self._timers.setdefault(stage, ThreadSafeTimer())
+
+
+    def timed(self, stage, function):
+        '''Wrap the function to record its execution time as a processing stage'''
+        timer = self.timer(stage)
+        @wraps(function)
+        def wrapper(*a, **ka):
+            with timer.measure():
+                return function(*a, **ka)
+        return wrapper
+
+
+    def timed_iter(self, stage, iterable):
+        '''Record the time spent on producing the values of an iterable'''
+        timer = self.timer(stage)
+        iterator = iter(iterable)
+        while True:
+            with timer.measure():
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+    @property
+    def stages(self):
+        '''Time spent in each processing stage (in seconds)'''
+        return {stage: timer.value for stage, timer in self._timers.items()}
 
 
 
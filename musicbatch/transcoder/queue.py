@@ -4,12 +4,10 @@ Non-greedy queueing of transcoding tasks
 
 
 import os
-from queue import Queue
-from threading import Thread
+import sys
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
 
-import mutagen
-
-from hods import Metadata, TreeStructuredData
 from musicbatch.metadata import METADATA_YAML
 from musicbatch.transcoder.util import find_music, safe_filename
 
@@ -20,7 +18,8 @@ log = logging.getLogger(__name__)
 
 
 def execute_in_threadqueue(function, args_seq,
-                           num_threads=None, buffer_size=None, break_value=None):
+                           num_threads=None, buffer_size=None, break_value=None,
+                           on_queue=None, on_start=None):
     '''
     Execute a function with each argument from a given sequence.
 
@@ -28,6 +27,9 @@ def execute_in_threadqueue(function, args_seq,
     lookahead (use buffer_size). break_value is a singleton object that can
     never occur in the args_seq - it is used to signal the end of the sequence
     to each thread.
+
+    Optional callbacks are notified when an argument enters the lookahead
+    buffer (on_queue) and when a thread picks it up (on_start).
     '''
     # NOTE: ThreadPoolExecutor and multiprocessing.Pool.imap_unordered are greedy.
     #       They consume the whole generator before starting processing its values,
@@ -48,6 +50,8 @@ def execute_in_threadqueue(function, args_seq,
             if task is break_value:
                 break
             try:
+                if on_start is not None:
+                    on_start(task)
                 function(task)
             finally:
                 queue.task_done()
@@ -67,17 +71,199 @@ def execute_in_threadqueue(function, args_seq,
     for i in range(num_threads):  # create worker threads
         start_worker_thread()
 
-    for task in args_seq:  # queue tasks at the sane pace
-        if task is break_value:
-            raise ValueError('Break value can never occur in the args_seq')
-        queue.put(task)
+    try:
+        for task in args_seq:  # queue tasks at the sane pace
+            if task is break_value:
+                raise ValueError('Break value can never occur in the args_seq')
+            if on_queue is not None:
+                on_queue(task)
+            queue.put(task)
+
+        queue.join()  # block until all tasks are done
+    finally:
+        for i in range(num_threads):  # stop workers (even if args_seq has failed)
+            queue.put(break_value)
+        for t in threads:
+            t.join()
+
+
+
+def execute_per_device(function, queues, reads_per_device=1, read=None,
+                       num_threads=None, buffer_size=None, **callbacks):
+    '''
+    Execute a function with each argument from several sequences concurrently.
+
+    `queues` maps storage device identifiers to argument sequences. Each
+    sequence is consumed by its own pool of `reads_per_device` reader threads
+    that call `read(argument)` (if given) before passing the argument on, so
+    all devices are read simultaneously and none is overloaded with
+    concurrent reads. The function is executed by `num_threads` workers
+    shared between all devices. Callbacks are passed to execute_in_threadqueue.
+    '''
+    if num_threads is None:
+        num_threads = os.cpu_count()
+    if buffer_size is None:
+        buffer_size = num_threads * 5
+    ready = Queue(maxsize=buffer_size)  # arguments that have been read
+    finished = object()
+    stop = Event()
+    errors = []
+
+    def consume(args_seq, lock):
+        try:
+            while not stop.is_set():
+                with lock:  # reader threads of a device share the sequence
+                    argument = next(args_seq, finished)
+                if argument is finished:
+                    break
+                if read is not None:
+                    read(argument)
+                ready.put(argument)
+        except Exception as e:
+            errors.append(e)  # raised after all workers have stopped
+        finally:
+            ready.put(finished)
+
+    def arguments():
+        remaining = len(readers)
+        while remaining:
+            argument = ready.get()
+            if argument is finished:
+                remaining -= 1
+            else:
+                yield argument
+
+    readers = []
+    for device, args_seq in queues.items():
+        log.debug('Starting {} reader(s) for device {}'.format(reads_per_device, device))
+        args_seq, lock = iter(args_seq), Lock()
+        for _ in range(reads_per_device):
+            readers.append(Thread(target=consume, args=(args_seq, lock)))
+    for t in readers:
+        t.start()
+    try:
+        execute_in_threadqueue(
+            function,
+            arguments(),
+            num_threads=num_threads,
+            buffer_size=buffer_size,
+            **callbacks
+        )
+    finally:
+        stop.set()
+        while any(t.is_alive() for t in readers):  # unblock readers waiting for free space
+            try:
+                ready.get(timeout=0.1)
+            except Empty:
+                pass
+        for t in readers:
+            t.join()
+    if errors:
+        raise errors[0]
+
+
+
+def batch_by_directory(tasks):
+    '''Group consecutive transcoding tasks from the same source directory into lists'''
+    batch = []
+    for task in tasks:
+        if batch and batch[-1].source_dir != task.source_dir:
+            yield batch
+            batch = []
+        batch.append(task)
+    if batch:
+        yield batch
+
+
+
+class TrackedAlbum:
+    '''Tasks from a single source directory that are counted by AlbumTracker'''
+
+    __slots__ = ('source_dir', 'pending', 'sealed', 'results')
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.pending = 0
+        self.sealed = False  # no more tasks will be added
+        self.results = []
+
+
+    @property
+    def complete(self):
+        return self.sealed and not self.pending
+
+
+
+class AlbumTracker:
+    '''
+    Detect when all tasks from a source directory have been processed while
+    the tasks themselves are executed one by one in parallel threads.
+
+    Tasks must pass through track() as they are produced, and done() must be
+    called for each of them when they are finished. `finished(results)` is
+    called once per album with the list of (task, result) pairs. Tasks that
+    did not pass through track() are albums by themselves
+    '''
+
+    def __init__(self, finished):
+        self.finished = finished
+        self.lock = Lock()
 
-    queue.join()  # block until all tasks are done
 
-    for i in range(num_threads):  # stop workers
-        queue.put(break_value)
-    for t in threads:
-        t.join()
+    def __repr__(self):
+        return '<{cls}({finished})>'.format(
+            cls = self.__class__.__name__,
+            finished = self.finished,
+        )
+
+
+    def track(self, tasks):
+        '''Register tasks as they are produced'''
+        album = None
+        try:
+            for task in tasks:
+                if album is not None and album.source_dir != task.source_dir:
+                    self._seal(album)
+                    album = None
+                if album is None:
+                    album = TrackedAlbum(task.source_dir)
+                with self.lock:
+                    album.pending += 1
+                task.tracked_album = album
+                yield task
+        finally:
+            if album is not None:
+                self._seal(album)
+
+
+    def done(self, task, result=None):
+        '''Mark task as finished'''
+        album = getattr(task, 'tracked_album', None)
+        if album is None:
+            album = TrackedAlbum(task.source_dir)
+            album.sealed = True
+            album.pending = 1
+        with self.lock:
+            album.results.append((task, result))
+            album.pending -= 1
+            complete = album.complete
+        if complete:
+            self.finished(album.results)
+
+
+    def _seal(self, album):
+        with self.lock:
+            album.sealed = True
+            complete = album.complete
+        if complete:
+            self.finished(album.results)
+
+
+
+def for_each(function, items):
+    '''Call the function for each item (adapts per-task callbacks to batches)'''
+    for item in items:
+        function(item)
 
 
 
@@ -102,26 +288,23 @@ class TranscodingQueue:
     def __next__(self):
         next_file = next(self.files)
         prev_task = self.prev_task
-        number = 0
-        next_target_dir = None
-        metadata = {}
-
 
         if prev_task is not None \
         and os.path.dirname(next_file) == prev_task.source_dir:
             # files from same directory always go to the same target
-            # and share the same Metadata object
-            metadata = prev_task.metadata
-            next_target_dir = prev_task.target_dir
-            number = prev_task.number
-
-        next_task = TranscodingTask(
-                        filename = next_file,
-                        pattern = self.pattern,
-                        seq_number = number + 1,
-                        target_dir = next_target_dir
-        )
-        next_task.metadata = metadata
+            # and share the same album level fields (incl. Metadata object)
+            prev_task.target_dir  # calculate target directory for the album
+            next_task = TranscodingTask(
+                            filename = next_file,
+                            pattern = self.pattern,
+                            seq_number = prev_task.number + 1,
+                            album = prev_task.album,
+            )
+        else:
+            next_task = TranscodingTask(
+                            filename = next_file,
+                            pattern = self.pattern,
+            )
         self.prev_task = next_task
         return next_task
 
@@ -131,25 +314,73 @@ class TranscodingQueue:
 
 
 
+class SourceAlbum:
+    '''Fields shared by all transcoding tasks from the same source directory'''
+
+    __slots__ = ('source_dir', 'target_dir', 'metadata', 'categories')
+
+
+    def __init__(self, source_dir, target_dir=None):
+        self.source_dir = sys.intern(source_dir)
+        self.target_dir = target_dir
+        self.metadata = None
+        self.categories = None
+
+
+    def __repr__(self):
+        return '<{cls}({source_dir!r})>'.format(
+            cls = self.__class__.__name__,
+            source_dir = self.source_dir,
+        )
+
+
+
 class TranscodingTask:
-    '''Stores information required to transcode a single music file'''
+    '''
+    Stores information required to transcode a single music file
 
+    Tasks are kept in memory for the whole library when planning the job, so
+    the representation is compact: album level fields are shared between the
+    tasks from the same directory, repetitive strings are interned and music
+    tags are cached only until compact() is called.
+    '''
 
-    def __init__(self, filename, pattern, seq_number=1, target_dir=None):
-        self.source = filename
-        self.source_dir = os.path.dirname(filename)
-        self.pattern = pattern
+    __slots__ = (
+        'album',
+        'filename',
+        'pattern',
+        'number',
+        'result',
+        'status',
+        'ledger_id',  # distributed transcoding
+        'staged_album',  # staging area
+        'tracked_album',  # album gain
+        '_tags',
+        '_duration',
+        '_path_elements',
+        '_target',
+    )
+
+
+    def __init__(self, filename, pattern, seq_number=1, target_dir=None, album=None):
+        directory, self.filename = os.path.split(filename)
+        if album is None:
+            album = SourceAlbum(directory, target_dir)
+        self.album = album
+        self.filename = sys.intern(self.filename)
+        self.pattern = sys.intern(pattern)
         self.number = seq_number
 
         self.result = None  # store full path to the result when task is done
         self.status = None  # indicate skipped task
+        self.ledger_id = None
+        self.staged_album = None
+        self.tracked_album = None
 
-        self._metadata = None
         self._tags = None
+        self._duration = None
         self._path_elements = None
         self._target = None
-        self._target_dir = target_dir
-        self._categories = None
 
         log.debug('Initialized {}'.format(self))
 
@@ -161,6 +392,17 @@ class TranscodingTask:
         )
 
 
+    @property
+    def source(self):
+        '''Full path to the source music file'''
+        return os.path.join(self.album.source_dir, self.filename)
+
+
+    @property
+    def source_dir(self):
+        return self.album.source_dir
+
+
     @property
     def target(self):
         '''Relative path to the transcoding destination file'''
@@ -169,8 +411,8 @@ class TranscodingTask:
 
         safe_elements = {k: safe_filename(v) for k,v in self.path_elements.items()}
         target = self.pattern.format(**safe_elements)
-        if self._target_dir is not None:
-            target = os.path.join(self._target_dir, os.path.basename(target))
+        if self.album.target_dir is not None:
+            target = os.path.join(self.album.target_dir, os.path.basename(target))
 
         self._target = target
         return self._target
@@ -179,9 +421,9 @@ class TranscodingTask:
     @property
     def target_dir(self):
         '''Path to transcoding destination directory'''
-        if self._target_dir is None:
-            self._target_dir = os.path.dirname(self.target)
-        return self._target_dir
+        if self.album.target_dir is None:
+            self.album.target_dir = sys.intern(os.path.dirname(self.target))
+        return self.album.target_dir
 
 
     @property
@@ -195,36 +437,63 @@ class TranscodingTask:
         #  - Genre, year and other less important tags are not worth the
         #    special treatment
         if self._tags is None:
-            self._tags = mutagen.File(self.source, easy=True).tags
+            self._tags = self.read_tags()
         return self._tags
 
 
+    def read_tags(self):
+        '''Read music tags without caching them'''
+        import mutagen
+        audio = mutagen.File(self.source, easy=True)
+        self._duration = audio.info.length
+        return audio.tags
+
+
+    @property
+    def duration(self):
+        '''Duration of the source audio (in seconds)'''
+        if self._duration is None:
+            self.read_tags()
+        return self._duration
+
+
+    def compact(self):
+        '''Drop cached data that can be calculated again when needed'''
+        if self._path_elements is not None:
+            self.target  # keep the target path, it is expensive to calculate
+        self._tags = None
+        self._path_elements = None
+
+
     @property
     def metadata(self):
         '''Metadata object (if any)'''
-        if self._metadata is not None:
-            return self._metadata
+        album = self.album
+        if album.metadata is not None:
+            return album.metadata
 
         metadata_filename = METADATA_YAML
         possible_paths = ['.', '..']
 
         for subdir in possible_paths:
-            candidate_path = os.path.join(self.source_dir, subdir, metadata_filename)
+            candidate_path = os.path.join(album.source_dir, subdir, metadata_filename)
             if os.path.exists(candidate_path):
                 # TODO: handle jsonschema.exceptions.ValidationError
                 # TODO: handle hash mismatch in metadata file
                 log.debug('Reading metadata from {}'.format(candidate_path))
-                self._metadata = Metadata(filename=candidate_path).data
-        if self._metadata is None:
-            self._metadata = {}  # fallback value
-        return self._metadata
+                from hods import Metadata
+                album.metadata = Metadata(filename=candidate_path).data
+        if album.metadata is None:
+            album.metadata = {}  # fallback value
+        return album.metadata
 
 
     @metadata.setter
     def metadata(self, value):
+        from hods import TreeStructuredData
         if isinstance(value, TreeStructuredData):
             log.debug('Reusing metadata object for {}'.format(self.source))
-            self._metadata = value
+            self.album.metadata = value
         elif value == {}:
             pass
         else:
@@ -236,12 +505,13 @@ class TranscodingTask:
     @property
     def categories(self):
         '''Return set of categories describing current task'''
-        if self._categories is None:
+        album = self.album
+        if album.categories is None:
             try:
-                self._categories = set(self.metadata._parent.extra.categories)
+                album.categories = frozenset(self.metadata._parent.extra.categories)
             except (KeyError, AttributeError):
-                self._categories = set()
-        return self._categories
+                album.categories = frozenset()
+        return album.categories
 
 
     @property
@@ -0,0 +1,229 @@
+'''
+Stage transcoded files on fast local storage before writing them to target
+'''
+
+
+import os
+import shutil
+from collections import OrderedDict
+from queue import Queue
+from threading import Lock, Thread
+
+from musicbatch.transcoder.util import make_target_directory, partial_filename
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+class StagedAlbum:
+    '''Transcoding tasks from a single source directory'''
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.pending = 0
+        self.sealed = False  # no more tasks will be added
+        self.tasks = []  # (task, staged file or None)
+
+
+    def __repr__(self):
+        return '<{cls}({source_dir!r}, pending={pending})>'.format(
+            cls = self.__class__.__name__,
+            source_dir = self.source_dir,
+            pending = self.pending,
+        )
+
+
+    @property
+    def complete(self):
+        return self.sealed and not self.pending
+
+
+
+class StagingArea:
+    '''
+    Collect transcoding results in staging directory and move complete albums
+    to the output directory with a single writer thread.
+
+    Concurrent encoders write small chunks to many files at once which is
+    extremely slow on removable media. The writer copies one file at a time
+    in large sequential blocks, then adds cover art and lyrics and verifies
+    the size of each copy.
+
+    Album is considered complete when the task producer moves on to another
+    source directory and all the tasks from the album are finished.
+    '''
+
+    COPY_BUFFER = 8 * 1024**2
+
+
+    def __init__(self, directory, output_dir, extras=None, stats=None):
+        self.directory = directory
+        self.output_dir = output_dir
+        self.extras = extras or ()  # callables that accept finished task
+        self.stats = stats
+        self.albums = OrderedDict()
+        self.lock = Lock()
+        self.flushes = Queue()
+        self.errors = []
+        self.writer = None
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def __repr__(self):
+        return '<{cls}({directory!r} -> {output_dir!r})>'.format(
+            cls = self.__class__.__name__,
+            directory = self.directory,
+            output_dir = self.output_dir,
+        )
+
+
+    def path(self, target):
+        '''Staging location for relative target path'''
+        return os.path.join(self.directory, target)
+
+
+    def track(self, tasks):
+        '''Register tasks as they are produced and seal finished albums'''
+        current = None
+        try:
+            for task in tasks:
+                with self.lock:
+                    if current is not None and current.source_dir != task.source_dir:
+                        self._seal(current)
+                        current = None
+                    if current is None:
+                        current = StagedAlbum(task.source_dir)
+                        self.albums[id(current)] = current
+                    current.pending += 1
+                    task.staged_album = current
+                yield task
+        finally:
+            if current is not None:
+                with self.lock:
+                    self._seal(current)
+
+
+    def done(self, task, staged=None):
+        '''
+        Mark task as finished. Path to the staged file must be provided if
+        transcoding result was written to staging area
+        '''
+        album = getattr(task, 'staged_album', None)
+        if album is None:  # untracked task
+            album = StagedAlbum(task.source_dir)
+            album.sealed = True
+            album.pending = 1
+            with self.lock:
+                self.albums[id(album)] = album
+        with self.lock:
+            album.tasks.append((task, staged))
+            album.pending -= 1
+            if album.complete:
+                self._flush(album)
+
+
+    def _seal(self, album):
+        album.sealed = True
+        if album.complete:
+            self._flush(album)
+
+
+    def _flush(self, album):
+        del self.albums[id(album)]
+        if self.writer is None or not self.writer.is_alive():
+            self.writer = Thread(target=self._write_forever, daemon=True)
+            self.writer.start()
+        self.flushes.put(album)
+
+
+    def _write_forever(self):
+        while True:
+            album = self.flushes.get()
+            try:
+                if album is None:
+                    return
+                if self.stats is not None:
+                    with self.stats.timer('flush').measure():
+                        self.write(album)
+                else:
+                    self.write(album)
+            except Exception as e:
+                log.error('Failed to flush {}: {}'.format(album.source_dir, e))
+                self.errors.append(e)
+            finally:
+                self.flushes.task_done()
+
+
+    def write(self, album):
+        '''Move staged files of the album to the output directory'''
+        log.debug('Flushing {}'.format(album))
+        for task, staged in album.tasks:
+            if staged is None:
+                continue
+            destination = os.path.join(self.output_dir, os.path.relpath(staged, self.directory))
+            self.copy(staged, destination)
+            os.remove(staged)
+            task.result = destination
+        for task, staged in album.tasks:
+            if not task.result:
+                continue
+            for extra in self.extras:
+                try:
+                    extra(task)
+                except Exception as e:
+                    log.error('Failed to process extras for {}: {}'.format(task, e))
+        self.cleanup(album)
+
+
+    def copy(self, source, destination):
+        '''Copy a single file sequentially and verify the result'''
+        size = os.path.getsize(source)
+        make_target_directory(destination)
+        partial = partial_filename(destination)
+        try:
+            with open(source, 'rb') as infile, open(partial, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile, self.COPY_BUFFER)
+            shutil.copystat(source, partial)
+            written = os.path.getsize(partial)
+            if written != size:
+                raise OSError('Size mismatch for {}: {} bytes written, {} expected'.format(
+                    destination, written, size
+                ))
+        except BaseException:
+            if os.path.lexists(partial):
+                os.remove(partial)
+            raise
+        os.replace(partial, destination)
+
+
+    def cleanup(self, album):
+        '''Remove empty staging directories'''
+        directories = set()
+        for task, staged in album.tasks:
+            if staged is not None:
+                directories.add(os.path.dirname(staged))
+        for directory in directories:
+            while os.path.abspath(directory) != os.path.abspath(self.directory):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+
+    def close(self):
+        '''Flush remaining albums and wait for the writer to finish'''
+        with self.lock:
+            for album in list(self.albums.values()):
+                album.sealed = True
+                album.pending = 0
+                self._flush(album)
+        if self.writer is not None:
+            self.flushes.put(None)
+            self.writer.join()
+            self.writer = None
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
@@ -5,6 +5,7 @@ Utilities for internal use
 
 import os
 import re
+from collections import OrderedDict
 
 from musicbatch import transcoder
 
@@ -12,12 +13,56 @@ from musicbatch import transcoder
 
 def find_music(directories):
     '''Traverse file tree in alphabetical order (top down) and return music file paths'''
+    for root, filenames in walk_music(directories):
+        for filename in filenames:
+            yield os.path.join(root, filename)
+
+
+
+def walk_music(directories):
+    '''
+    Traverse file tree in alphabetical order (top down) and return tuples of
+    (directory, sorted names of music files) for directories with music
+    '''
     for directory in sorted(directories):
         for root, dirs, files in os.walk(directory, followlinks=True, topdown=True):
             dirs.sort()  # ensure alphabetical traversal
-            for filename in sorted(files):
-                if is_music(filename):
-                    yield os.path.join(root, filename)
+            music = sorted(filename for filename in files if is_music(filename))
+            if music:
+                yield root, music
+
+
+
+def device_id(path):
+    '''
+    Identify the storage device that contains the path.
+
+    On Linux partitions are resolved to the parent disk, so that the paths from
+    different partitions of a single spindle are treated as one device.
+    Return None if the path is not accessible
+    '''
+    try:
+        device = os.stat(path).st_dev
+    except OSError:
+        return None
+    major, minor = os.major(device), os.minor(device)
+    sysfs = '/sys/dev/block/{}:{}'.format(major, minor)
+    if os.path.exists(os.path.join(sysfs, 'partition')):
+        try:
+            with open(os.path.join(sysfs, '..', 'dev')) as f:
+                return f.read().strip()
+        except OSError:
+            pass
+    return '{}:{}'.format(major, minor)
+
+
+
+def group_by_device(paths):
+    '''Group paths by the storage device they reside on'''
+    groups = OrderedDict()
+    for path in sorted(paths):
+        groups.setdefault(device_id(path), []).append(path)
+    return groups
 
 
 
@@ -53,6 +98,13 @@ def skip_action(input_filename, output_filename):
 
 
 
+def partial_filename(filename):
+    '''Temporary name for the file that is being written'''
+    directory, basename = os.path.split(filename)
+    return os.path.join(directory, '.part-' + basename)
+
+
+
 def make_target_directory(output_filename):
     '''Make sure that directory for this file exists'''
     target = os.path.dirname(output_filename)
@@ -60,6 +112,20 @@ def make_target_directory(output_filename):
 
 
 
+_size = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', re.IGNORECASE)
+def parse_size(value):
+    '''Convert human readable size (e.g. "512M", "64 GB") to the number of bytes'''
+    if isinstance(value, int):
+        return value
+    parsed = _size.match(str(value))
+    if not parsed:
+        raise ValueError('Invalid size value: {}'.format(value))
+    number, unit = parsed.groups()
+    power = ' KMGT'.index(unit.upper() or ' ')
+    return int(float(number) * 1024 ** power)
+
+
+
 _bad_characters = re.compile(r'[^\w\d !.()_+-]')
 def safe_filename(name, placeholder=''):
     '''Convert arbitrary filename into a safe version suitable for any file system'''
@@ -0,0 +1,253 @@
+'''
+Verify integrity of transcoded files by decoding them
+'''
+
+
+import os
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+
+from sqlalchemy import (
+    create_engine,
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    String,
+)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import (
+    Query,
+    sessionmaker,
+)
+
+from musicbatch.transcoder.queue import execute_in_threadqueue
+
+
+import logging
+log = logging.getLogger(__name__)
+Base = declarative_base()
+
+
+
+DURATION_TOLERANCE = 1.0  # seconds, encoders may add padding
+DURATION_TOLERANCE_RATIO = 0.01
+
+
+
+class VerificationError(Exception):
+    '''Output file could not be decoded or its duration does not match the source'''
+
+    def __init__(self, message, stderr=None):
+        super().__init__(message)
+        self.stderr = stderr
+
+
+
+class Verified(Base):
+    __tablename__ = 'verified'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String, unique=True, nullable=False)  # relative to output directory
+    size = Column(Integer, nullable=False)
+    mtime = Column(Float, nullable=False)
+    duration = Column(Float)
+    checked = Column(DateTime)
+
+
+
+class VerificationCache:
+    '''
+    Remember the output files that were decoded successfully, so that
+    repeated verification decodes only new or modified files
+    '''
+
+    def __init__(self, filename=None):
+        if filename is None:
+            url = 'sqlite://'
+        else:
+            url = 'sqlite:///{}'.format(os.path.abspath(filename))
+        self.db = create_engine(url)
+        Base.metadata.create_all(self.db)
+        self.sessionmaker = sessionmaker(bind=self.db)
+        self.lock = Lock()
+
+
+    def __repr__(self):
+        return '<{cls}({url})>'.format(
+            cls = self.__class__.__name__,
+            url = self.db.url,
+        )
+
+
+    def load(self):
+        '''Return a mapping of verified paths to their (size, mtime)'''
+        with self.session() as session:
+            query = Query((Verified.path, Verified.size, Verified.mtime)).with_session(session)
+            return {path: (size, mtime) for path, size, mtime in query}
+
+
+    def save(self, path, size, mtime, duration=None):
+        '''Remember a successfully verified file'''
+        with self.lock, self.session() as session:
+            entry = Query(Verified).with_session(session).filter(Verified.path == path).first()
+            if entry is None:
+                entry = Verified(path=path)
+                session.add(entry)
+            entry.size = size
+            entry.mtime = mtime
+            entry.duration = duration
+            entry.checked = datetime.utcnow()
+
+
+    def forget(self, path):
+        '''Remove the file from cache'''
+        with self.lock, self.session() as session:
+            Query(Verified).with_session(session).filter(Verified.path == path).delete()
+
+
+    @contextmanager
+    def session(self):
+        '''Context manager for database sessions'''
+        short_session = self.sessionmaker()
+        try:
+            yield short_session
+            short_session.commit()
+        except:
+            short_session.rollback()
+            raise
+        finally:
+            short_session.close()
+
+
+
+def decode(filename):
+    '''
+    Decode the audio file discarding the result.
+
+    Return the duration of decoded audio (in seconds) or None if FFmpeg did
+    not report it. Raise VerificationError if decoding fails
+    '''
+    from pydub.utils import get_encoder_name
+    command = [
+        get_encoder_name(), '-nostdin', '-loglevel', 'error', '-progress', 'pipe:1',
+        '-i', filename, '-map', '0:a:0', '-f', 'null', '-',
+    ]
+    process = subprocess.run(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stderr = process.stderr.decode(errors='replace').strip()
+    if process.returncode != 0 or stderr:
+        lines = stderr.splitlines()
+        raise VerificationError(
+            'Decoding failed: {}'.format(lines[-1] if lines else 'exit code {}'.format(process.returncode)),
+            stderr = stderr,
+        )
+    duration = None
+    for line in process.stdout.decode(errors='replace').splitlines():
+        key, _, value = line.partition('=')
+        if key in {'out_time_us', 'out_time_ms'}:  # both are in microseconds
+            try:
+                duration = int(value) / 1000000
+            except ValueError:
+                continue
+    return duration
+
+
+
+class Verifier:
+    '''
+    Decode transcoded files in parallel and compare their duration with the
+    duration of the sources.
+
+    Verification is performed for the (task, output path) pairs. Outputs
+    that were verified before and have not changed since are skipped. Corrupt
+    outputs are reported to `on_corrupt(task, error)` callback.
+    '''
+
+    def __init__(self, output_dir, cache, threads=None, on_corrupt=None, decoder=decode):
+        self.output_dir = output_dir
+        self.cache = cache
+        self.threads = threads
+        self.on_corrupt = on_corrupt
+        self.decoder = decoder
+        self.verified = 0
+        self.cached = 0
+        self.corrupt = []  # (output path, error message)
+        self.errors = 0
+        self.lock = Lock()
+
+
+    def __repr__(self):
+        return '<{cls}({output_dir!r})>'.format(
+            cls = self.__class__.__name__,
+            output_dir = self.output_dir,
+        )
+
+
+    def run(self, pairs):
+        '''Verify all the outputs that are not in cache'''
+        execute_in_threadqueue(self.verify, self.pending(pairs), num_threads=self.threads)
+
+
+    def pending(self, pairs):
+        '''Skip outputs that have been verified and have not changed'''
+        cached = self.cache.load()
+        for task, output in pairs:
+            try:
+                stat = os.stat(output)
+            except OSError:
+                continue  # not transcoded yet
+            path = os.path.relpath(output, self.output_dir)
+            if cached.get(path) == (stat.st_size, stat.st_mtime):
+                self.cached += 1
+                continue
+            yield task, output, path, stat
+
+
+    def verify(self, item):
+        '''Decode a single output and check its duration'''
+        task, output, path, stat = item
+        try:
+            duration = self.decoder(output)
+            expected = task.duration
+            if duration is not None and expected:
+                tolerance = max(DURATION_TOLERANCE, expected * DURATION_TOLERANCE_RATIO)
+                if abs(duration - expected) > tolerance:
+                    raise VerificationError('Duration mismatch: {:.1f}s decoded, {:.1f}s expected'.format(
+                        duration, expected
+                    ))
+        except VerificationError as e:
+            log.error('Corrupt output {}: {}'.format(output, e))
+            with self.lock:
+                self.corrupt.append((output, str(e)))
+            self.cache.forget(path)
+            if self.on_corrupt is not None:
+                self.on_corrupt(task, e)
+        except Exception as e:
+            log.error('Failed to verify {}: {}'.format(output, e))
+            with self.lock:
+                self.errors += 1
+        else:
+            self.cache.save(path, stat.st_size, stat.st_mtime, duration)
+            with self.lock:
+                self.verified += 1
+
+
+    def show(self):
+        '''Human readable summary of verification results'''
+        lines = ['{total} files checked ({verified} decoded, {cached} unchanged since last check, {corrupt} corrupt{errors})'.format(
+            total = self.verified + self.cached + len(self.corrupt) + self.errors,
+            verified = self.verified,
+            cached = self.cached,
+            corrupt = len(self.corrupt),
+            errors = ', {} errors'.format(self.errors) if self.errors else '',
+        )]
+        for output, error in sorted(self.corrupt):
+            lines.append('  {}: {}'.format(output, error))
+        return '\n'.join(lines)
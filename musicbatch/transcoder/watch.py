@@ -0,0 +1,256 @@
+'''
+Watch input directories and transcode new music continuously
+'''
+
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from musicbatch.transcoder.queue import (
+    TranscodingQueue,
+    execute_in_threadqueue,
+)
+from musicbatch.transcoder.util import find_music
+
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+class InotifyWatcher:
+    '''Recursively watch directory trees with Linux inotify API'''
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    _event = struct.Struct('iIII')
+
+
+    def __init__(self, directories):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = directories
+        self.watches = {}
+        for directory in directories:
+            self.add_tree(directory)
+
+
+    def __repr__(self):
+        return '<{cls}({dirs})>'.format(
+            cls = self.__class__.__name__,
+            dirs = list(self.directories),
+        )
+
+
+    def add_tree(self, directory):
+        '''Watch directory and all its subdirectories'''
+        for root, dirs, files in os.walk(directory, followlinks=True):
+            self.add_watch(root)
+
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, 'inotify watch limit reached '
+                                     '(see /proc/sys/fs/inotify/max_user_watches)')
+            log.debug('Can not watch {}: {}'.format(directory, os.strerror(error)))
+            return
+        self.watches[wd] = directory
+
+
+    def events(self, timeout=None):
+        '''
+        Wait for filesystem events and return the list of changed paths.
+
+        Return None if events were lost and full rescan is required
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        overflow = False
+        while offset < len(data):
+            wd, mask, cookie, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                self.add_tree(path)
+                for music_file in find_music([path]):
+                    paths.append(music_file)
+            else:
+                paths.append(path)
+        if overflow:
+            return None
+        return paths
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+class PollingWatcher:
+    '''Detect changes in directory trees by comparing periodic snapshots'''
+
+
+    def __init__(self, directories, interval=60):
+        self.directories = directories
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+
+
+    def __repr__(self):
+        return '<{cls}({dirs}, interval={interval})>'.format(
+            cls = self.__class__.__name__,
+            dirs = list(self.directories),
+            interval = self.interval,
+        )
+
+
+    def take_snapshot(self):
+        snapshot = {}
+        for directory in self.directories:
+            for root, dirs, files in os.walk(directory, followlinks=True):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+
+    def events(self, timeout=None):
+        if timeout is not None:
+            time.sleep(min(timeout, self.interval))
+        else:
+            time.sleep(self.interval)
+        snapshot = self.take_snapshot()
+        paths = [path for path, state in snapshot.items() if self.snapshot.get(path) != state]
+        self.snapshot = snapshot
+        return paths
+
+
+    def close(self):
+        pass
+
+
+
+class AlbumDebouncer:
+    '''
+    Group filesystem events by album directory and release each directory
+    only after no changes were seen in it for `settle` seconds
+    '''
+
+
+    def __init__(self, settle=30):
+        self.settle = settle
+        self.pending = {}
+
+
+    def touch(self, path, now=None):
+        '''Record a change in the file or directory'''
+        if now is None:
+            now = time.monotonic()
+        if os.path.isdir(path):
+            directory = path
+        else:
+            directory = os.path.dirname(path)
+        self.pending[directory] = now
+
+
+    def settled(self, now=None):
+        '''Return the list of directories that were not modified recently'''
+        if now is None:
+            now = time.monotonic()
+        ready = sorted(d for d, t in self.pending.items() if now - t >= self.settle)
+        for directory in ready:
+            del self.pending[directory]
+        return ready
+
+
+    def timeout(self, now=None):
+        '''Seconds until the next directory settles (None if nothing is pending)'''
+        if not self.pending:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max(0, self.settle - (now - min(self.pending.values())))
+
+
+
+def watch_job(job, settle=30, callback=None):
+    '''
+    Transcode new and modified music in the input directories of the job
+    until interrupted.
+
+    Only the affected album directories are passed to TranscodingQueue.
+    '''
+    try:
+        watcher = InotifyWatcher(job.inputs)
+    except (OSError, AttributeError) as e:
+        log.warning('Filesystem events are not available ({}), falling back to polling'.format(e))
+        watcher = PollingWatcher(job.inputs)
+    log.debug('Watching input directories with {}'.format(watcher))
+
+    debouncer = AlbumDebouncer(settle)
+    try:
+        while True:
+            paths = watcher.events(timeout=debouncer.timeout())
+            if paths is None:  # events were lost
+                log.warning('Filesystem events were lost, rescanning all input directories')
+                paths = job.inputs
+            for path in paths:
+                debouncer.touch(path)
+            for directory in debouncer.settled():
+                if not os.path.isdir(directory):
+                    continue
+                transcode_directory(job, directory)
+                if callback is not None:
+                    callback(directory)
+    finally:
+        watcher.close()
+
+
+
+def transcode_directory(job, directory):
+    '''Transcode music from a single directory that has changed'''
+    log.debug('Processing changes in {}'.format(directory))
+    job.reset_timestamp()  # outputs of previous passes are not collisions
+    tasks = job.stats.timed_iter('scan', TranscodingQueue([directory], job.output_pattern))
+    try:
+        function, callbacks = job.processing()
+        execute_in_threadqueue(function, job.batch(job.track(tasks)), num_threads=job.threads, **callbacks)
+    finally:
+        job.flush()
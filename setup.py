@@ -18,7 +18,7 @@ setup(
             'music-metadata=musicbatch.metadata.app:run',
         ],
     },
-    packages=find_packages(exclude=('tests',)),
+    packages=find_packages(exclude=('tests', 'benchmarks')),
     include_package_data=True,
     install_requires=[
         'mutagen',
@@ -31,6 +31,9 @@ setup(
         'lxml',
         'sqlalchemy',
     ],
-    python_requires='>=3.3',
+    extras_require={
+        'replaygain': ['numpy>=1.20'],  # sliding_window_view
+    },
+    python_requires='>=3.7',
     zip_safe=True,
 )
@@ -0,0 +1,128 @@
+'''
+Unit tests for album batched transcoding
+'''
+
+
+import os
+import stat
+import sys
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import TestCase, skipUnless
+
+from musicbatch.transcoder.app import TranscodingJob
+from musicbatch.transcoder.encoders import VorbisTranscoder
+from musicbatch.transcoder.queue import batch_by_directory
+
+
+CONFIG = '''
+name: Batches
+input:
+  - {input}
+output:
+  directory: {output}
+  format: vorbis
+execution:
+  album_batch: 60
+'''
+
+
+FAKE_ENCODER = '''#!{python}
+import shutil, sys
+args = sys.argv[1:]
+inputs = [args[i + 1] for i, arg in enumerate(args) if arg == '-i']
+maps = [int(args[i + 1].split(':')[0]) for i, arg in enumerate(args) if arg == '-map']
+outputs = [args[i + 2] for i, arg in enumerate(args) if arg == '-f']
+with open({log!r}, 'a') as log:
+    log.write('call\\n')
+for index, output in zip(maps, outputs):
+    if 'broken' in inputs[index]:
+        sys.exit(1)
+    shutil.copyfile(inputs[index], output)
+'''
+
+
+class Batching(TestCase):
+    def test_grouping(self):
+        tasks = [SimpleNamespace(source_dir=d) for d in 'aabccca']
+        self.assertEqual(
+            [''.join(t.source_dir for t in batch) for batch in batch_by_directory(tasks)],
+            ['aa', 'b', 'ccc', 'a'],
+        )
+
+
+    def test_queue_items(self):
+        with TemporaryDirectory() as tmp:
+            config = os.path.join(tmp, 'job.yml')
+            with open(config, 'w') as f:
+                f.write(CONFIG.format(input=tmp, output=os.path.join(tmp, 'output')))
+            job = TranscodingJob(config)
+        tasks = [
+            SimpleNamespace(source='/a/{}.flac'.format(name), source_dir='/a', duration=duration)
+            for name, duration in [('1', 30), ('2', 600), ('3', 40), ('4', 20), ('5', 900)]
+        ] + [
+            SimpleNamespace(source='/b/1.flac', source_dir='/b', duration=30),
+            SimpleNamespace(source='/c/1.mp3', source_dir='/c', duration=30),
+            SimpleNamespace(source='/c/2.mp3', source_dir='/c', duration=30),
+        ]
+        items = [[t.source for t in item] for item in job.batch(tasks)]
+        self.assertEqual(items, [
+            ['/a/2.flac'],
+            ['/a/5.flac'],
+            ['/a/1.flac', '/a/3.flac', '/a/4.flac'],  # only short tracks share an encoder
+            ['/b/1.flac'],
+            ['/c/1.mp3'],  # lossy sources are not transcoded
+            ['/c/2.mp3'],
+        ])
+
+        job.loudness = object()  # every track is analyzed on its own
+        self.assertIs(job.batch(tasks), tasks)
+
+
+@skipUnless(sys.platform.startswith('linux'), 'requires executable scripts in PATH')
+class SingleProcess(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.directory = self.tempdir.name
+        self.log = os.path.join(self.directory, 'calls.log')
+        bin_dir = os.path.join(self.directory, 'bin')
+        os.mkdir(bin_dir)
+        encoder = os.path.join(bin_dir, 'ffmpeg')
+        with open(encoder, 'w') as f:
+            f.write(FAKE_ENCODER.format(python=sys.executable, log=self.log))
+        os.chmod(encoder, os.stat(encoder).st_mode | stat.S_IEXEC)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = os.pathsep.join((bin_dir, self.path))
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        self.tempdir.cleanup()
+
+
+    def make_pairs(self, names):
+        pairs = []
+        for name in names:
+            source = os.path.join(self.directory, name + '.flac')
+            with open(source, 'w') as f:
+                f.write(name)
+            pairs.append((source, os.path.join(self.directory, 'out', name)))
+        return pairs
+
+
+    def test_batch(self):
+        encoder = VorbisTranscoder()
+        results = encoder.transcode_batch(self.make_pairs(['01', '02', '03']))
+        self.assertEqual([os.path.basename(r) for r, _ in results], ['01.ogg', '02.ogg', '03.ogg'])
+        self.assertTrue(all(status is encoder.STATUS_OK for _, status in results))
+        for result, _ in results:
+            with open(result) as f:
+                self.assertEqual(f.read(), os.path.basename(result)[:2])
+        with open(self.log) as f:
+            self.assertEqual(f.read(), 'call\n')
+
+
+    def test_failure(self):
+        results = VorbisTranscoder().transcode_batch(self.make_pairs(['01', 'broken', '03']))
+        self.assertTrue(all(status is None for _, status in results))
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'out')), [])
@@ -0,0 +1,92 @@
+'''
+Unit tests for capacity planning
+'''
+
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+from musicbatch.transcoder.capacity import CapacityPlanner
+from musicbatch.transcoder.encoders import (
+    AACTranscoder,
+    LameTranscoder,
+    VerbatimFileCopy,
+    VorbisTranscoder,
+)
+
+
+class FakeTask(SimpleNamespace):
+    def read_tags(self):
+        return self.tags
+
+    def compact(self):
+        pass
+
+
+def make_tasks(albums):
+    tasks = []
+    for album, (size, categories, playcount) in sorted(albums.items()):
+        for number in range(2):
+            tasks.append(FakeTask(
+                source = '/music/{}/{}.flac'.format(album, number),
+                source_dir = '/music/{}'.format(album),
+                categories = set(categories),
+                tags = {'playcount': [str(playcount)]},
+                size = size // 2,
+                existing = 0,
+            ))
+    return tasks
+
+
+def estimate(task):
+    return task.size, task.existing
+
+
+class Planner(TestCase):
+    albums = {
+        'a': (400, [], 1),
+        'b': (300, ['favorites'], 0),
+        'c': (200, [], 5),
+        'd': (100, ['favorites'], 2),
+    }
+
+
+    def plan(self, budget, priority=(), incremental=False, tasks=None):
+        planner = CapacityPlanner(budget, estimate, priority, incremental)
+        planner.MARGIN = 1
+        selected = planner.plan(tasks or make_tasks(self.albums))
+        albums = sorted(set(task.source_dir[-1] for task in selected))
+        left_out = [album.source_dir[-1] for album in planner.left_out]
+        return albums, left_out
+
+
+    def test_scan_order(self):
+        self.assertEqual(self.plan(700), (['a', 'b'], ['c', 'd']))
+        self.assertEqual(self.plan(650), (['a', 'c'], ['b', 'd']))  # gaps are filled
+
+
+    def test_priority(self):
+        self.assertEqual(self.plan(450, ['category:favorites']), (['b', 'd'], ['a', 'c']))
+        self.assertEqual(self.plan(700, ['playcount']), (['a', 'c', 'd'], ['b']))
+        self.assertEqual(self.plan(300, ['category:favorites', 'playcount']), (['c', 'd'], ['b', 'a']))
+        with self.assertRaises(ValueError):
+            self.plan(100, ['loudness'])
+
+
+    def test_incremental(self):
+        tasks = make_tasks(self.albums)
+        for task in tasks:
+            if task.source_dir.endswith('a'):
+                task.existing = task.size  # already transcoded
+        self.assertEqual(self.plan(600, tasks=tasks, incremental=True), (['a', 'b', 'c', 'd'], []))
+        self.assertEqual(self.plan(600, tasks=tasks), (['a', 'c'], ['b', 'd']))
+
+
+
+class Estimates(TestCase):
+    def test_bitrates(self):
+        minute = 60
+        self.assertEqual(VorbisTranscoder('q5').estimate_size(minute), 160 * 1000 // 8 * minute)
+        self.assertEqual(LameTranscoder('V0').estimate_size(minute), 245 * 1000 // 8 * minute)
+        self.assertEqual(AACTranscoder('256k').estimate_size(minute), 256 * 1000 // 8 * minute)
+        self.assertEqual(VerbatimFileCopy().estimate_size(minute, 12345), 12345)
@@ -0,0 +1,99 @@
+'''
+Unit tests for time budgeted runs
+'''
+
+
+import os
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from musicbatch.transcoder.deadline import (
+    CHANGED,
+    NEW,
+    UPGRADE,
+    BudgetedRun,
+    ResumeState,
+    TimeBudget,
+    parse_deadline,
+    parse_duration,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeJob:
+    config_hash = 'hash'
+    output_pattern = '{artist}/{album}/{number} {title}'
+
+    def __init__(self):
+        self.upgrades = set()
+
+    def expected_task_time(self):
+        return 10
+
+
+class Parsing(TestCase):
+    def test_duration(self):
+        dataset = (
+            ('90m', 5400),
+            ('1h30m', 5400),
+            ('2h', 7200),
+            ('45s', 45),
+            (3600, 3600),
+        )
+        for value, seconds in dataset:
+            with self.subTest(value=value):
+                self.assertEqual(parse_duration(value), seconds)
+        with self.assertRaises(ValueError):
+            parse_duration('soon')
+
+
+    def test_deadline(self):
+        now = datetime(2020, 1, 1, 23, 0)
+        self.assertEqual(parse_deadline('06:00', now=now), datetime(2020, 1, 2, 6, 0).timestamp())
+        self.assertEqual(parse_deadline('23:30', now=now), datetime(2020, 1, 1, 23, 30).timestamp())
+        self.assertEqual(parse_deadline('2020-01-03 05:00', now=now), datetime(2020, 1, 3, 5, 0).timestamp())
+        with self.assertRaises(ValueError):
+            parse_deadline('tomorrow')
+
+
+class Budget(TestCase):
+    def test_resume(self):
+        records = [
+            ['/music/a/01.flac', 1, 'a', NEW],
+            ['/music/a/02.flac', 2, 'a', NEW],
+            ['/music/b/01.flac', 1, 'b', CHANGED],
+            ['/music/c/01.flac', 1, 'c', UPGRADE],
+        ]
+        with TemporaryDirectory() as directory:
+            resume = ResumeState(os.path.join(directory, 'resume.json'))
+            self.assertIsNone(resume.load('hash'))
+            resume.save('hash', records)
+            self.assertIsNone(resume.load('other'))
+
+            clock = FakeClock()
+            job = FakeJob()
+            run = BudgetedRun(job, TimeBudget(25, clock=clock), resume)
+            processed = []
+            for task in run.tasks():
+                processed.append(task)
+                clock.now += 5
+            self.assertEqual([task.source for task in processed], [r[0] for r in records[:3]])
+            run.finish(processed[0])
+            run.finish(processed[2])
+            run.save()
+            self.assertEqual(resume.load('hash'), [records[1], records[3]])
+
+            run = BudgetedRun(job, TimeBudget(100, clock=clock), resume)
+            for task in run.tasks():
+                run.finish(task)
+            self.assertEqual(job.upgrades, {'/music/c/01.flac'})
+            run.save()
+            self.assertFalse(os.path.exists(resume.filename))
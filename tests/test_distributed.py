@@ -0,0 +1,248 @@
+'''
+Unit tests for distributed transcoding
+'''
+
+
+import multiprocessing
+import os
+import sys
+import time
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from musicbatch.transcoder.distributed import (
+    DONE,
+    FAILED,
+    PENDING,
+    LedgerTask,
+    WorkLedger,
+    authkey,
+    connect_ledger,
+    journal_results,
+    run_worker,
+    serve_ledger,
+)
+from musicbatch.transcoder.failures import FailureJournal
+from musicbatch.transcoder.progress import TranscodingStats
+from musicbatch.transcoder.queue import TranscodingTask
+
+
+PATTERN = '{artist}/{album}/{number} {title}'
+AUTHKEY = b'test'
+
+
+def make_tasks(count):
+    return [TranscodingTask('/music/{:03d}.flac'.format(i), PATTERN, i, 'album') for i in range(count)]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeJob:
+    '''Job that records processed tasks instead of transcoding them'''
+
+    output_pattern = PATTERN
+    threads = 2
+    callbacks = {}
+    config_hash = 'hash'
+    album_batch = None
+    albums = None
+
+    def __init__(self, output, delay=0, ledger=None):
+        self.output = output
+        self.delay = delay
+        self.ledger = ledger
+        self.stats = TranscodingStats()
+
+    def transcode(self, task):
+        time.sleep(self.delay)
+        if self.ledger is not None:  # like coordinator does periodically
+            self.ledger.reclaim()
+        task.result = os.path.join(self.output, '{}-{}'.format(os.getpid(), os.path.basename(task.source)))
+        with open(task.result, 'w') as f:
+            f.write(task.source)
+        self.stats.record_done()
+        return True
+
+    def track(self, tasks):
+        return tasks
+
+    def flush(self):
+        pass
+
+
+def worker_process(address, output):
+    run_worker(FakeJob(output), connect_ledger(address, AUTHKEY), idle_delay=0.1)
+
+
+class ClosingLedger(WorkLedger):
+    '''Ledger served by coordinator that stops when all tasks are leased'''
+
+    def lease(self, worker, count=1):
+        leased = super().lease(worker, count)
+        if not leased:
+            raise EOFError('connection closed')
+        return leased
+
+    def report(self, worker, stages):
+        raise ConnectionResetError('connection closed')
+
+
+def crashing_worker(address):
+    ledger = connect_ledger(address, AUTHKEY)
+    ledger.lease('crashed', 1)
+    os._exit(1)
+
+
+class Ledger(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.ledger = WorkLedger(lease_time=10, max_attempts=2, clock=self.clock)
+        self.assertFalse(self.ledger.prepare('hash'))
+        self.ledger.fill(make_tasks(3))
+
+
+    def test_lease_and_complete(self):
+        first = self.ledger.lease('a', 2)
+        second = self.ledger.lease('b', 2)
+        self.assertEqual([t['number'] for t in first], [0, 1])
+        self.assertEqual([t['number'] for t in second], [2])
+        self.assertEqual(self.ledger.lease('c'), [])
+        for task in first + second:
+            self.ledger.complete('x', task['id'])
+        self.assertTrue(self.ledger.finished())
+        self.assertEqual(self.ledger.progress()[DONE], 3)
+        self.ledger.report('a', {})
+        self.assertEqual(self.ledger.unreported(), {'b', 'c'})
+
+
+    def test_expired_lease(self):
+        task = self.ledger.lease('a')[0]
+        self.clock.now = 5
+        self.assertEqual(self.ledger.heartbeat('a', [task['id']]), [])
+        self.clock.now = 14
+        self.assertEqual(self.ledger.lease('b', 3)[0]['id'], 2)  # lease is still valid
+        self.clock.now = 16
+        reassigned = self.ledger.lease('b')
+        self.assertEqual(reassigned[0]['id'], task['id'])
+        self.assertEqual(self.ledger.heartbeat('a', [task['id']]), [task['id']])
+
+
+    def test_failures(self):
+        task = self.ledger.lease('a')[0]
+        self.ledger.fail('a', task['id'], 'oops')
+        self.assertEqual(self.ledger.progress()[PENDING], 3)
+        task = self.ledger.lease('a')[0]
+        self.ledger.fail('a', task['id'], 'oops')
+        self.assertEqual(self.ledger.progress()[FAILED], 1)
+        self.assertEqual(self.ledger.failures(), [(task['source'], 'oops')])
+
+        job = FakeJob(None)
+        job.journal = FailureJournal()
+        job.journal.add('hash', '/music/002.flac', 2, 'album', 'old error')
+        job.failing = {'/music/002.flac'}
+        self.ledger.complete('a', self.ledger.lease('a', 3)[-1]['id'])
+        journal_results(job, self.ledger)
+        failures = job.journal.failures('hash')
+        self.assertEqual([(f.source, f.error, f.target_dir) for f in failures], [(task['source'], 'oops', 'album')])
+
+
+    def test_resume(self):
+        self.ledger.lease('a')
+        self.assertTrue(self.ledger.prepare('hash'))
+        self.assertEqual(self.ledger.progress()[PENDING], 3)
+        self.assertFalse(self.ledger.prepare('other'))
+        self.assertEqual(sum(self.ledger.progress().values()), 0)
+
+
+    def test_completed_run(self):
+        for task in self.ledger.lease('a', 3):
+            self.ledger.complete('a', task['id'])
+        self.assertTrue(self.ledger.finished())
+        self.assertFalse(self.ledger.prepare('hash'))  # nothing to resume, inputs are scanned again
+        self.assertEqual(sum(self.ledger.progress().values()), 0)
+        self.ledger.fill(make_tasks(4))
+        self.assertFalse(self.ledger.finished())
+        self.assertEqual(self.ledger.progress()[PENDING], 4)
+
+
+class Worker(TestCase):
+    def test_queued_leases(self):
+        ledger = WorkLedger(lease_time=0.6)
+        ledger.prepare('hash')
+        ledger.fill(make_tasks(6))
+        with TemporaryDirectory() as output:
+            run_worker(FakeJob(output, delay=1, ledger=ledger), ledger, idle_delay=0.1)
+            self.assertEqual(len(os.listdir(output)), 6)
+        with ledger.session() as session:
+            attempts = [row.attempts for row in session.query(LedgerTask)]
+        self.assertEqual(attempts, [1] * 6)  # leases of queued tasks were renewed too
+
+
+    def test_disconnected(self):
+        ledger = ClosingLedger()
+        ledger.prepare('hash')
+        ledger.fill(make_tasks(3))
+        with TemporaryDirectory() as output:
+            run_worker(FakeJob(output), ledger, idle_delay=0.1)
+            self.assertEqual(len(os.listdir(output)), 3)
+
+
+    def test_album_options(self):
+        ledger = WorkLedger()
+        ledger.prepare('hash')
+        ledger.fill(make_tasks(2))
+        with TemporaryDirectory() as output:
+            job = FakeJob(output)
+            job.album_batch = 60
+            job.albums = object()
+            with self.assertLogs('musicbatch.transcoder.distributed', 'WARNING') as logs:
+                run_worker(job, ledger, idle_delay=0.1)
+        self.assertEqual((job.album_batch, job.albums), (None, None))
+        self.assertEqual(len(logs.output), 2)
+
+
+    def test_authkey(self):
+        job = FakeJob(None)
+        with patch.dict(os.environ, {'MUSICBATCH_AUTHKEY': ''}):
+            self.assertEqual(authkey(job, '7391'), b'hash')
+            self.assertEqual(authkey(job, '127.0.0.1:7391'), b'hash')
+            with self.assertRaises(ValueError):
+                authkey(job, '0.0.0.0:7391')
+        with patch.dict(os.environ, {'MUSICBATCH_AUTHKEY': 'secret'}):
+            self.assertEqual(authkey(job, '0.0.0.0:7391'), b'secret')
+
+
+
+@skipUnless(sys.platform.startswith('linux'), 'fork start method is required')
+class Network(TestCase):
+    def test_workers(self):
+        context = multiprocessing.get_context('fork')
+        ledger = WorkLedger(lease_time=1)
+        ledger.prepare('hash')
+        ledger.fill(make_tasks(20))
+        server = serve_ledger(ledger, ('localhost', 0), AUTHKEY)
+        address = server.address
+        try:
+            with TemporaryDirectory() as output:
+                crashed = context.Process(target=crashing_worker, args=(address,))
+                crashed.start()
+                crashed.join()
+                workers = [context.Process(target=worker_process, args=(address, output)) for _ in range(3)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join(timeout=30)
+                    self.assertEqual(worker.exitcode, 0)
+                processed = sorted(name.split('-', 1)[1] for name in os.listdir(output))
+                self.assertEqual(processed, ['{:03d}.flac'.format(i) for i in range(20)])
+            self.assertTrue(ledger.finished())
+            self.assertEqual(len(ledger.reports), 3)
+        finally:
+            server.stop_event.set()
@@ -0,0 +1,171 @@
+'''
+Unit tests for the journal of failed tasks and retries
+'''
+
+
+import errno
+import os
+from subprocess import CalledProcessError
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from musicbatch.transcoder.app import TranscodingJob, TranscodingStep
+from musicbatch.transcoder.failures import (
+    FailureJournal,
+    is_transient,
+    output_tail,
+)
+from musicbatch.transcoder.queue import TranscodingTask
+
+
+PATTERN = '{artist}/{album}/{number} {title}'
+CONFIG = '''
+name: Failures
+input:
+  - {input}
+output:
+  directory: {output}
+  format: copy
+execution:
+  retries: 2
+  retry_delay: 0
+'''
+
+
+class Journal(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, 'track.flac')
+        with open(self.source, 'w') as f:
+            f.write('flac')
+        self.journal = FailureJournal(os.path.join(self.tmp.name, 'transcoding.db'))
+
+
+    def tearDown(self):
+        self.journal.db.dispose()
+        self.tmp.cleanup()
+
+
+    def test_record_and_resolve(self):
+        task = TranscodingTask(self.source, PATTERN, 3, 'album')
+        self.journal.record('hash', task, ValueError('first\nsecond'))
+        failure = self.journal.record('hash', task, ValueError('again'))
+        self.assertEqual(failure.attempts, 2)
+        self.assertEqual(failure.error, 'ValueError: again')
+        self.assertEqual(self.journal.failures('other'), [])
+
+        tasks = list(self.journal.tasks('hash', PATTERN))
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0].source, self.source)
+        self.assertEqual(tasks[0].number, 3)
+        self.assertEqual(tasks[0].target_dir, 'album')
+
+        self.journal.resolve('hash', self.source)
+        self.assertEqual(self.journal.failures('hash'), [])
+
+
+    def test_missing_source(self):
+        task = TranscodingTask(self.source, PATTERN, 1, 'album')
+        self.journal.record('hash', task, ValueError('oops'))
+        os.remove(self.source)
+        self.assertEqual(list(self.journal.tasks('hash', PATTERN)), [])
+        self.assertEqual(self.journal.failures('hash'), [])
+
+
+    def test_output_tail(self):
+        stderr = '\n'.join('line {}'.format(i) for i in range(100)).encode()
+        error = CalledProcessError(1, 'ffmpeg', stderr=stderr)
+        tail = output_tail(error, lines=3)
+        self.assertEqual(tail, 'line 97\nline 98\nline 99')
+        self.assertEqual(output_tail(ValueError('message')), 'message')
+
+
+    def test_transient(self):
+        self.assertTrue(is_transient(OSError(errno.ESTALE, 'Stale file handle')))
+        self.assertFalse(is_transient(OSError(errno.ENOENT, 'No such file')))
+        self.assertFalse(is_transient(ValueError('oops')))
+
+
+
+class Retries(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        inputs = os.path.join(self.tmp.name, 'input')
+        os.makedirs(inputs)
+        self.source = os.path.join(inputs, 'track.flac')
+        with open(self.source, 'w') as f:
+            f.write('flac')
+        config = os.path.join(self.tmp.name, 'job.yml')
+        with open(config, 'w') as f:
+            f.write(CONFIG.format(input=inputs, output=os.path.join(self.tmp.name, 'output')))
+        self.job = TranscodingJob(config)
+        self.job.prepare = lambda task: TranscodingStep(None, None)
+        self.task = TranscodingTask(self.source, PATTERN, 1, 'album')
+
+
+    def tearDown(self):
+        if self.job.keep_journal:
+            self.job.journal.db.dispose()
+        self.tmp.cleanup()
+
+
+    def failing(self, *errors):
+        errors = list(errors)
+        calls = []
+        def _transcode(task, step):
+            calls.append(task)
+            if errors:
+                raise errors.pop(0)
+            task.result = 'done'
+        self.job._transcode = _transcode
+        return calls
+
+
+    def test_transient_error(self):
+        calls = self.failing(OSError(errno.EIO, 'I/O error'), OSError(errno.ESTALE, 'Stale'))
+        self.assertTrue(self.job.transcode(self.task))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.job.stats.failed, 0)
+
+
+    def test_compact(self):
+        self.failing()
+        self.task._tags = {'artist': ['Artist']}
+        self.task._target = 'Artist/Album/01 Title'
+        self.assertTrue(self.job.transcode(self.task))
+        self.assertIsNone(self.task._tags)  # cached tags are released after processing
+        self.assertEqual(self.task.target, 'Artist/Album/01 Title')
+
+
+    def test_persistent_error(self):
+        calls = self.failing(ValueError('broken file'))
+        self.assertFalse(self.job.transcode(self.task))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.job.stats.failed, 1)
+        self.assertIsNone(self.task.result)
+        self.assertEqual(self.job.failures, {self.source: 'ValueError: broken file'})
+        failures = self.job.journal.failures(self.job.config_hash)
+        self.assertEqual([f.source for f in failures], [self.source])
+
+
+    def test_too_many_retries(self):
+        calls = self.failing(*[OSError(errno.EIO, 'I/O error')] * 5)
+        self.assertFalse(self.job.transcode(self.task))
+        self.assertEqual(len(calls), 3)
+
+
+    def test_resolved(self):
+        self.failing(ValueError('broken file'))
+        self.job.transcode(self.task)
+        self.job.failing = {self.source}
+        self.assertTrue(self.job.transcode(self.task))
+        self.assertEqual(self.job.journal.failures(self.job.config_hash), [])
+
+
+    def test_without_journal(self):
+        self.job.keep_journal = False  # distributed worker
+        self.failing(ValueError('broken file'))
+        self.assertFalse(self.job.transcode(self.task))
+        self.assertEqual(self.job.failures, {self.source: 'ValueError: broken file'})
+        self.assertEqual(self.job.failing, set())
+        self.assertFalse(os.path.exists(os.path.join(self.job.output_dir, 'transcoding.db')))
@@ -0,0 +1,60 @@
+'''
+Unit tests for transcoder run history
+'''
+
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+from musicbatch.transcoder.history import RunHistory
+from musicbatch.transcoder.progress import TranscodingStats
+
+
+def fake_job(duration, done, stages, config_hash='abc'):
+    stats = TranscodingStats()
+    stats.started = 1000000
+    stats.finished = stats.started + duration
+    for _ in range(done):
+        stats.record_done()
+    for stage, seconds in stages.items():
+        stats.timer(stage).add(seconds)
+    return SimpleNamespace(
+        job_id = 'Test job',
+        config_hash = config_hash,
+        transcoder = 'encoder',
+        threads = 4,
+        stats = stats,
+    )
+
+
+class RunHistoryComparison(TestCase):
+    def setUp(self):
+        self.history = RunHistory()
+
+
+    def test_no_regression(self):
+        for _ in range(3):
+            self.history.record(fake_job(100, 100, {'transcode': 300}))
+        comparisons = self.history.compare('abc', threshold=0.1)
+        self.assertEqual(len(comparisons), 3)
+        self.assertIsNone(comparisons[0].change)
+        self.assertFalse(any(c.regression for c in comparisons))
+
+
+    def test_regression_culprit(self):
+        for _ in range(3):
+            self.history.record(fake_job(100, 100, {'transcode': 300, 'tags': 10}))
+        self.history.record(fake_job(200, 100, {'transcode': 310, 'tags': 400}))
+        last = self.history.compare('abc', threshold=0.1)[-1]
+        self.assertTrue(last.regression)
+        self.assertAlmostEqual(last.change, -0.5)
+        self.assertEqual(last.culprit, 'tags')
+        self.assertIn('REGRESSION: tags', last.show())
+
+
+    def test_other_configs_ignored(self):
+        self.history.record(fake_job(10, 100, {}, config_hash='other'))
+        self.history.record(fake_job(100, 100, {}))
+        comparisons = self.history.compare('abc')
+        self.assertEqual(len(comparisons), 1)
+        self.assertFalse(comparisons[0].regression)
@@ -0,0 +1,69 @@
+'''
+Import time benchmark for command line entry points
+
+Heavy dependencies must be loaded only when the code path that needs them is
+executed. Import time budget may be overridden with MUSICBATCH_IMPORT_BUDGET
+environment variable (in seconds).
+'''
+
+
+import os
+import re
+import subprocess
+import sys
+from unittest import TestCase
+
+
+IMPORT_BUDGET = float(os.getenv('MUSICBATCH_IMPORT_BUDGET') or 0.15)
+
+ENTRY_POINTS = (
+    'musicbatch.app',
+    'musicbatch.lyrics.app',
+    'musicbatch.metadata.app',
+    'musicbatch.transcoder.app',
+)
+
+HEAVY_MODULES = (
+    'hods',
+    'jsonschema',
+    'lxml',
+    'mutagen',
+    'PIL',
+    'pkg_resources',
+    'pydub',
+    'ruamel',
+    'scrapehelper',
+    'sqlalchemy',
+)
+
+
+def measure_import(module):
+    '''
+    Import module in a clean interpreter.
+    Return cumulative import time (seconds) and the set of loaded top-level modules
+    '''
+    code = 'import sys, {module}; print(" ".join(sys.modules))'.format(module=module)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    pattern = re.compile(r'^import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*{}$'.format(re.escape(module)))
+    cumulative = 0
+    for line in process.stderr.splitlines():
+        match = pattern.match(line)
+        if match:
+            cumulative = int(match.group(1))
+    loaded = set(name.split('.')[0] for name in process.stdout.split())
+    return cumulative / 10**6, loaded
+
+
+class ImportTime(TestCase):
+    def test_entry_points(self):
+        for module in ENTRY_POINTS:
+            with self.subTest(module=module):
+                seconds, loaded = measure_import(module)
+                self.assertFalse(loaded.intersection(HEAVY_MODULES))
+                self.assertLess(seconds, IMPORT_BUDGET)
@@ -0,0 +1,112 @@
+'''
+Unit tests for loudness measurement
+'''
+
+
+from unittest import TestCase
+
+import numpy as np
+
+from musicbatch.transcoder.loudness import (
+    LoudnessAnalysis,
+    LoudnessMeter,
+    gain_tags,
+    measure,
+    to_float,
+)
+
+
+RATE = 48000
+
+
+def sine(level, seconds, frequency=1000, channels=2, rate=RATE):
+    '''Sine wave with peak amplitude of `level` dBFS'''
+    time = np.arange(int(rate * seconds)) / rate
+    wave = 10 ** (level / 20) * np.sin(2 * np.pi * frequency * time)
+    return np.stack([wave] * channels, axis=1)
+
+
+def loudness(samples, chunk=None, rate=RATE):
+    meter = LoudnessMeter(rate, samples.shape[1])
+    if chunk is None:
+        meter.feed(samples)
+    else:
+        for start in range(0, len(samples), chunk):
+            meter.feed(samples[start:start + chunk])
+    return meter.loudness
+
+
+class Meter(TestCase):
+    '''Test cases from EBU Tech 3341'''
+
+    def test_sine(self):
+        self.assertAlmostEqual(loudness(sine(-23, 20)), -23, delta=0.1)
+        self.assertAlmostEqual(loudness(sine(-33, 20)), -33, delta=0.1)
+        self.assertAlmostEqual(loudness(sine(-23, 20, rate=44100), rate=44100), -23, delta=0.1)
+
+
+    def test_gating(self):
+        samples = np.concatenate([sine(-36, 10), sine(-23, 60), sine(-36, 10)])
+        self.assertAlmostEqual(loudness(samples), -23, delta=0.1)
+        samples = np.concatenate([sine(-72, 10), sine(-36, 10), sine(-23, 60), sine(-36, 10), sine(-72, 10)])
+        self.assertAlmostEqual(loudness(samples), -23, delta=0.1)
+
+
+    def test_streaming(self):
+        samples = sine(-20, 5, frequency=440) * np.linspace(0, 1, 5 * RATE)[:, None]
+        whole = loudness(samples)
+        self.assertAlmostEqual(loudness(samples, chunk=1000), whole, places=6)
+        self.assertAlmostEqual(loudness(samples, chunk=100000), whole, places=6)
+
+
+    def test_silence(self):
+        self.assertIsNone(loudness(np.zeros((RATE * 5, 2))))
+        self.assertIsNone(loudness(sine(-23, 0.3)))  # shorter than a single block
+
+
+
+class Conversion(TestCase):
+    def test_sample_width(self):
+        expected = [[0, 0.5], [-0.5, -1]]
+        pcm = {
+            1: bytes([128, 192, 64, 0]),
+            2: np.array([0, 16384, -16384, -32768], dtype='<i2').tobytes(),
+            3: b''.join(int(v).to_bytes(3, 'little', signed=True) for v in (0, 2**22, -2**22, -2**23)),
+            4: np.array([0, 2**30, -2**30, -2**31], dtype='<i4').tobytes(),
+        }
+        for width, raw in pcm.items():
+            with self.subTest(width=width):
+                self.assertEqual(to_float(raw, width, 2).tolist(), expected)
+
+
+    def test_audio_segment(self):
+        from pydub import AudioSegment
+        samples = (sine(-23, 10) * 32767).astype('<i2')
+        segment = AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=RATE, channels=2)
+        meter = measure(segment)
+        self.assertAlmostEqual(meter.loudness, -23, delta=0.1)
+        self.assertAlmostEqual(meter.peak, 10 ** (-23 / 20), places=3)
+
+
+
+class ReplayGain(TestCase):
+    def test_album(self):
+        analysis = LoudnessAnalysis()
+        for name, level in (('quiet', -33), ('loud', -23)):
+            meter = LoudnessMeter(RATE, 2)
+            meter.feed(sine(level, 10))
+            analysis.meters[name] = meter
+        gain = lambda tags, key: float(tags[key].split()[0])
+        self.assertAlmostEqual(gain(analysis.track_tags('loud'), 'replaygain_track_gain'), 5, delta=0.1)
+        album = analysis.album_tags(['quiet', 'loud'])
+        self.assertAlmostEqual(gain(album, 'replaygain_album_gain'), 7.6, delta=0.1)  # quiet track is not gated
+        self.assertEqual(album['replaygain_album_peak'], '0.070795')
+        self.assertEqual(analysis.album_tags(['quiet', 'loud', 'unknown']), {})
+        analysis.discard('loud')
+        self.assertEqual(analysis.track_tags('loud'), {})
+
+
+    def test_opus(self):
+        tags = gain_tags('track', -20.0, 1.0, opus=True)
+        self.assertEqual(tags['r128_track_gain'], str(-3 * 256))
+        self.assertEqual(gain_tags('album', None, 0), {})
@@ -5,7 +5,13 @@ Unit tests for lyrics fetchers
 
 from unittest import TestCase
 
-from musicbatch.lyrics.fetchers import BaseLyricsFetcher
+from musicbatch.lyrics.fetchers import (
+    AzLyricsFetcher,
+    BaseLyricsFetcher,
+    LyricsModeFetcher,
+    MetroLyricsFetcher,
+    MusixMatchFetcher,
+)
 
 
 class HelperFunctions(TestCase):
@@ -18,6 +24,7 @@ class HelperFunctions(TestCase):
             # source, result, position
             ('Beatles, the', 'The Beatles', 'start'),
             ('Beatles,the', 'The Beatles', 'start'),
+            ('Beatles the', 'The Beatles', 'start'),
             ('Amaranthe', 'Amaranthe', 'start'),
             ('The Beatles', 'The Beatles', 'start'),
             ('The Beatles', 'Beatles, the', 'end'),
@@ -26,9 +33,25 @@ class HelperFunctions(TestCase):
             ('Amaranthe', 'Amaranthe', 'end'),
             ('The Beatles', 'Beatles', None),
             ('Beatles, the', 'Beatles', None),
+            ('Beatles the', 'Beatles', None),
             ('Amaranthe', 'Amaranthe', None),
             ('Theater', 'Theater', None),
         )
         for source, result, position in dataset:
             with self.subTest(source=source, result=result, position=position):
                 self.assertEqual(self.fetcher.fix_the(source, position), result)
+
+
+    def test_urls(self):
+        dataset = (
+            # fetcher, artist, first requested URL
+            (AzLyricsFetcher, 'Beatles the', 'https://www.azlyrics.com/lyrics/beatles/yesterday.html'),
+            (AzLyricsFetcher, 'Beatles, the', 'https://www.azlyrics.com/lyrics/beatles/yesterday.html'),
+            (LyricsModeFetcher, 'The Beatles', 'https://www.lyricsmode.com/lyrics/b/beatles/yesterday.html'),
+            (MetroLyricsFetcher, 'Beatles the', 'http://www.metrolyrics.com/printlyric/yesterday-lyrics-the-beatles.html'),
+            (MusixMatchFetcher, 'Beatles, the', 'https://www.musixmatch.com/lyrics/The-Beatles/Yesterday'),
+        )
+        for fetcher, artist, url in dataset:
+            with self.subTest(fetcher=fetcher.__name__, artist=artist):
+                request = next(fetcher().search(artist, 'Yesterday'))
+                self.assertEqual(request.url, url)
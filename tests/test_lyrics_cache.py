@@ -0,0 +1,80 @@
+'''
+Unit tests for HTTP cache of lyrics fetchers
+'''
+
+
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from musicbatch.lyrics.cache import CacheMiss, HTTPCache
+from musicbatch.lyrics.client import HTTPError, Response
+from musicbatch.lyrics.engine import AsyncFetchEngine
+from tests.test_lyrics_engine import FakeFetcher, Server
+
+
+def lookup(fetchers, cache, songs):
+    results = {}
+    def callback(artist, title, text, fetcher):
+        results[title] = text
+    AsyncFetchEngine(fetchers, cache=cache).run(songs, callback)
+    return results
+
+
+class Cache(TestCase):
+    def test_record_replay(self):
+        songs = [('artist', 'first'), ('artist', 'second')]
+        with TemporaryDirectory() as tmp:
+            with Server() as server:
+                fetchers = [FakeFetcher(server.url, '/missing', delay=0), FakeFetcher(server.url, '/lyrics', delay=0)]
+                recorded = lookup(fetchers, HTTPCache(tmp, mode='record'), songs)
+                self.assertEqual(len(server.server.requests), 4)
+            self.assertEqual(recorded, {'first': 'Lyrics of first', 'second': 'Lyrics of second'})
+
+            replayed = lookup(fetchers, HTTPCache(tmp, mode='replay'), songs)  # server is down
+            self.assertEqual(replayed, recorded)
+            results = lookup(fetchers, HTTPCache(tmp, mode='replay'), [('artist', 'third')])
+            self.assertEqual(results, {'third': None})
+
+
+    def test_expiration(self):
+        now = [1000]
+        downloads = []
+        def download(url):
+            downloads.append(url)
+            status = 404 if 'missing' in url else 200
+            return Response(url, status, 'OK', {'content-type': 'text/plain'}, b'same page')
+
+        with TemporaryDirectory() as tmp:
+            cache = HTTPCache(tmp, ttl=60, clock=lambda: now[0])
+            for _ in range(2):
+                response = cache.get('http://example.com/page', dict(id=1), download)
+                self.assertEqual(response.text, 'same page')
+                with self.assertRaises(HTTPError):
+                    cache.get('http://example.com/missing', None, download)
+            self.assertEqual(len(downloads), 2)  # error pages are cached too
+            self.assertEqual(downloads[0], 'http://example.com/page?id=1')
+
+            now[0] += 61
+            cache.get('http://example.com/page', dict(id=1), download)
+            self.assertEqual(len(downloads), 3)
+
+            replay = HTTPCache(tmp, mode='replay', ttl=60, clock=lambda: now[0] + 3600)
+            self.assertEqual(replay.get('http://example.com/page', dict(id=1), download).status, 200)
+            with self.assertRaises(CacheMiss):
+                replay.get('http://example.com/page', dict(id=2), download)
+            self.assertEqual(len(downloads), 3)
+
+            objects = [name for path, dirs, files in os.walk(os.path.join(tmp, 'objects')) for name in files]
+            self.assertEqual(len(objects), 1)  # identical content is stored once
+
+
+    def test_transient_errors(self):
+        def download(url):
+            response = Response(url, 503, 'Service Unavailable', {}, b'')
+            raise HTTPError('unavailable', response)
+        with TemporaryDirectory() as tmp:
+            cache = HTTPCache(tmp)
+            with self.assertRaises(HTTPError):
+                cache.get('http://example.com/page', None, download)
+            self.assertIsNone(cache.load('http://example.com/page'))
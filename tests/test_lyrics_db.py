@@ -0,0 +1,318 @@
+'''
+Unit tests for lyrics database
+'''
+
+
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+from threading import Thread
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from benchmarks.library import flac_stream, sine_wave, write_flac
+from musicbatch.lyrics.db import (
+    SCHEMA_VERSION,
+    Lyrics,
+    LyricsStorage,
+    Schedule,
+    retry_delay,
+    within_budget,
+)
+from musicbatch.lyrics.keys import normalize
+from musicbatch.lyrics.writer import BatchWriter
+from musicbatch.transcoder.deadline import TimeBudget
+
+
+OLD_SCHEMA = '''
+CREATE TABLE lyrics (
+    artist VARCHAR NOT NULL,
+    title VARCHAR NOT NULL,
+    text VARCHAR,
+    source VARCHAR,
+    timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL,
+    PRIMARY KEY (artist, title)
+);
+CREATE TABLE schedule (
+    artist VARCHAR NOT NULL,
+    title VARCHAR NOT NULL,
+    timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL,
+    PRIMARY KEY (artist, title)
+);
+'''
+
+
+class Keys(TestCase):
+    def test_normalize(self):
+        dataset = (
+            ('The Beatles', 'beatles'),
+            ('Beatles, the', 'beatles'),
+            ('  the   BEATLES ', 'beatles'),
+            ('Amaranthe', 'amaranthe'),
+            ('Theater', 'theater'),
+            ('ПИЛОТ', 'пилот'),
+            ('Straße', 'strasse'),
+        )
+        for caption, key in dataset:
+            with self.subTest(caption=caption):
+                self.assertEqual(normalize(caption), key)
+
+
+
+class Fetcher:
+    HOME = 'test'
+    NOT_FOUND = None
+
+    def __init__(self):
+        self.songs = []
+
+    def __call__(self, artist, title, attempt=None, cache=None):
+        self.songs.append((artist, title))
+        return 'Lyrics of {}'.format(title)
+
+    def search(self, artist, title):
+        return self(artist, title)
+        yield
+
+
+
+class Writer(TestCase):
+    def test_batches(self):
+        commits = []
+        @contextmanager
+        def session():
+            batch = []
+            yield batch
+            commits.append(batch)
+        written = []
+        writer = BatchWriter(session, batch_size=100, interval=0.2, committed=written.extend)
+        for i in range(250):
+            writer.put(lambda batch, i=i: batch.append(i), key=i)
+        writer.flush()
+        self.assertEqual([len(batch) for batch in commits], [100, 100, 50])
+        self.assertEqual(sorted(written), list(range(250)))
+
+        start = time.monotonic()
+        writer.put(lambda batch: batch.append('late'))
+        writer.flush()
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)  # incomplete batch waits for interval
+        self.assertEqual(commits[-1], ['late'])
+        writer.close()
+
+
+
+class Storage(TestCase):
+    def test_lookup(self):
+        with TemporaryDirectory() as tmp:
+            db = LyricsStorage(os.path.join(tmp, 'lyrics.db'))
+            with db.session() as session:
+                session.add(Lyrics(artist='The Beatles', title='Yellow  Submarine', text='In the town'))
+                session.add(Lyrics(artist='Пилот', title='Сказка', text='Жили-были'))
+            self.assertEqual(db.stored('beatles, THE', 'yellow submarine'), 'In the town')
+            self.assertEqual(db.stored('ПИЛОТ', 'СКАЗКА'), 'Жили-были')
+            self.assertIsNone(db.stored('Beatles', 'Help'))
+            db.close()
+
+
+    def test_migration(self):
+        with TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'lyrics.db')
+            connection = sqlite3.connect(filename)
+            with connection:
+                connection.executescript(OLD_SCHEMA)
+                connection.executemany(
+                    'INSERT INTO lyrics (artist, title, text) VALUES (?, ?, ?)',
+                    [('Artist {}'.format(i), 'Song {}'.format(i), str(i)) for i in range(25)]
+                )
+                connection.execute('INSERT INTO schedule (artist, title) VALUES (?, ?)', ('The Band', 'Missing'))
+            connection.close()
+
+            db = LyricsStorage(filename)
+            self.assertEqual(db.stored('ARTIST 7', 'song 7'), '7')
+            self.assertEqual(db.due(), [('The Band', 'Missing')])
+            db.record('Band, the', 'missing', 'Found at last', Fetcher)
+            db.close()
+
+            connection = sqlite3.connect(filename)
+            indexes = {row[1] for row in connection.execute("SELECT * FROM sqlite_master WHERE type = 'index'")}
+            self.assertLessEqual({'lyrics_lookup', 'schedule_lookup'}, indexes)
+            plan = ' '.join(str(row) for row in connection.execute(
+                'EXPLAIN QUERY PLAN SELECT text FROM lyrics WHERE artist_key = ? AND title_key = ?',
+                ('a', 'b'),
+            ))
+            self.assertIn('lyrics_lookup', plan)
+            self.assertEqual(connection.execute('SELECT count(*) FROM schedule').fetchone()[0], 0)
+            self.assertEqual(connection.execute('SELECT count(*) FROM lyrics WHERE artist_key IS NULL').fetchone()[0], 0)
+            self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+            connection.close()
+
+            with patch('musicbatch.lyrics.db.upgrade_schema') as upgrade:  # upgraded only once
+                db = LyricsStorage(filename)
+                self.assertEqual(db.stored('Artist 7', 'Song 7'), '7')
+                db.close()
+            upgrade.assert_not_called()
+
+
+    def test_concurrency(self):
+        with TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'lyrics.db')
+            storages = [LyricsStorage(filename), LyricsStorage(filename)]  # like two processes
+            errors = []
+            def work(storage, number):
+                try:
+                    for i in range(50):
+                        title = 'Song {} {}'.format(number, i)
+                        storage.record('Artist', title, 'Text {}'.format(i), Fetcher)
+                        storage.record('Missing', title, None, None)
+                        if storage.stored('artist', title) is None:
+                            raise AssertionError('written lyrics are not visible')
+                except Exception as e:
+                    errors.append(e)
+            threads = [Thread(target=work, args=(storages[n % 2], n)) for n in range(32)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for storage in storages:
+                storage.close()
+            self.assertEqual(errors, [])
+
+            connection = sqlite3.connect(filename)
+            self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(connection.execute('SELECT count(*) FROM lyrics').fetchone()[0], 32 * 50)
+            self.assertEqual(connection.execute('SELECT count(*) FROM schedule').fetchone()[0], 32 * 50)
+            connection.close()
+
+
+    def test_prefetch(self):
+        fetcher = Fetcher()
+        class Storage(LyricsStorage):
+            FETCHERS = ('Fetcher',)
+            fetchers = (fetcher,)
+        db = Storage()
+        db.record('The Beatles', 'Help', 'Help!', Fetcher)
+        db.record('Beatles', 'Yesterday', None, None)
+        db.flush()
+        db.record('Beatles', 'Girl', 'Is there anybody', Fetcher)  # not written yet
+        songs = [
+            ('Beatles, the', 'HELP'),
+            ('The Beatles', 'Yesterday'),
+            ('The Beatles', 'Girl'),
+            ('The Beatles', 'Michelle'),
+            ('Beatles', 'michelle'),
+            ('The Beatles', 'Something'),
+        ]
+        for engine in ('async', 'threads'):
+            with self.subTest(engine=engine):
+                del fetcher.songs[:]
+                db.get_many(db.unknown(songs), engine=engine, check_stored=False)
+                if engine == 'async':
+                    self.assertEqual(fetcher.songs, [('The Beatles', 'Michelle'), ('The Beatles', 'Something')])
+                else:  # already fetched by the previous engine
+                    self.assertEqual(fetcher.songs, [])
+        self.assertEqual(db.stored('beatles', 'michelle'), 'Lyrics of Michelle')
+        db.close()
+
+
+    def test_incremental_scan(self):
+        fetcher = Fetcher()
+        class Storage(LyricsStorage):
+            FETCHERS = ('Fetcher',)
+            fetchers = (fetcher,)
+        stream = flac_stream(sine_wave(0.05))
+        def track(album, title):
+            directory = os.path.join(library, album)
+            os.makedirs(directory, exist_ok=True)
+            filename = os.path.join(directory, title + '.flac')
+            tags = dict(artist='Artist', album=album, title=title, date='2000',
+                        genre='Rock', tracknumber='1', discnumber='1')
+            write_flac(filename, stream, tags)
+            return filename
+
+        with TemporaryDirectory() as library:
+            for album in ('First', 'Second'):
+                for title in ('One', 'Two'):
+                    track(album, album + ' ' + title)
+            db = Storage()
+            db.build_library(library)
+            self.assertEqual(len(fetcher.songs), 4)
+
+            scan = db.scan([library])
+            self.assertEqual(list(scan), [])
+            self.assertEqual(scan.skipped, 2)
+
+            track('Second', 'Second Three')
+            os.utime(track('First', 'First One'), (0, 0))  # tags were edited
+            scan = db.scan([library])
+            self.assertEqual(sorted(title for artist, title in scan), [
+                'First One', 'First Two',
+                'Second One', 'Second Three', 'Second Two',
+            ])
+            self.assertEqual(scan.skipped, 0)
+            self.assertEqual(len(list(db.scan([library], incremental=False))), 5)
+
+            db.build_library(library, prefetch=True)
+            self.assertEqual(fetcher.songs[4:], [('Artist', 'Second Three')])
+            self.assertEqual(list(db.scan([library])), [])
+            db.close()
+
+
+    def test_backoff(self):
+        self.assertEqual(retry_delay(1), timedelta(days=1))
+        self.assertEqual(retry_delay(4), timedelta(days=8))
+        self.assertEqual(retry_delay(50), timedelta(days=90))
+
+        db = LyricsStorage()
+        for _ in range(3):
+            db.record('Artist', 'Rare', None, None)
+        db.record('Artist', 'Fresh', None, None)
+        db.flush()
+        with db.session() as session:
+            rare = session.query(Schedule).filter(Schedule.title == 'Rare').one()
+            self.assertEqual(rare.attempts, 3)
+            self.assertAlmostEqual(
+                (rare.next_attempt - datetime.utcnow()).total_seconds(),
+                timedelta(days=4).total_seconds(),
+                delta=60,
+            )
+        self.assertEqual(db.due(), [])
+        self.assertEqual(db.due(now=datetime.utcnow() + timedelta(days=2)), [('Artist', 'Fresh')])
+        later = datetime.utcnow() + timedelta(days=5)
+        self.assertEqual(db.due(now=later), [('Artist', 'Fresh'), ('Artist', 'Rare')])
+        self.assertEqual(db.due(now=later, limit=1), [('Artist', 'Fresh')])
+        db.close()
+
+
+    def test_waiting(self):
+        fetcher = Fetcher()
+        class Storage(LyricsStorage):
+            FETCHERS = ('Fetcher',)
+            fetchers = (fetcher,)
+        db = Storage()
+        db.record('Artist', 'Rare', None, None)
+        db.flush()
+        self.assertIsNone(db.get('artist', 'rare'))
+        for engine in ('async', 'threads'):
+            db.get_many([('Artist', 'Rare')], engine=engine)
+        self.assertEqual(fetcher.songs, [])
+        self.assertEqual(db.stats.waiting.value, 3)
+        with db.session() as session:
+            rare = session.query(Schedule).one()
+            self.assertEqual(rare.attempts, 1)
+            rare.next_attempt = datetime.utcnow() - timedelta(minutes=1)
+        self.assertEqual(db.get('Artist', 'Rare'), 'Lyrics of Rare')
+        self.assertEqual(fetcher.songs, [('Artist', 'Rare')])
+        db.close()
+
+
+    def test_budget(self):
+        now = [0]
+        budget = TimeBudget(10, clock=lambda: now[0])
+        processed = []
+        for song in within_budget(range(100), budget):
+            processed.append(song)
+            now[0] += 3
+        self.assertEqual(processed, [0, 1, 2, 3])
@@ -0,0 +1,303 @@
+'''
+Unit tests for asynchronous lyrics fetching engine
+'''
+
+
+import asyncio
+import gzip
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, get_ident
+from unittest import TestCase
+from urllib.parse import parse_qs, urlsplit
+
+from musicbatch.lyrics.client import HTTPClient, HTTPError, Response
+from musicbatch.lyrics.engine import (
+    AsyncFetchEngine,
+    FetchError,
+    RateLimiter,
+    Request,
+    drive,
+    parse_html,
+)
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Stand-in for lyrics websites'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *a):
+        pass
+
+    def reply(self, body, status=200, headers=()):
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        if body is not None:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self.server.lock:
+            self.server.requests.append(url.path)
+        if 'delay' in query:
+            time.sleep(float(query['delay']))
+        if url.path == '/lyrics':
+            self.reply('Lyrics of {}'.format(query.get('title')).encode())
+        elif url.path == '/gzip':
+            self.reply(gzip.compress(b'compressed'), headers=[('Content-Encoding', 'gzip')])
+        elif url.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in (b'first ', b'second'):
+                self.wfile.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        elif url.path == '/corrupt':
+            self.reply(b'not gzipped', headers=[('Content-Encoding', 'gzip')])
+        elif url.path == '/redirect':
+            self.reply(b'', status=302, headers=[('Location', '/lyrics?title=moved')])
+        elif url.path == '/page':
+            self.reply(
+                '<html><body><a href="/lyrics?title=линк">Ссылка</a></body></html>'.encode('cp1251'),
+                headers=[('Content-Type', 'text/html; charset=windows-1251')],
+            )
+        else:
+            self.reply(b'not found', status=404)
+
+
+class Server:
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.server.lock = Lock()
+        self.server.connections = 0
+        self.server.requests = []
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *a):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+
+class FakeFetcher:
+    '''Fetcher that finds lyrics only at the given path'''
+
+    NOT_FOUND = None
+    HOME = 'fake'
+
+    def __init__(self, base, path, calls=None, period=None, delay=0.1):
+        self.base = base
+        self.path = path
+        self.delay = delay
+        self.cancelled = False
+        self.errors = []
+        if calls:
+            self.RATELIMIT_CALLS = calls
+            self.RATELIMIT_PERIOD = period
+
+    def search(self, artist, title):
+        try:
+            response = yield Request(self.base + self.path, params=dict(title=title, delay=self.delay))
+        except FetchError as e:
+            self.errors.append(e)
+            return self.NOT_FOUND
+        except GeneratorExit:
+            self.cancelled = True
+            raise
+        return response.text
+
+
+
+class InstantFetcher:
+    '''Fetcher that returns lyrics without any requests'''
+
+    NOT_FOUND = None
+
+    def __init__(self, text):
+        self.text = text
+
+    def search(self, artist, title):
+        return self.text
+        yield
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class Client(TestCase):
+    def test_keepalive(self):
+        async def sequential(client, url):
+            return [(await client.get(url + '/lyrics', dict(title=i))).text for i in range(20)]
+        with Server() as server:
+            client = HTTPClient()
+            texts = run(sequential(client, server.url))
+            self.assertEqual(texts[5], 'Lyrics of 5')
+            self.assertEqual(server.server.connections, 1)
+
+
+    def test_pool_size(self):
+        async def concurrent(client, url):
+            return await asyncio.gather(*[client.get(url + '/lyrics', dict(title=i, delay=0.05)) for i in range(40)])
+        with Server() as server:
+            client = HTTPClient(connections_per_host=4)
+            responses = run(concurrent(client, server.url))
+            self.assertEqual(len(responses), 40)
+            self.assertLessEqual(server.server.connections, 4)
+
+
+    def test_encodings(self):
+        async def fetch(client, url):
+            return [await client.get(url + path) for path in ('/gzip', '/chunked', '/redirect', '/page')]
+        with Server() as server:
+            gzipped, chunked, redirected, page = run(fetch(HTTPClient(), server.url))
+            self.assertEqual(gzipped.content, b'compressed')
+            self.assertEqual(chunked.content, b'first second')
+            self.assertEqual(redirected.text, 'Lyrics of moved')
+            self.assertIn('Ссылка', page.text)
+
+
+    def test_error(self):
+        async def fetch(client, url):
+            await client.get(url + '/missing')
+        with Server() as server:
+            with self.assertRaises(HTTPError) as error:
+                run(fetch(HTTPClient(), server.url))
+            self.assertEqual(error.exception.response.status, 404)
+
+
+    def test_corrupt(self):
+        async def fetch(client, url):
+            await client.get(url + '/corrupt')
+        with Server() as server:
+            with self.assertRaises(HTTPError) as error:
+                run(fetch(HTTPClient(), server.url))
+            self.assertIsNone(error.exception.response)
+        with self.assertRaises(FetchError):
+            parse_html(Response('http://example.com', 200, 'OK', {}, b''))
+
+
+class Limiter(TestCase):
+    def test_ratelimit(self):
+        now = [0]
+        limiter = RateLimiter(2, 10, clock=lambda: now[0])
+        self.assertEqual(limiter.delay(), 0)
+        self.assertEqual(limiter.delay(), 0)
+        now[0] = 4
+        self.assertEqual(limiter.delay(), 6)
+        now[0] = 10
+        self.assertEqual(limiter.delay(), 0)
+
+
+class Engine(TestCase):
+    def process(self, fetchers, songs, **options):
+        results = {}
+        def callback(artist, title, text, fetcher):
+            results[title] = text, fetcher
+        start = time.perf_counter()
+        AsyncFetchEngine(fetchers, **options).run(songs, callback)
+        return results, time.perf_counter() - start
+
+
+    def test_priority(self):
+        with Server() as server:
+            missing = FakeFetcher(server.url, '/missing')
+            found = FakeFetcher(server.url, '/lyrics')
+            results, elapsed = self.process([missing, found], [('artist', str(i)) for i in range(40)])
+        self.assertEqual(len(results), 40)
+        self.assertEqual(results['7'], ('Lyrics of 7', found))
+        self.assertLess(elapsed, 40 * 0.2 / 2)  # requests are in flight simultaneously
+
+
+    def test_blocking_songs(self):
+        threads = set()
+        def songs():
+            for i in range(5):
+                time.sleep(0.05)  # e.g. reading music tags
+                threads.add(get_ident())
+                yield 'artist', str(i)
+        loop_threads = set()
+        def callback(artist, title, text, fetcher):
+            loop_threads.add(get_ident())
+        AsyncFetchEngine([InstantFetcher('text')]).run(songs(), callback)
+        self.assertEqual(len(loop_threads), 1)
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads.isdisjoint(loop_threads))
+
+
+    def test_ratelimit(self):
+        with Server() as server:
+            limited = FakeFetcher(server.url, '/lyrics', calls=3, period=0.5)
+            results, elapsed = self.process([limited], [('artist', str(i)) for i in range(7)])
+        self.assertEqual(len(results), 7)
+        self.assertGreaterEqual(elapsed, 1.0)  # 3 + 3 + 1
+
+
+    def test_client_errors(self):
+        with Server() as server:
+            corrupt = FakeFetcher(server.url, '/corrupt', delay=0)
+            results, elapsed = self.process([corrupt], [('artist', 'song')])
+        self.assertEqual(results['song'], (None, None))
+        self.assertEqual(len(corrupt.errors), 1)  # passed to the fetcher as a failed request
+
+
+    def test_ratelimit_period(self):
+        unknown = FakeFetcher('http://example.com', '/lyrics', calls=3)
+        with self.assertRaises(ValueError):
+            AsyncFetchEngine([unknown]).limiter(unknown)
+
+
+    def test_concurrent(self):
+        with Server() as server:
+            slow = FakeFetcher(server.url, '/lyrics', delay=2)
+            fast = FakeFetcher(server.url, '/lyrics', delay=0.05)
+            results, elapsed = self.process([slow, fast], [('artist', 'song')], strategy='concurrent')
+        self.assertEqual(results['song'], ('Lyrics of song', fast))
+        self.assertLess(elapsed, 1)
+        self.assertTrue(slow.cancelled)
+
+
+    def test_concurrent_tie(self):
+        first, second = InstantFetcher('first'), InstantFetcher('second')
+        results, elapsed = self.process([InstantFetcher(None), first, second], [('a', 't')], strategy='concurrent')
+        self.assertEqual(results['t'], ('first', first))
+
+
+    def test_hedged(self):
+        with Server() as server:
+            slow = FakeFetcher(server.url, '/lyrics', delay=2)
+            fast = FakeFetcher(server.url, '/lyrics', delay=0.05)
+            results, elapsed = self.process([slow, fast], [('artist', 'song')], strategy='hedged', hedge_delay=0.2)
+            self.assertEqual(results['song'], ('Lyrics of song', fast))
+            self.assertGreater(elapsed, 0.2)
+            self.assertLess(elapsed, 1)
+
+            missing = FakeFetcher(server.url, '/missing', delay=0.1)
+            results, elapsed = self.process([missing, fast], [('artist', 'song')], strategy='hedged', hedge_delay=5)
+            self.assertEqual(results['song'], ('Lyrics of song', fast))
+            self.assertLess(elapsed, 1)  # next fetcher starts as soon as previous has failed
+            self.assertEqual(server.server.requests[-2:], ['/missing', '/lyrics'])
+
+
+    def test_blocking_driver(self):
+        fetcher = FakeFetcher('http://example.com', '/lyrics')
+        def perform(request):
+            raise FetchError('offline')
+        self.assertIsNone(drive(fetcher.search('artist', 'title'), perform, FetchError))
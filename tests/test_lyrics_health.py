@@ -0,0 +1,144 @@
+'''
+Unit tests for health tracking of lyrics sources
+'''
+
+
+import asyncio
+import os
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from musicbatch.lyrics.app import sources_report
+from musicbatch.lyrics.client import HTTPError, Response
+from musicbatch.lyrics.db import LyricsStorage
+from musicbatch.lyrics.engine import AsyncFetchEngine, FetchError
+from musicbatch.lyrics.health import Attempt, HealthMonitor, is_source_error
+
+
+class BrokenFetcher:
+    '''Fetcher for a source that is unreachable'''
+
+    NOT_FOUND = None
+    HOME = 'broken'
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, artist, title, attempt=None, cache=None):
+        return self.search(artist, title).send(None)
+
+    def search(self, artist, title):
+        self.calls += 1
+        raise ConnectionRefusedError('source is down')
+        yield
+
+
+class GoodFetcher:
+    '''Fetcher that knows every song'''
+
+    NOT_FOUND = None
+    HOME = 'good'
+
+    def __call__(self, artist, title, attempt=None, cache=None):
+        return 'Lyrics of {}'.format(title)
+
+    def search(self, artist, title):
+        return self(artist, title)
+        yield
+
+
+def response(status):
+    return Response('http://example.com', status, '', {}, b'')
+
+
+class Monitor(TestCase):
+    def test_errors(self):
+        try:
+            try:
+                raise HTTPError('not found', response(404))
+            except HTTPError as e:
+                raise FetchError(str(e)) from e
+        except FetchError as e:
+            self.assertFalse(is_source_error(e))
+        self.assertTrue(is_source_error(HTTPError('unavailable', response(503))))
+        self.assertTrue(is_source_error(ConnectionRefusedError()))
+        try:
+            try:
+                raise asyncio.TimeoutError()
+            except asyncio.TimeoutError:
+                raise HTTPError('Timed out: http://example.com')
+        except HTTPError as e:
+            self.assertTrue(is_source_error(e))
+        self.assertFalse(is_source_error(FetchError('not found')))
+        self.assertFalse(is_source_error(LookupError('no such song')))
+
+
+    def test_misses(self):
+        monitor = HealthMonitor(threshold=2)
+        fetcher = GoodFetcher()
+        for error in (FetchError('not found'), LookupError('no such song'), IndexError('list index out of range')):
+            attempt = Attempt(fetcher)
+            attempt.failed(error)
+            monitor.record(attempt, found=False)
+        self.assertTrue(monitor.available(fetcher))  # misses do not disable healthy sources
+        stats = monitor.source('GoodFetcher')
+        self.assertEqual((stats.lookups, stats.errors, stats.failures), (3, 0, 0))
+
+
+    def test_circuit(self):
+        now = [datetime(2020, 1, 1)]
+        monitor = HealthMonitor(threshold=3, interval=timedelta(hours=1), clock=lambda: now[0])
+        fetcher = BrokenFetcher()
+        for _ in range(3):
+            self.assertTrue(monitor.available(fetcher))
+            attempt = Attempt(fetcher)
+            attempt.failed(ConnectionRefusedError())
+            monitor.record(attempt, found=False)
+        self.assertFalse(monitor.available(fetcher))
+
+        now[0] += timedelta(minutes=61)
+        self.assertTrue(monitor.available(fetcher))  # probe
+        self.assertFalse(monitor.available(fetcher))  # waiting for the probe
+        monitor.record(Attempt(fetcher), found=True)
+        self.assertTrue(monitor.available(fetcher))
+        stats = monitor.source('BrokenFetcher')
+        self.assertEqual((stats.lookups, stats.found, stats.errors, stats.failures), (4, 1, 3, 0))
+
+
+    def test_engine(self):
+        broken, good = BrokenFetcher(), GoodFetcher()
+        monitor = HealthMonitor(threshold=2)
+        results = {}
+        def callback(artist, title, text, fetcher):
+            results[title] = text
+        engine = AsyncFetchEngine([broken, good], max_in_flight=1, health=monitor)
+        engine.run([('artist', str(i)) for i in range(5)], callback)
+        self.assertEqual(results['4'], 'Lyrics of 4')
+        self.assertEqual(broken.calls, 2)
+        self.assertEqual(monitor.source('GoodFetcher').found, 5)
+
+
+
+class Storage(TestCase):
+    def test_persistence(self):
+        class Storage(LyricsStorage):
+            FETCHERS = ('BrokenFetcher', 'GoodFetcher')
+            fetchers = (BrokenFetcher(), GoodFetcher())
+        with TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'lyrics.db')
+            db = Storage(filename)
+            with self.assertRaises(ConnectionRefusedError):
+                db.get('artist', 'title')
+            db.get_many([('artist', 'song')])
+            self.assertEqual(db.get('artist', 'song'), 'Lyrics of song')
+            db.close()
+
+            db = Storage(filename)
+            broken, good = db.sources()
+            self.assertEqual((broken.lookups, broken.errors, broken.failures), (2, 2, 2))
+            self.assertEqual((good.lookups, good.found), (1, 1))
+            report = sources_report(db.sources())
+            self.assertIn('GoodFetcher', report)
+            self.assertIn('100.0%', report)
+            db.close()
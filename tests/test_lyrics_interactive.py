@@ -21,7 +21,11 @@ TEST_SONGS = (
 )
 
 
-def run_tests(fetcher_class, filename=None):
+def run_tests(fetcher_class, filename=None, cache=None):
+    '''
+    Fetch lyrics for test songs. Pass HTTPCache to record web pages once and
+    to rerun fixed parsers on the same pages offline (mode='replay')
+    '''
     fetcher = fetcher_class()
 
     if filename:
@@ -32,7 +36,7 @@ def run_tests(fetcher_class, filename=None):
 
     for artist, title, explanation in TEST_SONGS:
         try:
-            lyrics = fetcher(artist, title)
+            lyrics = fetcher(artist, title, cache=cache)
         except Exception:
             lyrics = format_exc()
         show(
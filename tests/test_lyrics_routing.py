@@ -0,0 +1,118 @@
+'''
+Unit tests for adaptive order of lyrics fetchers
+'''
+
+
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from musicbatch.lyrics.db import LyricsStorage
+from musicbatch.lyrics.engine import AsyncFetchEngine
+from musicbatch.lyrics.routing import FetcherRanking, detect_script, song_features
+
+
+class ScriptFetcher:
+    '''Fetcher that knows only songs in a single script'''
+
+    NOT_FOUND = None
+    HOME = 'script'
+
+    def __init__(self, script):
+        self.script = script
+        self.calls = 0
+
+    def __call__(self, artist, title, attempt=None, cache=None):
+        self.calls += 1
+        if detect_script(artist + title) == self.script:
+            return 'Lyrics of {}'.format(title)
+        return self.NOT_FOUND
+
+    def search(self, artist, title):
+        return self(artist, title)
+        yield
+
+
+class Latin(ScriptFetcher):
+    def __init__(self):
+        super().__init__('latin')
+
+
+class Cyrillic(ScriptFetcher):
+    def __init__(self):
+        super().__init__('cyrillic')
+
+
+class German(ScriptFetcher):
+    def __init__(self):
+        super().__init__('latin-ext')
+
+
+
+class Features(TestCase):
+    def test_script(self):
+        self.assertEqual(detect_script('Metallica'), 'latin')
+        self.assertEqual(detect_script('Кино - Группа крови'), 'cyrillic')
+        self.assertEqual(detect_script('Die Ärzte'), 'latin-ext')
+        self.assertEqual(detect_script('坂本龍一'), 'cjk')
+        self.assertIsNone(detect_script('1979 - 2000!'))
+
+
+    def test_features(self):
+        self.assertEqual(
+            song_features('The  Beatles', 'Help'),
+            ['*', 'script:latin', 'artist:beatles'],
+        )
+
+
+
+class Ranking(TestCase):
+    def test_order(self):
+        latin, cyrillic, german = Latin(), Cyrillic(), German()
+        fetchers = (latin, cyrillic, german)
+        ranking = FetcherRanking()
+        self.assertEqual(ranking.order(fetchers, 'Кино', 'Кукушка'), fetchers)  # no data yet
+        for artist, title in [('Кино', 'Звезда'), ('Metallica', 'One'), ('Die Ärzte', 'Schrei nach Liebe')] * 5:
+            for fetcher in fetchers:
+                found = fetcher(artist, title) is not None
+                ranking.record(artist, title, fetcher, found)
+        self.assertEqual(ranking.order(fetchers, 'Сплин', 'Романс')[0], cyrillic)
+        self.assertEqual(ranking.order(fetchers, 'Rammstein', 'Ohne dich')[0], latin)  # no umlauts
+        self.assertEqual(ranking.order(fetchers, 'Rammstein', 'Du hast mich gefragt, für immer')[0], german)
+
+
+    def test_engine(self):
+        latin, cyrillic = Latin(), Cyrillic()
+        ranking = FetcherRanking()
+        songs = [('Кино', str(i)) for i in range(30)]
+        results = {}
+        def callback(artist, title, text, fetcher):
+            results[title] = fetcher
+        AsyncFetchEngine([latin, cyrillic], max_in_flight=1, ranking=ranking).run(songs, callback)
+        self.assertEqual(len(results), 30)
+        self.assertLess(latin.calls, 10)
+        self.assertEqual(cyrillic.calls, 30)
+
+
+    def test_storage(self):
+        class Storage(LyricsStorage):
+            FETCHERS = ('Latin', 'Cyrillic')
+            fetchers = (Latin(), Cyrillic())
+        latin, cyrillic = Storage.fetchers
+        with TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'lyrics.db')
+            db = Storage(filename)
+            for i in range(10):
+                self.assertIsNotNone(db.get('Кино', 'Песня {}'.format(i)))
+            db.close()
+            self.assertEqual(latin.calls, 1)  # first miss is enough to demote the source
+
+            db = Storage(filename)  # statistics are persistent
+            self.assertIsNotNone(db.get('Сплин', 'Романс'))
+            self.assertEqual(latin.calls, 1)
+            db.close()
+
+            db = Storage(filename, adaptive=False)
+            self.assertIsNotNone(db.get('Ария', 'Штиль'))
+            self.assertEqual(latin.calls, 2)
+            db.close()
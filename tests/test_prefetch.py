@@ -0,0 +1,51 @@
+'''
+Unit tests for source prefetching
+'''
+
+
+import os
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import TestCase
+
+from musicbatch.transcoder.prefetch import SourcePrefetcher
+from musicbatch.transcoder.util import parse_size
+
+
+class Prefetcher(TestCase):
+    def test_budget(self):
+        with TemporaryDirectory() as directory:
+            tasks = []
+            for i in range(5):
+                path = os.path.join(directory, '{}.flac'.format(i))
+                with open(path, 'wb') as f:
+                    f.write(b'\0' * 100)
+                tasks.append(SimpleNamespace(source=path))
+            for method in ('fadvise', 'read'):
+                with self.subTest(method=method):
+                    prefetcher = SourcePrefetcher(lookahead=3, budget=250, method=method)
+                    for task in tasks:
+                        prefetcher.queued(task)
+                    self.assertEqual(prefetcher.reserved, 200)  # budget limit
+                    prefetcher.started(tasks[0])
+                    self.assertEqual(prefetcher.reserved, 200)
+                    self.assertEqual(prefetcher.prefetched, 300)
+                    for task in tasks[1:]:
+                        prefetcher.started(task)
+                    self.assertEqual(prefetcher.reserved, 0)
+                    self.assertEqual(prefetcher.prefetched, 500)
+
+
+    def test_size(self):
+        dataset = (
+            (1024, 1024),
+            ('1024', 1024),
+            ('256M', 256 * 1024**2),
+            ('1.5 GB', int(1.5 * 1024**3)),
+            ('64GiB', 64 * 1024**3),
+        )
+        for value, result in dataset:
+            with self.subTest(value=value):
+                self.assertEqual(parse_size(value), result)
+        with self.assertRaises(ValueError):
+            parse_size('lots')
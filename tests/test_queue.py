@@ -0,0 +1,121 @@
+'''
+Unit tests for transcoding queue helpers
+'''
+
+
+import time
+from collections import Counter
+from tempfile import TemporaryDirectory
+from threading import Lock
+from unittest import TestCase
+
+from musicbatch.transcoder.queue import (
+    AlbumTracker,
+    TranscodingTask,
+    execute_in_threadqueue,
+    execute_per_device,
+)
+from musicbatch.transcoder.util import group_by_device
+
+
+PATTERN = '{artist}/{album}/{number} {title}'
+
+
+class PerDeviceExecution(TestCase):
+    def test_limits(self):
+        lock = Lock()
+        reading = Counter()
+        peak = Counter()
+        running = []
+        total = []
+
+        def read(task):
+            device, number = task
+            with lock:
+                reading[device] += 1
+                peak[device] = max(peak[device], reading[device])
+            time.sleep(0.002)
+            with lock:
+                reading[device] -= 1
+
+        def function(task):
+            with lock:
+                running.append(task)
+                total.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.remove(task)
+
+        queues = {device: [(device, i) for i in range(10)] for device in 'abc'}
+        execute_per_device(function, queues, reads_per_device=2, read=read, num_threads=5)
+        self.assertEqual(len(total), 30)
+        self.assertEqual(set(peak), set('abc'))
+        self.assertTrue(all(value <= 2 for value in peak.values()))
+        self.assertLessEqual(max(total), 5)
+
+        total.clear()
+        execute_per_device(function, {'a': [('a', i) for i in range(10)]}, reads_per_device=1, num_threads=4)
+        self.assertGreater(max(total), 1)  # encoding is not limited to one task per device
+
+
+    def test_reader_error(self):
+        def tasks():
+            yield 1
+            raise OSError('device is gone')
+        processed = []
+        with self.assertRaises(OSError):
+            execute_per_device(processed.append, {'a': tasks(), 'b': range(5)}, num_threads=2)
+        self.assertEqual(sorted(processed), [0, 1, 1, 2, 3, 4])
+
+
+    def test_grouping(self):
+        with TemporaryDirectory() as first, TemporaryDirectory() as second:
+            groups = group_by_device([second, first])
+            self.assertEqual(list(groups.values()), [sorted([first, second])])
+
+
+class Tasks(TestCase):
+    def test_compact(self):
+        first = TranscodingTask('/music/album/01.flac', PATTERN)
+        second = TranscodingTask('/music/album/02.flac', PATTERN, 2, album=first.album)
+        self.assertFalse(hasattr(first, '__dict__'))
+        self.assertIs(first.source_dir, second.source_dir)
+        self.assertEqual(second.source, '/music/album/02.flac')
+        with self.assertRaises(AttributeError):
+            first.something = 'value'
+
+
+    def test_shared_target_dir(self):
+        first = TranscodingTask('/music/album/01.flac', PATTERN)
+        first._path_elements = dict(artist='Artist', album='Album', title='One', number='01')
+        second = TranscodingTask('/music/album/02.flac', PATTERN, 2, album=first.album)
+        second._path_elements = dict(artist='Other', album='Album', title='Two', number='02')
+        self.assertEqual(first.target_dir, 'Artist/Album')
+        self.assertEqual(second.target, 'Artist/Album/02 Two')
+        second.compact()
+        self.assertIsNone(second._path_elements)
+        self.assertEqual(second.target, 'Artist/Album/02 Two')
+
+
+
+class Albums(TestCase):
+    def test_tracker(self):
+        tasks = [
+            TranscodingTask('/music/{}/{:02d}.flac'.format(album, number), '{title}', number)
+            for album in ('first', 'second', 'third')
+            for number in range(1, 5)
+        ]
+        albums = []
+        lock = Lock()
+        def finished(results):
+            with lock:
+                albums.append(sorted(task.number for task, result in results))
+        tracker = AlbumTracker(finished)
+        def process(task):
+            time.sleep(0.01 * (task.number % 3))
+            tracker.done(task, True)
+        execute_in_threadqueue(process, tracker.track(tasks), num_threads=4)
+        self.assertEqual(albums, [[1, 2, 3, 4]] * 3)
+
+        tracker.done(TranscodingTask('/music/single.flac', '{title}'), False)
+        self.assertEqual(albums[-1], [1])
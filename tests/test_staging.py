@@ -0,0 +1,86 @@
+'''
+Unit tests for staging area
+'''
+
+
+import errno
+import os
+import threading
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from musicbatch.transcoder.staging import StagingArea
+
+
+def make_task(album, number):
+    source_dir = os.path.join('/music', album)
+    return SimpleNamespace(
+        source = os.path.join(source_dir, '{:02d}.flac'.format(number)),
+        source_dir = source_dir,
+        target = os.path.join(album, '{:02d}.ogg'.format(number)),
+        result = None,
+    )
+
+
+class Staging(TestCase):
+    def test_flush(self):
+        with TemporaryDirectory() as staging, TemporaryDirectory() as output:
+            extras = []
+            area = StagingArea(
+                staging,
+                output,
+                extras=[lambda task: extras.append((task.result, threading.current_thread()))],
+            )
+            tasks = [make_task(album, number) for album in ('first', 'second') for number in range(3)]
+            produced = area.track(tasks)
+            for task in produced:
+                staged = area.path(task.target)
+                os.makedirs(os.path.dirname(staged), exist_ok=True)
+                with open(staged, 'w') as f:
+                    f.write(task.source)
+                task.result = staged
+                area.done(task, staged)
+                if task.source_dir.endswith('second'):
+                    break  # first album is sealed and flushed by now
+            area.flushes.join()
+            self.assertEqual(os.listdir(output), ['first'])
+            self.assertEqual(len(os.listdir(os.path.join(output, 'first'))), 3)
+            self.assertEqual(len(extras), 3)
+            self.assertTrue(all(r.startswith(output) for r, _ in extras))
+
+            for task in produced:
+                staged = area.path(task.target)
+                with open(staged, 'w') as f:
+                    f.write(task.source)
+                area.done(task, staged)
+            area.close()
+            self.assertEqual(len(os.listdir(os.path.join(output, 'second'))), 3)
+            self.assertEqual(os.listdir(staging), [])
+            self.assertEqual(len(set(thread for _, thread in extras)), 1)
+            with open(os.path.join(output, 'second', '02.ogg')) as f:
+                self.assertEqual(f.read(), '/music/second/02.flac')
+
+
+    def test_errors(self):
+        with TemporaryDirectory() as staging, TemporaryDirectory() as output:
+            area = StagingArea(staging, output)
+            for task in area.track([make_task('album', 1)]):
+                area.done(task, area.path('missing.ogg'))
+            with self.assertRaises(OSError):
+                area.close()
+
+
+    def test_partial_copy(self):
+        def copyfileobj(infile, outfile, length):
+            outfile.write(infile.read(2))
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        with TemporaryDirectory() as staging, TemporaryDirectory() as output:
+            area = StagingArea(staging, output)
+            source = os.path.join(staging, 'track.ogg')
+            with open(source, 'w') as f:
+                f.write('music')
+            with patch('shutil.copyfileobj', copyfileobj), self.assertRaises(OSError):
+                area.copy(source, os.path.join(output, 'album', 'track.ogg'))
+            self.assertEqual(os.listdir(os.path.join(output, 'album')), [])
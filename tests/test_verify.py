@@ -0,0 +1,150 @@
+'''
+Unit tests for verification of transcoded files
+'''
+
+
+import os
+import stat
+import sys
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import TestCase, skipUnless
+
+from musicbatch.transcoder.verify import (
+    VerificationCache,
+    VerificationError,
+    Verifier,
+    decode,
+)
+
+
+FAKE_DECODER = '''#!{python}
+import sys
+args = sys.argv[1:]
+with open(args[args.index('-i') + 1]) as f:
+    content = f.read()
+if content == 'broken':
+    sys.stderr.write('Invalid data found when processing input\\n')
+    sys.exit(1)
+print('out_time_us={{}}'.format(int(float(content) * 1000000)))
+print('progress=end')
+'''
+
+
+class FakeDecoder:
+    '''Read duration from file contents'''
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, filename):
+        self.calls.append(os.path.basename(filename))
+        with open(filename) as f:
+            content = f.read()
+        if content == 'broken':
+            raise VerificationError('Decoding failed')
+        return float(content)
+
+
+class Verification(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.directory = self.tempdir.name
+        self.cache = VerificationCache(os.path.join(self.directory, 'transcoding.db'))
+        self.corrupt = []
+
+
+    def tearDown(self):
+        self.cache.db.dispose()
+        self.tempdir.cleanup()
+
+
+    def make_pairs(self, outputs):
+        pairs = []
+        for name, (content, duration) in sorted(outputs.items()):
+            output = os.path.join(self.directory, name)
+            with open(output, 'w') as f:
+                f.write(content)
+            pairs.append((SimpleNamespace(source=name, duration=duration), output))
+        return pairs
+
+
+    def verify(self, pairs):
+        decoder = FakeDecoder()
+        verifier = Verifier(
+            self.directory,
+            self.cache,
+            threads = 2,
+            on_corrupt = lambda task, error: self.corrupt.append(task.source),
+            decoder = decoder,
+        )
+        verifier.run(pairs)
+        return verifier, sorted(decoder.calls)
+
+
+    def test_verify(self):
+        pairs = self.make_pairs({
+            'good.ogg': ('180.2', 180),
+            'truncated.ogg': ('61', 180),
+            'broken.ogg': ('broken', 180),
+        })
+        pairs.append((SimpleNamespace(source='missing', duration=1), os.path.join(self.directory, 'missing')))
+        verifier, decoded = self.verify(pairs)
+        self.assertEqual(decoded, ['broken.ogg', 'good.ogg', 'truncated.ogg'])
+        self.assertEqual(verifier.verified, 1)
+        self.assertEqual(sorted(self.corrupt), ['broken.ogg', 'truncated.ogg'])
+        self.assertIn('3 files checked', verifier.show())
+
+
+    def test_cache(self):
+        pairs = self.make_pairs({'first.ogg': ('10', 10), 'second.ogg': ('20', 20)})
+        self.verify(pairs)
+        verifier, decoded = self.verify(pairs)
+        self.assertEqual(decoded, [])
+        self.assertEqual(verifier.cached, 2)
+
+        with open(pairs[1][1], 'a') as f:
+            f.write('0')  # size changes
+        verifier, decoded = self.verify(pairs)
+        self.assertEqual(decoded, ['second.ogg'])
+        self.assertEqual(self.corrupt, ['second.ogg'])
+        verifier, decoded = self.verify(pairs)
+        self.assertEqual(decoded, ['second.ogg'])  # corrupt files are not cached
+
+
+
+@skipUnless(sys.platform.startswith('linux'), 'requires executable scripts in PATH')
+class Decoding(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.directory = self.tempdir.name
+        bin_dir = os.path.join(self.directory, 'bin')
+        os.mkdir(bin_dir)
+        decoder = os.path.join(bin_dir, 'ffmpeg')
+        with open(decoder, 'w') as f:
+            f.write(FAKE_DECODER.format(python=sys.executable))
+        os.chmod(decoder, os.stat(decoder).st_mode | stat.S_IEXEC)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = os.pathsep.join((bin_dir, self.path))
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        self.tempdir.cleanup()
+
+
+    def make_file(self, content):
+        filename = os.path.join(self.directory, 'output.ogg')
+        with open(filename, 'w') as f:
+            f.write(content)
+        return filename
+
+
+    def test_duration(self):
+        self.assertEqual(decode(self.make_file('12.5')), 12.5)
+
+
+    def test_error(self):
+        with self.assertRaises(VerificationError) as context:
+            decode(self.make_file('broken'))
+        self.assertIn('Invalid data', context.exception.stderr)
@@ -0,0 +1,88 @@
+'''
+Unit tests for transcoder watch mode
+'''
+
+
+import os
+import sys
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipUnless
+
+from benchmarks.library import flac_stream, sine_wave, write_flac
+from musicbatch.transcoder.app import TranscodingJob
+from musicbatch.transcoder.watch import AlbumDebouncer, InotifyWatcher, transcode_directory
+
+
+CONFIG = '''
+name: Watch
+input:
+  - {input}
+output:
+  directory: {output}
+  format: copy
+'''
+
+
+class Debouncer(TestCase):
+    def test_settle(self):
+        debouncer = AlbumDebouncer(settle=10)
+        debouncer.touch('/music/album/01.flac', now=0)
+        debouncer.touch('/music/other/01.flac', now=5)
+        debouncer.touch('/music/album/02.flac', now=8)
+        self.assertEqual(debouncer.timeout(now=8), 7)
+        self.assertEqual(debouncer.settled(now=15), ['/music/other'])
+        self.assertEqual(debouncer.settled(now=17), [])
+        self.assertEqual(debouncer.settled(now=18), ['/music/album'])
+        self.assertIsNone(debouncer.timeout())
+
+
+@skipUnless(sys.platform.startswith('linux'), 'inotify is available only on Linux')
+class Inotify(TestCase):
+    def test_new_album(self):
+        with TemporaryDirectory() as library:
+            watcher = InotifyWatcher([library])
+            try:
+                album = os.path.join(library, 'artist', 'album')
+                os.makedirs(album)
+                with open(os.path.join(album, '01.flac'), 'w') as f:
+                    f.write('test')
+                paths = set()
+                for _ in range(5):
+                    events = watcher.events(timeout=0.5)
+                    if not events:
+                        break
+                    paths.update(events)
+                self.assertIn(os.path.join(album, '01.flac'), paths)
+            finally:
+                watcher.close()
+
+
+
+class Passes(TestCase):
+    def test_same_album_twice(self):
+        with TemporaryDirectory() as tmp:
+            album = os.path.join(tmp, 'input', 'album')
+            os.makedirs(album)
+            stream = flac_stream(sine_wave(0.05))
+            def track(number):
+                tags = dict(artist='Artist', album='Album', title='Track {}'.format(number),
+                            date='2000', tracknumber=str(number))
+                write_flac(os.path.join(album, '{:02d}.flac'.format(number)), stream, tags)
+            config = os.path.join(tmp, 'job.yml')
+            output = os.path.join(tmp, 'output')
+            with open(config, 'w') as f:
+                f.write(CONFIG.format(input=os.path.join(tmp, 'input'), output=output))
+            job = TranscodingJob(config)
+
+            track(1)
+            track(2)
+            transcode_directory(job, album)
+            track(3)  # album has changed after it was transcoded by this process
+            transcode_directory(job, album)
+
+            self.assertEqual(job.failures, {})
+            self.assertEqual(job.stats.failed, 0)
+            self.assertEqual(job.stats.skipped, 2)
+            results = [name for path, dirs, files in os.walk(output) for name in files if name.endswith('.flac')]
+            self.assertEqual(len(results), 3)
+            job.journal.db.dispose()